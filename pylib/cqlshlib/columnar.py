@@ -0,0 +1,376 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# columnar table dumps, as written by COPY TO with FORMAT=columnar, and read
+# back with ColumnarTable. A dump is a directory holding schema.json, which
+# describes the table and its columns, and for column number n:
+#
+#   n.valid    one byte per row: 1 where the row has a value, 0 for null
+#   n.values   for fixed-width types, the values packed one after another in
+#              the struct format given for the column in the schema (with
+#              nulls as zeros); for other types, the bytes of the values one
+#              after another: utf8 for text, as they are for ascii and blobs,
+#              decimal digits for decimals and varints, and serialized the way
+#              Cassandra does for everything else
+#   n.offsets  for variable-width types only: rows + 1 offsets into n.values,
+#              in the schema's offset_format, the value of row i being
+#              values[offsets[i]:offsets[i + 1]]
+#
+# Numbers are in the byte order named in the schema. Timestamps are stored
+# as milliseconds since the epoch. schema.json is written last, so a dump
+# without one didn't finish.
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+from decimal import Decimal
+from cql.cqltypes import lookup_casstype
+from .copyutil import serializer_for_type
+
+try:
+    import json
+except ImportError:
+    # python 2.5
+    json = None
+
+SCHEMA_FILE = 'schema.json'
+FORMAT_VERSION = 1
+
+def typecode_for(fmt):
+    """
+    The array module typecode holding values of the given struct format's
+    standard size, or None if there isn't one on this platform.
+    """
+
+    size = struct.calcsize('<' + fmt)
+    for code in {'b': 'b', 'i': 'il', 'q': 'lq', 'I': 'IL', 'Q': 'LQ', 'f': 'f', 'd': 'd'}[fmt]:
+        try:
+            if array(code).itemsize == size:
+                return code
+        except ValueError:
+            # no such typecode here
+            pass
+    return None
+
+# struct formats for the cql types which are stored fixed-width
+fixed_width_formats = {
+    'int': 'i',
+    'bigint': 'q',
+    'counter': 'q',
+    'timestamp': 'q',
+    'float': 'f',
+    'double': 'd',
+    'boolean': 'b',
+}
+
+def column_storage(cqltype):
+    """
+    How values of the given cql type are stored: the struct format for
+    fixed-width ones (None for the rest), and the encoding of variable-width
+    ones.
+    """
+
+    typename = cqltype.typename
+    fmt = fixed_width_formats.get(typename)
+    if fmt is not None and typecode_for(fmt) is not None:
+        return fmt, None
+    if typename in ('text', 'varchar'):
+        return None, 'utf8'
+    if typename in ('ascii', 'blob'):
+        return None, 'bytes'
+    if typename in ('decimal', 'varint'):
+        return None, 'digits'
+    return None, 'serialized'
+
+offset_format = typecode_for('q') and 'q' or 'I'
+
+def file_name(dirname, colnum, kind):
+    return os.path.join(dirname, '%d.%s' % (colnum, kind))
+
+class ColumnWriter:
+    """
+    Appends values to the files of one column of a columnar dump.
+    """
+
+    def __init__(self, dirname, colnum, name, cqltype):
+        self.name = name
+        self.cqltype = cqltype
+        self.format, self.encoding = column_storage(cqltype)
+        self.validfile = open(file_name(dirname, colnum, 'valid'), 'wb')
+        self.valuesfile = open(file_name(dirname, colnum, 'values'), 'wb')
+        self.offsetsfile = None
+        if self.format is None:
+            self.offsetsfile = open(file_name(dirname, colnum, 'offsets'), 'wb')
+            self.offset = 0
+            array(typecode_for(offset_format), [0]).tofile(self.offsetsfile)
+        self.encode = self.make_encoder()
+
+    def make_encoder(self):
+        if self.cqltype.typename == 'timestamp' and self.format is not None:
+            return lambda val: int(round(val * 1000))
+        if self.encoding == 'utf8':
+            return lambda val: val.encode('utf8')
+        if self.encoding == 'digits':
+            return str
+        if self.encoding == 'serialized':
+            # not the type's own serialize, which gets some values wrong
+            # inside collections
+            return serializer_for_type(self.cqltype)
+        return lambda val: val
+
+    def write(self, values):
+        array('B', [val is not None and 1 or 0 for val in values]).tofile(self.validfile)
+        encode = self.encode
+        if self.format is not None:
+            array(typecode_for(self.format),
+                  [encode(val) if val is not None else 0 for val in values]).tofile(self.valuesfile)
+            return
+        data = [encode(val) if val is not None else '' for val in values]
+        offsets = array(typecode_for(offset_format))
+        for d in data:
+            self.offset += len(d)
+            offsets.append(self.offset)
+        offsets.tofile(self.offsetsfile)
+        self.valuesfile.write(''.join(data))
+
+    def describe(self):
+        return {
+            'name': self.name.decode('utf8'),
+            'type': self.cqltype.cql_parameterized_type(),
+            'cassandra_type': self.cqltype.cass_parameterized_type(full=True),
+            'format': self.format,
+            'encoding': self.encoding,
+        }
+
+    def close(self):
+        for f in (self.validfile, self.valuesfile, self.offsetsfile):
+            if f is not None:
+                f.close()
+
+class ColumnarWriter:
+    """
+    Writes rows of native values out as a columnar dump in dirname, which
+    is made if it isn't there. Only the first len(colnames) values of each
+    row are written. The keyspace, table and key column names just go into
+    the schema, for readers' information.
+    """
+
+    def __init__(self, dirname, colnames, coltypes, keyspace=None, table=None,
+                 partition_key=(), primary_key=()):
+        if json is None:
+            raise ImportError("Columnar dumps require the json module"
+                              " (Python 2.6 or later)")
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        elif os.path.exists(os.path.join(dirname, SCHEMA_FILE)):
+            # don't leave an earlier dump's schema describing this one
+            os.remove(os.path.join(dirname, SCHEMA_FILE))
+        self.dirname = dirname
+        self.keyspace = keyspace
+        self.table = table
+        self.partition_key = partition_key
+        self.primary_key = primary_key
+        self.rows = 0
+        self.columns = []
+        try:
+            for n, (name, cqltype) in enumerate(zip(colnames, coltypes)):
+                self.columns.append(ColumnWriter(dirname, n, name, cqltype))
+        except:
+            self.close()
+            raise
+
+    def writerows(self, rows):
+        for n, col in enumerate(self.columns):
+            col.write([row[n] for row in rows])
+        self.rows += len(rows)
+
+    def write_schema(self):
+        schema = {
+            'version': FORMAT_VERSION,
+            'keyspace': self.keyspace,
+            'table': self.table,
+            'rows': self.rows,
+            'byteorder': sys.byteorder,
+            'offset_format': offset_format,
+            'partition_key': list(self.partition_key),
+            'primary_key': list(self.primary_key),
+            'columns': [col.describe() for col in self.columns],
+        }
+        f = open(os.path.join(self.dirname, SCHEMA_FILE), 'w')
+        try:
+            json.dump(schema, f, indent=2)
+        finally:
+            f.close()
+
+    def close(self):
+        for col in self.columns:
+            col.close()
+
+    def finish(self):
+        self.close()
+        self.write_schema()
+
+def map_file(fname):
+    f = open(fname, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size == 0:
+            # can't map an empty file
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+class ColumnReader:
+    """
+    One column of a columnar dump, memory-mapped. Indexing gives the value
+    of a row as a native python value, or None for null; raw() and
+    values_buffer() give the stored bytes without copying them.
+    """
+
+    def __init__(self, dirname, colnum, desc, byteorder, offset_fmt, rows):
+        self.name = desc['name']
+        self.cqltype = lookup_casstype(desc['cassandra_type'])
+        self.format = desc['format']
+        self.encoding = desc['encoding']
+        self.rows = rows
+        order = byteorder == 'big' and '>' or '<'
+        self.valid = map_file(file_name(dirname, colnum, 'valid'))
+        self.values = map_file(file_name(dirname, colnum, 'values'))
+        self.offsets = None
+        if self.format is None:
+            self.offsets = map_file(file_name(dirname, colnum, 'offsets'))
+            self.offset_struct = struct.Struct(order + offset_fmt * 2)
+        else:
+            self.value_struct = struct.Struct(order + self.format)
+        self.decode = self.make_decoder()
+
+    def make_decoder(self):
+        if self.cqltype.typename == 'timestamp' and self.format is not None:
+            return lambda val: val / 1000.0
+        if self.cqltype.typename == 'boolean' and self.format is not None:
+            return bool
+        if self.encoding == 'utf8':
+            return lambda val: str(val).decode('utf8')
+        if self.encoding == 'digits':
+            if self.cqltype.typename == 'decimal':
+                return lambda val: Decimal(str(val))
+            return lambda val: long(str(val))
+        if self.encoding == 'serialized':
+            return lambda val: self.cqltype.deserialize(str(val))
+        if self.encoding == 'bytes':
+            return str
+        return lambda val: val
+
+    def __len__(self):
+        return self.rows
+
+    def is_null(self, rownum):
+        return self.valid[rownum] == '\x00'
+
+    def raw(self, rownum):
+        """
+        The stored bytes for a row, as a buffer over the mapped file.
+        """
+
+        if self.format is None:
+            start, end = self.offset_struct.unpack_from(
+                    self.offsets, rownum * (self.offset_struct.size / 2))
+        else:
+            start = rownum * self.value_struct.size
+            end = start + self.value_struct.size
+        return buffer(self.values, start, end - start)
+
+    def __getitem__(self, rownum):
+        if rownum < 0:
+            rownum += self.rows
+        if not 0 <= rownum < self.rows:
+            raise IndexError(rownum)
+        if self.is_null(rownum):
+            return None
+        if self.format is None:
+            return self.decode(self.raw(rownum))
+        val, = self.value_struct.unpack_from(self.values, rownum * self.value_struct.size)
+        return self.decode(val)
+
+    def __iter__(self):
+        for rownum in xrange(self.rows):
+            yield self[rownum]
+
+    def values_buffer(self):
+        """
+        All of the column's stored values, as a buffer over the mapped file,
+        for handing to something that understands the layout (numpy's
+        frombuffer, for one).
+        """
+
+        return buffer(self.values)
+
+    def close(self):
+        for m in (self.valid, self.values, self.offsets):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+class ColumnarTable:
+    """
+    Reads a columnar dump from dirname, mapping each column's files into
+    memory rather than reading them in.
+    """
+
+    def __init__(self, dirname):
+        if json is None:
+            raise ImportError("Columnar dumps require the json module"
+                              " (Python 2.6 or later)")
+        f = open(os.path.join(dirname, SCHEMA_FILE))
+        try:
+            schema = json.load(f)
+        finally:
+            f.close()
+        if schema.get('version') != FORMAT_VERSION:
+            raise ValueError('Unsupported columnar dump version %r in %s'
+                             % (schema.get('version'), dirname))
+        self.keyspace = schema['keyspace']
+        self.table = schema['table']
+        self.rows = schema['rows']
+        self.partition_key = schema['partition_key']
+        self.primary_key = schema['primary_key']
+        self.columns = []
+        try:
+            for n, desc in enumerate(schema['columns']):
+                self.columns.append(ColumnReader(dirname, n, desc, schema['byteorder'],
+                                                 schema['offset_format'], self.rows))
+        except:
+            self.close()
+            raise
+        self.colnames = [col.name for col in self.columns]
+
+    def column(self, name):
+        return self.columns[self.colnames.index(name)]
+
+    def __len__(self):
+        return self.rows
+
+    def row(self, rownum):
+        return tuple([col[rownum] for col in self.columns])
+
+    def __iter__(self):
+        for rownum in xrange(self.rows):
+            yield self.row(rownum)
+
+    def close(self):
+        for col in self.columns:
+            col.close()
@@ -0,0 +1,2675 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# support code for cqlsh's COPY command. anything here that runs in a
+# worker process has to be importable, so it can't live in bin/cqlsh.
+
+import os
+import re
+import csv
+import bz2
+import zlib
+import mmap
+import time
+import calendar
+import uuid
+import Queue
+import threading
+import heapq
+import random
+from collections import deque
+import struct
+import socket
+import binascii
+from bisect import bisect_left
+from cStringIO import StringIO
+from decimal import Decimal
+import cql
+from cql.apivalues import UUID
+from cql.query import cql_quote
+from cql.cqltypes import cql_time_formats
+from cql.marshal import int64_pack, int32_pack, uint16_pack, varint_pack
+from .formatting import make_plain_formatter
+
+try:
+    import json
+except ImportError:
+    # python 2.5
+    json = None
+
+try:
+    import multiprocessing
+except ImportError:
+    # python 2.5
+    multiprocessing = None
+
+CQL_ERRORS = (cql.Error,)
+try:
+    from thrift.Thrift import TException
+except ImportError:
+    pass
+else:
+    CQL_ERRORS += (TException,)
+
+# errors which mean a connection is no good any more, as opposed to the
+# request on it having failed
+CONNECTION_ERRORS = (socket.error,)
+try:
+    from thrift.transport.TTransport import TTransportException
+except ImportError:
+    pass
+else:
+    CONNECTION_ERRORS += (TTransportException,)
+
+try:
+    from hashlib import md5
+except ImportError:
+    # python 2.4
+    from md5 import md5
+
+def error_message(err):
+    # thrift exceptions straight from the server keep their message in .why
+    return getattr(err, 'why', None) or str(err)
+
+class ConnectionParams:
+    """
+    Everything needed to open a new connection equivalent to the one a cqlsh
+    session is using, without having to hand the connection itself across a
+    process boundary.
+    """
+
+    def __init__(self, host, port, user=None, password=None, cql_version=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.cql_version = cql_version
+
+    def connect(self):
+        return cql.connect(self.host, self.port, user=self.user,
+                           password=self.password, cql_version=self.cql_version)
+
+    def for_host(self, host):
+        return ConnectionParams(host, self.port, self.user, self.password,
+                                self.cql_version)
+
+# Mapping cql type base names ("int", "map", etc) to functions which read a
+# CSV field into the native python value that type's serializer expects.
+_parsers = {}
+
+def parser_for(*typnames):
+    def registrator(f):
+        for typname in typnames:
+            _parsers[typname] = f
+        return f
+    return registrator
+
+@parser_for('ascii', 'inet')
+def parse_bytes(val):
+    return val
+
+@parser_for('text', 'varchar')
+def parse_text(val):
+    return val.decode('utf8')
+
+@parser_for('blob')
+def parse_blob(val):
+    return binascii.unhexlify(val)
+
+@parser_for('int', 'bigint', 'varint', 'counter')
+def parse_integer(val):
+    return int(val)
+
+@parser_for('float', 'double')
+def parse_floating_point(val):
+    return float(val)
+
+@parser_for('decimal')
+def parse_decimal(val):
+    return Decimal(val)
+
+@parser_for('boolean')
+def parse_boolean(val):
+    lval = val.lower()
+    if lval == 'true':
+        return True
+    if lval == 'false':
+        return False
+    raise ValueError("expected 'true' or 'false'")
+
+@parser_for('uuid')
+def parse_uuid(val):
+    return UUID(val)
+
+integer_re = re.compile(r'^-?[0-9]+$')
+tz_offset_re = re.compile(r'[+-][0-9]{4}$')
+
+@parser_for('timestamp')
+def parse_timestamp(val):
+    """
+    Read a timestamp the way Cassandra does, into seconds since the epoch:
+    'now', milliseconds since the epoch, or a date and time in one of the
+    CQL formats, with or without a timezone offset like +0100.
+
+    One difference: a date without an offset is taken to be in cqlsh's
+    local time (daylight saving time and all), where Cassandra would go by
+    the server's.
+    """
+
+    if integer_re.match(val):
+        return int(val) / 1000.0
+    if val.lower() == 'now':
+        return time.time()
+    offset = None
+    if tz_offset_re.search(val):
+        offset = (int(val[-4:-2]) * 3600 + int(val[-2:]) * 60) * int(val[-5] + '1')
+        val = val[:-5]
+    for tformat in cql_time_formats:
+        try:
+            tval = time.strptime(val, tformat)
+        except ValueError:
+            continue
+        if offset is None:
+            # let mktime work out whether DST was in effect
+            return time.mktime(tval[:8] + (-1,))
+        return calendar.timegm(tval) - offset
+    raise ValueError("can't interpret %r as a date" % (val,))
+
+# 100ns intervals between the start of the gregorian calendar and the epoch
+UUID_EPOCH_OFFSET = 0x01b21dd213814000
+
+def time_uuid_for(timestamp):
+    """
+    A new version 1 UUID for the given time, in seconds since the epoch,
+    with a random clock sequence and node.
+    """
+
+    ts = int(round(timestamp * 10000000)) + UUID_EPOCH_OFFSET
+    clock_seq = random.getrandbits(14)
+    # the multicast bit marks the node as random, rather than a MAC address
+    node = random.getrandbits(48) | (1 << 40)
+    return UUID(fields=(ts & 0xffffffff, (ts >> 32) & 0xffff, (ts >> 48) & 0x0fff,
+                        (clock_seq >> 8) & 0x3f, clock_seq & 0xff, node), version=1)
+
+@parser_for('timeuuid')
+def parse_timeuuid(val):
+    """
+    Read a timeuuid as Cassandra does: a version 1 UUID, or else anything
+    parse_timestamp reads, which gets a new time UUID for that moment.
+    """
+
+    try:
+        u = UUID(val)
+    except ValueError:
+        if val.lower() == 'now':
+            return uuid.uuid1()
+        return time_uuid_for(parse_timestamp(val))
+    if u.version != 1:
+        raise ValueError('timeuuids have to be version 1 UUIDs')
+    return u
+
+def split_collection_literal(val, lbracket, rbracket, sep=','):
+    """
+    Split the text of a collection literal like "[1, 2]" or "{'a': 'b'}"
+    on the given separator, ignoring separators inside quoted items.
+
+    >>> split_collection_literal("['a', 'b,c']", '[', ']')
+    ["'a'", "'b,c'"]
+    """
+
+    val = val.strip()
+    if val[:1] != lbracket or val[-1:] != rbracket:
+        raise ValueError('expected collection literal in %s%s' % (lbracket, rbracket))
+    val = val[1:-1]
+    if not val.strip():
+        return []
+    items = []
+    start = 0
+    in_quotes = False
+    for n, c in enumerate(val):
+        if c == "'":
+            in_quotes = not in_quotes
+        elif c == sep and not in_quotes:
+            items.append(val[start:n].strip())
+            start = n + 1
+    items.append(val[start:].strip())
+    return items
+
+def dequote_collection_item(item):
+    if len(item) > 1 and item[0] == "'" and item[-1] == "'":
+        return item[1:-1].replace("''", "'")
+    return item
+
+def make_item_parser(cqltype):
+    parse = parser_for_type(cqltype)
+    return lambda item: parse(dequote_collection_item(item))
+
+def parser_for_type(cqltype):
+    """
+    Build a function which reads a CSV field into a native value for the
+    given cql type. Raises KeyError if the type isn't one we know how to
+    read.
+    """
+
+    typename = cqltype.typename
+    if typename in ('list', 'set'):
+        parse_item = make_item_parser(cqltype.subtypes[0])
+        lbracket, rbracket = ('[', ']') if typename == 'list' else ('{', '}')
+        return lambda val: [parse_item(item) for item in
+                            split_collection_literal(val, lbracket, rbracket)]
+    if typename == 'map':
+        parse_key = make_item_parser(cqltype.subtypes[0])
+        parse_value = make_item_parser(cqltype.subtypes[1])
+        def parse_map(val):
+            themap = {}
+            for item in split_collection_literal(val, '{', '}'):
+                pair = split_collection_literal('{%s}' % item, '{', '}', sep=':')
+                if len(pair) != 2:
+                    raise ValueError('expected key: value, not %r' % (item,))
+                themap[parse_key(pair[0])] = parse_value(pair[1])
+            return themap
+        return parse_map
+    return _parsers[typename]
+
+def serialize_varint(val):
+    # the driver's varint_pack gives no bytes at all for zero
+    if val == 0:
+        return '\x00'
+    return varint_pack(val)
+
+def serialize_decimal(dec):
+    sign, digits, exponent = dec.as_tuple()
+    unscaled = int(''.join(map(str, digits)))
+    if sign:
+        unscaled = -unscaled
+    return int32_pack(-exponent) + serialize_varint(unscaled)
+
+def serialize_timestamp(val):
+    # DateType.serialize would hand a float to struct.pack
+    return int64_pack(int(round(val * 1000)))
+
+# serializers to use in place of the driver's, for the types it gets wrong
+_serializers = {
+    'varint': serialize_varint,
+    'decimal': serialize_decimal,
+    'timestamp': serialize_timestamp,
+}
+
+def serialize_items(serialize, items):
+    parts = [uint16_pack(len(items))]
+    for item in items:
+        itembytes = serialize(item)
+        parts.append(uint16_pack(len(itembytes)))
+        parts.append(itembytes)
+    return ''.join(parts)
+
+def serializer_for_type(cqltype):
+    """
+    Build a function which serializes a native value of the given cql type
+    the way Cassandra expects. Mostly that's the type's own serialize, but
+    varints and decimals of zero, and timestamps, are done here, inside
+    collections as well as out.
+    """
+
+    typename = cqltype.typename
+    if typename in ('list', 'set'):
+        serialize_item = serializer_for_type(cqltype.subtypes[0])
+        return lambda val: serialize_items(serialize_item, val)
+    if typename == 'map':
+        serialize_key = serializer_for_type(cqltype.subtypes[0])
+        serialize_value = serializer_for_type(cqltype.subtypes[1])
+        def serialize_map(val):
+            parts = [uint16_pack(len(val))]
+            for k, v in val.items():
+                for itembytes in (serialize_key(k), serialize_value(v)):
+                    parts.append(uint16_pack(len(itembytes)))
+                    parts.append(itembytes)
+            return ''.join(parts)
+        return serialize_map
+    return _serializers.get(typename, cqltype.serialize)
+
+def converter_for_type(cqltype):
+    """
+    Build a function which reads a CSV field straight into the serialized
+    bytes Cassandra expects for the given cql type. Empty fields are sent
+    as empty values.
+    """
+
+    if cqltype.typename in ('ascii', 'text', 'varchar'):
+        # already the right bytes, assuming utf8 input
+        return str
+    parse = parser_for_type(cqltype)
+    serialize = serializer_for_type(cqltype)
+    def convert(val):
+        if val == '':
+            return ''
+        return serialize(parse(val))
+    return convert
+
+def can_convert(cqltype):
+    try:
+        parser_for_type(cqltype)
+    except KeyError:
+        return False
+    return True
+
+# Mapping cql type base names to functions which build a formatter writing
+# native values of that type out as CSV text the matching parser above reads
+# back to the same value, for COPY TO's raw format. Each takes the output
+# encoding.
+_raw_formatter_makers = {}
+
+def raw_formatter_maker_for(*typnames):
+    def registrator(f):
+        for typname in typnames:
+            _raw_formatter_makers[typname] = f
+        return f
+    return registrator
+
+@raw_formatter_maker_for('ascii', 'inet', 'int', 'bigint', 'varint', 'counter', 'decimal',
+                         'boolean', 'uuid', 'timeuuid')
+def make_raw_formatter_str(encoding):
+    return str
+
+@raw_formatter_maker_for('text', 'varchar')
+def make_raw_formatter_text(encoding):
+    return lambda val: val.encode(encoding)
+
+@raw_formatter_maker_for('blob')
+def make_raw_formatter_blob(encoding):
+    return binascii.hexlify
+
+@raw_formatter_maker_for('float', 'double')
+def make_raw_formatter_floating_point(encoding):
+    # repr gives enough digits to get the same double back
+    return repr
+
+@raw_formatter_maker_for('timestamp')
+def make_raw_formatter_timestamp(encoding):
+    return lambda val: str(int(round(val * 1000)))
+
+def quote_collection_item(item):
+    return "'%s'" % item.replace("'", "''")
+
+# item types whose text can't contain anything which would confuse
+# split_collection_literal, so they can go into collections unquoted
+unquoted_item_types = ('int', 'bigint', 'varint', 'counter', 'decimal', 'boolean',
+                       'float', 'double', 'uuid', 'timeuuid', 'timestamp')
+
+def make_raw_item_formatter(cqltype, encoding):
+    fmt = raw_formatter_for_type(cqltype, encoding)
+    if cqltype.typename in unquoted_item_types:
+        return fmt
+    return lambda item: quote_collection_item(fmt(item))
+
+def raw_formatter_for_type(cqltype, encoding):
+    """
+    Build a function which writes a native value of the given cql type out
+    as text that parser_for_type(cqltype) reads back exactly. Raises
+    KeyError if the type isn't one we know how to write.
+    """
+
+    typename = cqltype.typename
+    if typename in ('list', 'set'):
+        fmt_item = make_raw_item_formatter(cqltype.subtypes[0], encoding)
+        lbracket, rbracket = ('[', ']') if typename == 'list' else ('{', '}')
+        return lambda val: lbracket + ', '.join([fmt_item(item) for item in val]) + rbracket
+    if typename == 'map':
+        fmt_key = make_raw_item_formatter(cqltype.subtypes[0], encoding)
+        fmt_value = make_raw_item_formatter(cqltype.subtypes[1], encoding)
+        return lambda val: '{' + ', '.join([fmt_key(k) + ': ' + fmt_value(v)
+                                            for (k, v) in val.items()]) + '}'
+    return _raw_formatter_makers[typename](encoding)
+
+def check_field_count(row, colnames):
+    if len(row) != len(colnames):
+        raise ValueError('Wrong number of fields (%d instead of %d)'
+                         % (len(row), len(colnames)))
+
+def present_columns(row):
+    """
+    The positions of the fields in a row which aren't None (null), or None
+    if none of them are. Null fields are left out of the row's INSERT
+    altogether, so that they stay null.
+    """
+
+    if None not in row:
+        return None
+    return tuple([n for (n, val) in enumerate(row) if val is not None])
+
+class LiteralInsert:
+    """
+    Inserts each row as a whole CQL statement, with the values escaped as
+    CQL string literals and left for Cassandra to interpret. Works with any
+    CQL version and column type.
+    """
+
+    def __init__(self, query, colnames, quoted_colnames, escape_value):
+        # query has a %s where the column list goes, and another where the
+        # value list goes
+        self.insertq = query
+        self.colnames = colnames
+        self.quoted_colnames = quoted_colnames
+        self.escape_value = escape_value
+        self.query = query % (', '.join(quoted_colnames), '%s')
+
+    def convert_row(self, row):
+        check_field_count(row, self.colnames)
+        present = present_columns(row)
+        if present is None:
+            return self.query % ', '.join(map(self.escape_value, row))
+        return self.insertq % (', '.join([self.quoted_colnames[n] for n in present]),
+                               ', '.join([self.escape_value(row[n]) for n in present]))
+
+    row_size = len
+
+    def split_batch(self, batch):
+        return [batch]
+
+    def prepare(self, cursor):
+        """
+        Returns a function which gives the thrift call, and its arguments,
+        for inserting a list of converted rows, as a batch if there is more
+        than one. See InsertPipeline.
+        """
+
+        def request(statements, sync):
+            if len(statements) == 1:
+                query = statements[0]
+            else:
+                query = 'BEGIN BATCH\n%s;\nAPPLY BATCH' % ';\n'.join(statements)
+            return 'execute_cql_query', cursor.compress_query_text(query)
+        return request
+
+class PreparedInsert:
+    """
+    Inserts rows through a prepared INSERT. Each CSV field is turned into
+    its serialized form by a converter picked once, up front, from the type
+    of its column.
+
+    Every different combination of row count and null columns in a batch
+    needs a statement of its own, so only max_batch_shapes of those are
+    allowed; see split_batch().
+    """
+
+    max_batch_shapes = 32
+
+    def __init__(self, query, colnames, quoted_colnames, coltypes):
+        # query has a %s where the column list goes, and another where the
+        # list of bind markers goes
+        self.insertq = query
+        self.colnames = colnames
+        self.quoted_colnames = quoted_colnames
+        self.coltypes = coltypes
+        self.converters = map(converter_for_type, coltypes)
+        self.query = self.row_query(0)
+        self.batch_shapes = set()
+
+    def row_query(self, rownum, present=None):
+        if present is None:
+            present = range(len(self.colnames))
+        return self.insertq % (', '.join([self.quoted_colnames[n] for n in present]),
+                               ', '.join([':r%dc%d' % (rownum, n) for n in present]))
+
+    def batch_query(self, shapes):
+        """
+        An INSERT for rows giving the columns in shapes (each one as from
+        present_columns), as a batch if there's more than one.
+        """
+
+        if len(shapes) == 1:
+            return self.row_query(0, shapes[0])
+        return 'BEGIN BATCH %s; APPLY BATCH' % '; '.join([self.row_query(n, present)
+                                                          for (n, present) in enumerate(shapes)])
+
+    def convert_row(self, row):
+        check_field_count(row, self.colnames)
+        values = []
+        for name, convert, val in zip(self.colnames, self.converters, row):
+            if val is None:
+                values.append(None)
+                continue
+            try:
+                values.append(convert(val))
+            except Exception, e:
+                raise ValueError('Invalid value %r for column %s: %s' % (val, name, e))
+        return values
+
+    def row_size(self, values):
+        return sum([len(v) for v in values if v is not None])
+
+    def split_batch(self, batch):
+        """
+        Split a batch of (rownum, linenum, row, values) records into the
+        batches to send: the batch itself, unless it's of a new shape and
+        there have been max_batch_shapes already, in which case its records
+        go one by one. Those only need a statement for each set of null
+        columns.
+        """
+
+        if len(batch) == 1:
+            return [batch]
+        shapes = tuple([present_columns(rec[3]) for rec in batch])
+        if shapes not in self.batch_shapes:
+            if len(self.batch_shapes) >= self.max_batch_shapes:
+                return [[rec] for rec in batch]
+            self.batch_shapes.add(shapes)
+        return [batch]
+
+    def prepare(self, cursor):
+        """
+        Returns a function which gives the thrift call, and its arguments,
+        for inserting a list of converted rows, as a batch if there is more
+        than one. See InsertPipeline.
+
+        Batches are prepared on first use, once for each number of rows and
+        set of null columns in them (of which split_batch() only lets so
+        many through). Since preparing is a synchronous call,
+        sync() gets called first, to get any outstanding responses out of
+        the way.
+        """
+
+        prepared = {}
+        def request(rows, sync):
+            shapes = tuple(map(present_columns, rows))
+            try:
+                q = prepared[shapes]
+            except KeyError:
+                sync()
+                q = prepared[shapes] = cursor.prepare_query(self.batch_query(shapes))
+            values = [v for row in rows for v in row if v is not None]
+            return 'execute_prepared_cql_query', (q.itemid, values)
+        # fail early if the INSERT can't be prepared at all
+        prepared[(None,)] = cursor.prepare_query(self.query)
+        return request
+
+class RowBatcher:
+    """
+    Groups converted (rownum, linenum, row, values) records into batches of
+    at most batchsize records, and at most max_bytes of converted values
+    unless a single record is bigger than that.
+
+    Within each chunk of records, those for the same partition are put next
+    to each other, so that a batch touches as few partitions as it can.
+    Records keep their relative order otherwise, and a record never goes in
+    the same batch as an earlier one with the same primary key, since the
+    two would get the same timestamp.
+    """
+
+    def __init__(self, batchsize=1, max_bytes=65536, partkey_indexes=None,
+                 primkey_indexes=None):
+        self.batchsize = batchsize
+        self.max_bytes = max_bytes
+        self.partkey_indexes = partkey_indexes
+        self.primkey_indexes = primkey_indexes
+
+    def group_by_partition(self, records):
+        if not self.partkey_indexes:
+            return records
+        groups = {}
+        order = []
+        indexes = self.partkey_indexes
+        for rec in records:
+            row = rec[2]
+            key = tuple([row[i] for i in indexes])
+            try:
+                groups[key].append(rec)
+            except KeyError:
+                groups[key] = [rec]
+                order.append(key)
+        return [rec for key in order for rec in groups[key]]
+
+    def batches(self, records, row_size):
+        if self.batchsize == 1:
+            for rec in records:
+                yield [rec]
+            return
+        primkey_indexes = self.primkey_indexes
+        batch = []
+        batchbytes = 0
+        batchkeys = set()
+        for rec in self.group_by_partition(records):
+            recbytes = row_size(rec[3])
+            if primkey_indexes:
+                key = tuple([rec[2][i] for i in primkey_indexes])
+            else:
+                key = None
+            if batch and (len(batch) >= self.batchsize
+                          or batchbytes + recbytes > self.max_bytes
+                          or key in batchkeys):
+                yield batch
+                batch = []
+                batchbytes = 0
+                batchkeys = set()
+            batch.append(rec)
+            batchbytes += recbytes
+            if key is not None:
+                batchkeys.add(key)
+        if batch:
+            yield batch
+
+class InsertPipeline:
+    """
+    Sends insert requests down one connection without waiting for the
+    response to each before sending the next, keeping up to maxinflight of
+    them outstanding. Cassandra handles the requests on a connection one
+    at a time, in order, so responses are matched up with requests first
+    in, first out.
+
+    request is a function like the ones returned by the inserters' prepare
+    methods. send() and drain() return lists of (tag, error) completions,
+    error being None for a successful insert.
+
+    If the connection fails, everything in flight and everything sent
+    afterward goes through the fallback pipeline, when there is one.
+    Otherwise the lost requests complete with the connection error.
+    """
+
+    def __init__(self, conn, request, maxinflight, fallback=None, on_failure=None):
+        self.client = conn.client
+        self.cursor = conn.cursor()
+        self.request = request
+        self.maxinflight = maxinflight
+        self.fallback = fallback
+        self.on_failure = on_failure
+        self.broken = False
+        self.inflight = deque()
+
+    def pending(self):
+        if self.broken:
+            return self.fallback.pending()
+        return len(self.inflight)
+
+    def send(self, rows, tag):
+        if self.broken:
+            return self.fallback.send(rows, tag)
+        done = []
+        def sync():
+            while self.inflight and not self.broken:
+                done.extend(self.recv())
+        while len(self.inflight) >= self.maxinflight and not self.broken:
+            done.extend(self.recv())
+        if self.broken:
+            return done + self.fallback.send(rows, tag)
+        try:
+            call, args = self.request(rows, sync)
+        except CONNECTION_ERRORS, e:
+            done.extend(self.connection_failed(e))
+            if not self.broken:
+                return done + [(tag, e)]
+        except CQL_ERRORS, e:
+            # couldn't even prepare it
+            return done + [(tag, e)]
+        if self.broken:
+            return done + self.fallback.send(rows, tag)
+        self.inflight.append((call, rows, tag))
+        try:
+            getattr(self.client, 'send_' + call)(*args)
+        except CONNECTION_ERRORS, e:
+            done.extend(self.connection_failed(e))
+        return done
+
+    def recv(self):
+        call, rows, tag = self.inflight[0]
+        try:
+            self.cursor.handle_cql_execution_errors(getattr(self.client, 'recv_' + call))
+        except CONNECTION_ERRORS, e:
+            return self.connection_failed(e)
+        except CQL_ERRORS, e:
+            self.inflight.popleft()
+            return [(tag, e)]
+        self.inflight.popleft()
+        return [(tag, None)]
+
+    def drain(self):
+        done = []
+        while self.inflight and not self.broken:
+            done.extend(self.recv())
+        if self.broken:
+            done.extend(self.fallback.drain())
+        return done
+
+    def connection_failed(self, err):
+        lost = list(self.inflight)
+        self.inflight.clear()
+        if self.fallback is None:
+            return [(tag, err) for (call, rows, tag) in lost]
+        self.broken = True
+        if self.on_failure is not None:
+            self.on_failure()
+        done = []
+        for call, rows, tag in lost:
+            done.extend(self.fallback.send(rows, tag))
+        return done
+
+MASK64 = 0xffffffffffffffff
+
+def rotl64(x, r):
+    return ((x << r) | (x >> (64 - r))) & MASK64
+
+def fmix64(k):
+    k ^= k >> 33
+    k = (k * 0xff51afd7ed558ccd) & MASK64
+    k ^= k >> 33
+    k = (k * 0xc4ceb9fe1a85ec53) & MASK64
+    k ^= k >> 33
+    return k
+
+def murmur3_token(key):
+    """
+    The Murmur3Partitioner token for a serialized partition key: the first
+    half of its 128-bit x64 MurmurHash3, as a signed 64-bit integer.
+
+    This has to match Cassandra's MurmurHash.hash3_x64_128 exactly, which
+    sign-extends the bytes of the tail block where the reference
+    implementation doesn't, so it gives different hashes for keys whose
+    tail has bytes over 0x7f. Also, the partitioner never hands out the
+    minimum long as a token, so that becomes the maximum.
+    """
+
+    length = len(key)
+    nblocks = length // 16
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    h1 = h2 = 0
+    if nblocks:
+        blocks = struct.unpack('<%dQ' % (nblocks * 2), key[:nblocks * 16])
+        for i in xrange(0, nblocks * 2, 2):
+            k1 = rotl64((blocks[i] * c1) & MASK64, 31) * c2 & MASK64
+            h1 ^= k1
+            h1 = (rotl64(h1, 27) + h2) & MASK64
+            h1 = (h1 * 5 + 0x52dce729) & MASK64
+            k2 = rotl64((blocks[i + 1] * c2) & MASK64, 33) * c1 & MASK64
+            h2 ^= k2
+            h2 = (rotl64(h2, 31) + h1) & MASK64
+            h2 = (h2 * 5 + 0x38495ab5) & MASK64
+    # signed bytes, to get the sign extension
+    tail = struct.unpack('%db' % (length - nblocks * 16), key[nblocks * 16:])
+    if len(tail) > 8:
+        k2 = 0
+        for i in range(len(tail) - 1, 7, -1):
+            k2 ^= (tail[i] << ((i - 8) * 8)) & MASK64
+        h2 ^= rotl64((k2 * c2) & MASK64, 33) * c1 & MASK64
+    if tail:
+        k1 = 0
+        for i in range(min(len(tail), 8) - 1, -1, -1):
+            k1 ^= (tail[i] << (i * 8)) & MASK64
+        h1 ^= rotl64((k1 * c1) & MASK64, 31) * c2 & MASK64
+    h1 ^= length
+    h2 ^= length
+    h1 = (h1 + h2) & MASK64
+    h2 = (h2 + h1) & MASK64
+    h1 = (fmix64(h1) + fmix64(h2)) & MASK64
+    if h1 >= 1 << 63:
+        h1 -= 1 << 64
+    if h1 == -(1 << 63):
+        return (1 << 63) - 1
+    return h1
+
+def md5_token(key):
+    """
+    The RandomPartitioner token for a serialized partition key: the absolute
+    value of its MD5 digest, read as a signed big-endian 128-bit integer
+    (which is what Java's BigInteger does with it).
+    """
+
+    token = long(binascii.hexlify(md5(key).digest()), 16)
+    if token >= 1 << 127:
+        token -= 1 << 128
+    return abs(token)
+
+partitioner_token_functions = {
+    'org.apache.cassandra.dht.Murmur3Partitioner': murmur3_token,
+    'org.apache.cassandra.dht.RandomPartitioner': md5_token,
+}
+
+def routing_key(values, partkey_indexes):
+    """
+    The serialized partition key of a row of serialized values, as it gets
+    hashed by the partitioner. A key with more than one component is
+    encoded like a CompositeType value.
+    """
+
+    # a null key component won't get inserted anyway; Cassandra will say so
+    if len(partkey_indexes) == 1:
+        return values[partkey_indexes[0]] or ''
+    return ''.join([struct.pack('>H', len(values[i] or '')) + (values[i] or '') + '\x00'
+                    for i in partkey_indexes])
+
+def ring_endpoints(tokenrange):
+    # the rpc address is the one clients should talk to, unless it's unset
+    endpoints = tokenrange.rpc_endpoints
+    if not endpoints or '0.0.0.0' in endpoints:
+        endpoints = tokenrange.endpoints
+    return endpoints
+
+class TokenMap:
+    """
+    Which nodes hold replicas of which ranges of the token ring, as given
+    by describe_ring for a keyspace.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        ranges = sorted([(long(r.end_token), ring_endpoints(r)) for r in ring])
+        self.end_tokens = [end for (end, endpoints) in ranges]
+        self.replicas = [endpoints for (end, endpoints) in ranges]
+
+    def replicas_for(self, token):
+        # each range runs from just after its start token up to and
+        # including its end token, and the last one wraps around
+        if not self.replicas:
+            return ()
+        n = bisect_left(self.end_tokens, token)
+        if n == len(self.end_tokens):
+            n = 0
+        return self.replicas[n]
+
+    def same_ring(self, ring):
+        def describe(ring):
+            return sorted([(r.start_token, r.end_token, sorted(r.endpoints)) for r in ring])
+        return describe(self.ring) == describe(ring)
+
+class TokenAwareRouting:
+    """
+    Settings for sending inserts straight to a replica of their partition,
+    instead of having the coordinator we happen to be connected to forward
+    them. Small and picklable, so it can be handed to worker processes,
+    each of which makes its own TokenAwareRouter from it.
+    """
+
+    def __init__(self, connparams, keyspace, partitioner, partkey_indexes):
+        self.connparams = connparams
+        self.keyspace = keyspace
+        self.partitioner = partitioner
+        self.partkey_indexes = partkey_indexes
+
+    @staticmethod
+    def supports_partitioner(partitioner):
+        return partitioner in partitioner_token_functions
+
+    def make_router(self, inserter, pipeline, conn):
+        try:
+            return TokenAwareRouter(self, inserter, pipeline, conn.client)
+        except CQL_ERRORS:
+            # can't see the ring; everything goes through the coordinator
+            return SingleRoute(pipeline)
+
+class SingleRoute:
+    """
+    Sends everything through one connection.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def route(self, records):
+        return [(self.pipeline, records)]
+
+    def close(self):
+        pass
+
+class TokenAwareRouter:
+    """
+    Groups converted records by a replica of their partition, and opens and
+    prepares a pipelined connection to each replica as it's first needed,
+    falling back to the original connection's pipeline. The ring is
+    looked up again every refresh_interval seconds, and the replica map is
+    rebuilt if it changed.
+
+    Anything for a node we can't get through to goes through the original
+    connection instead, and that node is left alone until the ring is next
+    refreshed.
+    """
+
+    refresh_interval = 30
+
+    def __init__(self, routing, inserter, pipeline, client):
+        self.routing = routing
+        self.inserter = inserter
+        self.default_pipeline = pipeline
+        self.client = client
+        self.token_for = partitioner_token_functions[routing.partitioner]
+        self.pipelines = {}
+        self.conns = {}
+        self.down = set()
+        # each router (so, each worker process) favors different replicas
+        self.replica_choice = random.randrange(1 << 16)
+        self.tokenmap = TokenMap(self.describe_ring())
+        self.last_refresh = time.time()
+
+    def describe_ring(self):
+        return self.client.describe_ring(self.routing.keyspace)
+
+    def maybe_refresh(self):
+        if time.time() - self.last_refresh < self.refresh_interval:
+            return
+        self.last_refresh = time.time()
+        try:
+            ring = self.describe_ring()
+        except CQL_ERRORS:
+            # keep using what we have
+            return
+        self.down.clear()
+        if not self.tokenmap.same_ring(ring):
+            self.tokenmap = TokenMap(ring)
+            # keep the connections; most will still be to replicas
+
+    def host_for(self, values):
+        token = self.token_for(routing_key(values, self.routing.partkey_indexes))
+        replicas = [host for host in self.tokenmap.replicas_for(token)
+                    if host not in self.down]
+        if not replicas:
+            return None
+        # spread the load between replicas, but keep sending a given range
+        # to the same one so batches for it stay together
+        return replicas[self.replica_choice % len(replicas)]
+
+    def pipeline_for(self, host):
+        if host is None or host in self.down:
+            return self.default_pipeline
+        try:
+            return self.pipelines[host]
+        except KeyError:
+            pass
+        try:
+            conn = self.routing.connparams.for_host(host).connect()
+        except CQL_ERRORS + CONNECTION_ERRORS:
+            self.host_failed(host)
+            return self.default_pipeline
+        try:
+            request = self.inserter.prepare(conn.cursor())
+        except CQL_ERRORS + CONNECTION_ERRORS:
+            conn.close()
+            self.host_failed(host)
+            return self.default_pipeline
+        pipeline = InsertPipeline(conn, request, self.default_pipeline.maxinflight,
+                                  fallback=self.default_pipeline,
+                                  on_failure=lambda: self.host_failed(host))
+        self.conns[host] = conn
+        self.pipelines[host] = pipeline
+        return pipeline
+
+    def host_failed(self, host):
+        self.down.add(host)
+        self.pipelines.pop(host, None)
+        conn = self.conns.pop(host, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except CQL_ERRORS + CONNECTION_ERRORS:
+                pass
+        # look again soon; maybe the ring changed
+        self.last_refresh = 0
+
+    def route(self, records):
+        self.maybe_refresh()
+        groups = {}
+        order = []
+        for rec in records:
+            host = self.host_for(rec[3])
+            try:
+                groups[host].append(rec)
+            except KeyError:
+                groups[host] = [rec]
+                order.append(host)
+        return [(self.pipeline_for(host), groups[host]) for host in order]
+
+    def close(self):
+        for conn in self.conns.values():
+            try:
+                conn.close()
+            except CQL_ERRORS + CONNECTION_ERRORS:
+                pass
+        self.conns = {}
+        self.pipelines = {}
+
+def make_router(routing, inserter, pipeline, conn):
+    if routing is None:
+        return SingleRoute(pipeline)
+    return routing.make_router(inserter, pipeline, conn)
+
+class ErrorPolicy:
+    """
+    How an import deals with failures. Batches which fail in a way that
+    might not happen again (a timeout, unavailable replicas, a schema
+    disagreement) are tried again, up to num_retries tries in all, after an
+    exponentially growing delay with some jitter. Other failures reject the
+    records involved, and up to maxerrors of those are tolerated.
+    """
+
+    base_backoff = 1.0
+    max_backoff = 30.0
+
+    def __init__(self, num_retries, maxerrors=0):
+        self.num_retries = num_retries
+        self.maxerrors = maxerrors
+
+    def should_retry(self, err, trynum):
+        return trynum < self.num_retries \
+               and isinstance(err, (cql.IntegrityError, cql.OperationalError))
+
+    def retry_delay(self, trynum):
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (trynum - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def too_many(self, errors):
+        return len(errors) > self.maxerrors
+
+class ChunkProgress:
+    """
+    What's become of the records of one chunk, while its batches are in
+    flight.
+    """
+
+    def __init__(self, nrecords, conversion_errors):
+        self.nrecords = nrecords
+        self.conversion_errors = conversion_errors
+        self.imported = 0
+        self.errors = []
+        # batches sent or waiting to be retried, and not yet completed
+        self.outstanding = 0
+        self.all_sent = False
+
+    def all_errors(self):
+        return self.errors + self.conversion_errors
+
+class InsertTracker:
+    """
+    Sends batches of converted records through InsertPipelines, and keeps
+    count of the ones that make it and the errors for the ones that don't
+    as their completions come back, in whatever order that is.
+
+    One tracker lasts for a whole import, so that the pipelines stay full
+    from one chunk of records to the next, and are only drained at the end
+    (finish()). Progress is kept for each chunk, and a chunk is finished
+    once all of its batches have been sent and have completed; see
+    pop_finished().
+
+    Batches to be retried wait their turn in a queue instead of holding up
+    everything else. When errors are tolerated, a batch which fails for
+    good is split up and its records sent one by one, so that only the bad
+    ones get rejected.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.pipelines = []
+        self.retries = []
+        self.retry_seq = 0
+        self.chunks = {}
+        self.finished = []
+
+    def start_chunk(self, chunkid, nrecords, conversion_errors):
+        self.chunks[chunkid] = ChunkProgress(nrecords, conversion_errors)
+
+    def chunk_errors(self, chunkid):
+        return self.chunks[chunkid].all_errors()
+
+    def chunk_sent(self, chunkid):
+        """
+        Note that every batch of the chunk has been sent.
+        """
+
+        self.chunks[chunkid].all_sent = True
+        self.check_finished(chunkid)
+
+    def check_finished(self, chunkid):
+        chunk = self.chunks[chunkid]
+        if chunk.all_sent and chunk.outstanding == 0:
+            del self.chunks[chunkid]
+            self.finished.append((chunkid, chunk.imported, chunk.all_errors(), chunk.nrecords))
+
+    def pop_finished(self):
+        """
+        Return (chunkid, imported, errors, nrecords) for each chunk which
+        has finished since the last call. errors is a list of (rownum,
+        linenum, message, rows) tuples, giving the first record involved
+        and the original rows of all of them.
+        """
+
+        finished = self.finished
+        self.finished = []
+        return finished
+
+    def send(self, pipeline, batch, chunkid, trynum=1):
+        self.send_due_retries()
+        if pipeline not in self.pipelines:
+            self.pipelines.append(pipeline)
+        self.chunks[chunkid].outstanding += 1
+        self.completed(pipeline.send([rec[3] for rec in batch],
+                                     (pipeline, batch, chunkid, trynum)))
+
+    def send_due_retries(self):
+        now = time.time()
+        while self.retries and self.retries[0][0] <= now:
+            due, seq, pipeline, batch, chunkid, trynum = heapq.heappop(self.retries)
+            self.chunks[chunkid].outstanding -= 1
+            self.send(pipeline, batch, chunkid, trynum)
+
+    def completed(self, completions):
+        for (pipeline, batch, chunkid, trynum), err in completions:
+            chunk = self.chunks[chunkid]
+            if err is None:
+                chunk.imported += len(batch)
+            elif self.policy.should_retry(err, trynum):
+                due = time.time() + self.policy.retry_delay(trynum)
+                self.retry_seq += 1
+                heapq.heappush(self.retries,
+                               (due, self.retry_seq, pipeline, batch, chunkid, trynum + 1))
+                chunk.outstanding += 1
+            elif len(batch) > 1 and self.policy.maxerrors > 0:
+                for rec in batch:
+                    self.send(pipeline, [rec], chunkid)
+            else:
+                msg = error_message(err)
+                if len(batch) > 1:
+                    msg += ' (in a batch of %d records)' % len(batch)
+                chunk.errors.append((batch[0][0], batch[0][1], msg,
+                                     [rec[2] for rec in batch]))
+            chunk.outstanding -= 1
+            self.check_finished(chunkid)
+
+    def finish(self):
+        """
+        Wait for everything in flight, and for all retries. Returns the
+        chunks finished since the last pop_finished(), as it does.
+        """
+
+        # retries can put more in flight while draining
+        while True:
+            self.send_due_retries()
+            busy = [p for p in self.pipelines if p.pending()]
+            for pipeline in busy:
+                self.completed(pipeline.drain())
+            if busy:
+                continue
+            if not self.retries:
+                break
+            time.sleep(max(0, self.retries[0][0] - time.time()))
+        return self.pop_finished()
+
+def import_records(inserter, router, batcher, policy, tracker, chunkid, records):
+    """
+    Convert and insert a chunk of (rownum, linenum, row) records through the
+    given InsertTracker, split up by connection according to the given
+    router, then batched according to the given RowBatcher. Once more
+    records than the ErrorPolicy allows have failed, stops converting
+    records and sending batches, but those already in flight carry on.
+
+    Doesn't wait for the inserts; the chunk's results come out of the
+    tracker's pop_finished() or finish() once they're all back.
+    """
+
+    converted = []
+    errors = []
+    for rownum, linenum, row in records:
+        try:
+            converted.append((rownum, linenum, row, inserter.convert_row(row)))
+        except ValueError, e:
+            errors.append((rownum, linenum, str(e), [row]))
+            if policy.too_many(errors):
+                break
+    tracker.start_chunk(chunkid, len(records), errors)
+    for pipeline, routed in router.route(converted):
+        for batch in batcher.batches(routed, inserter.row_size):
+            for piece in inserter.split_batch(batch):
+                if policy.too_many(tracker.chunk_errors(chunkid)):
+                    break
+                tracker.send(pipeline, piece, chunkid)
+    tracker.chunk_sent(chunkid)
+
+def read_task(task):
+    """
+    The records for an import task, which is either a list of them or a
+    FileRange to read them from.
+    """
+
+    if isinstance(task, FileRange):
+        return task.read()
+    return task
+
+def import_worker(connparams, inserter, batcher, policy, maxinflight, routing,
+                  tasks, results):
+    try:
+        try:
+            conn = connparams.connect()
+        except CQL_ERRORS, e:
+            results.put((None, 0, [(None, None, 'Could not connect: %s' % (e,), [])], 0))
+            return
+        try:
+            try:
+                pipeline = InsertPipeline(conn, inserter.prepare(conn.cursor()), maxinflight)
+                router = make_router(routing, inserter, pipeline, conn)
+            except CQL_ERRORS, e:
+                results.put((None, 0, [(None, None, error_message(e), [])], 0))
+                return
+            tracker = InsertTracker(policy)
+            try:
+                for chunkid, task in iter(tasks.get, None):
+                    try:
+                        records = read_task(task)
+                    except (csv.Error, EnvironmentError), e:
+                        # can't tell which records we missed; give up, once
+                        # the earlier chunks are accounted for
+                        map(results.put, tracker.finish())
+                        results.put((None, 0, [(None, None, str(e), [])], 0))
+                        return
+                    import_records(inserter, router, batcher, policy, tracker,
+                                   chunkid, records)
+                    map(results.put, tracker.pop_finished())
+                map(results.put, tracker.finish())
+            finally:
+                router.close()
+        finally:
+            conn.close()
+    except KeyboardInterrupt:
+        # the parent process gets the interrupt too, and cleans up after us
+        pass
+
+class CountingLineSource:
+    """
+    Iterates over the lines of a file, like the file itself would, keeping
+    track of the offset just past the last line handed out. file.tell()
+    can't be used for that while iterating, because of read-ahead.
+    """
+
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.f.next()
+        self.offset += len(line)
+        return line
+
+COMPRESSION_SUFFIXES = (('.gz', 'gzip'), ('.bz2', 'bz2'))
+
+def compression_for(fname, compression=None):
+    """
+    The codec to use for a COPY file: the one asked for, if any, or else
+    the one its name suggests. None means no compression. Raises ValueError
+    for codecs we don't know.
+    """
+
+    if compression is not None:
+        compression = compression.lower()
+        if compression == 'none':
+            return None
+        if compression not in ('gzip', 'bz2'):
+            raise ValueError('Unknown compression %r (expected gzip, bz2 or none)'
+                             % (compression,))
+        return compression
+    if fname is not None:
+        for suffix, codec in COMPRESSION_SUFFIXES:
+            if fname.lower().endswith(suffix):
+                return codec
+    return None
+
+def range_file_name(fname, rangeid):
+    """
+    Name for the file of one token range of an export to fname, with the
+    range number going before any compression suffix.
+    """
+
+    for suffix, codec in COMPRESSION_SUFFIXES:
+        if fname.endswith(suffix):
+            return '%s.%d%s' % (fname[:-len(suffix)], rangeid, suffix)
+    return '%s.%d' % (fname, rangeid)
+
+def make_decompressor(codec):
+    if codec == 'gzip':
+        # the extra 16 means to expect a gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+def make_compressor(codec):
+    if codec == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return bz2.BZ2Compressor()
+
+class DecompressingLineSource:
+    """
+    Iterates over the lines of a gzip or bz2 compressed file, keeping track
+    of the offset in the decompressed data like a CountingLineSource. The
+    file is read and decompressed on a separate thread, which runs alongside
+    everything else since zlib and bz2 let go of the GIL while they work.
+    The first skip bytes of decompressed data are passed over.
+    """
+
+    blocksize = 256 * 1024
+
+    def __init__(self, f, codec, skip=0):
+        self.f = f
+        self.codec = codec
+        self.skip = skip
+        self.offset = skip
+        self.blocks = Queue.Queue(16)
+        self.lines = iter(())
+        self.done = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self.decompress_all)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def decompressed(self):
+        decomp = make_decompressor(self.codec)
+        while not self.stopping:
+            block = self.f.read(self.blocksize)
+            if not block:
+                break
+            while block:
+                try:
+                    data = decomp.decompress(block)
+                except EOFError:
+                    # a bz2 stream ended right at the end of the last block
+                    decomp = make_decompressor(self.codec)
+                    continue
+                yield data
+                block = decomp.unused_data
+                if block:
+                    # another stream concatenated onto the first
+                    decomp = make_decompressor(self.codec)
+
+    def decompress_all(self):
+        try:
+            pending = ''
+            skip = self.skip
+            for data in self.decompressed():
+                if skip:
+                    if len(data) <= skip:
+                        skip -= len(data)
+                        continue
+                    data = data[skip:]
+                    skip = 0
+                data = pending + data
+                cut = data.rfind('\n') + 1
+                pending = data[cut:]
+                if cut:
+                    self.blocks.put(StringIO(data[:cut]).readlines())
+            if pending:
+                self.blocks.put([pending])
+        except Exception, e:
+            self.blocks.put(e)
+        else:
+            self.blocks.put(None)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            line = self.lines.next()
+        except StopIteration:
+            if self.done:
+                raise
+            lines = self.blocks.get()
+            if lines is None or isinstance(lines, Exception):
+                self.done = True
+                if lines is None:
+                    raise StopIteration
+                raise lines
+            self.lines = iter(lines)
+            line = self.lines.next()
+        self.offset += len(line)
+        return line
+
+    def close(self):
+        self.stopping = True
+        while self.thread.isAlive():
+            try:
+                self.blocks.get(True, 0.1)
+            except Queue.Empty:
+                pass
+
+class CompressingWriter:
+    """
+    A file-like object for a csv writer to write to, which compresses what
+    it's given on a separate thread and writes it to the underlying file.
+    Writes are gathered up into blocks of about blocksize bytes first.
+    close() has to be called to finish the compressed stream, but it
+    doesn't close the underlying file.
+    """
+
+    blocksize = 256 * 1024
+
+    def __init__(self, f, codec):
+        self.f = f
+        self.codec = codec
+        self.buf = []
+        self.buflen = 0
+        self.blocks = Queue.Queue(16)
+        self.error = None
+        self.thread = threading.Thread(target=self.compress_all)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def compress_all(self):
+        comp = make_compressor(self.codec)
+        try:
+            for block in iter(self.blocks.get, None):
+                self.f.write(comp.compress(block))
+            self.f.write(comp.flush())
+        except Exception, e:
+            self.error = e
+            # keep taking blocks, so writers don't get stuck
+            for block in iter(self.blocks.get, None):
+                pass
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.blocksize:
+            self.flush_block()
+
+    def flush_block(self):
+        if self.error is not None:
+            raise self.error
+        if self.buf:
+            self.blocks.put(''.join(self.buf))
+            self.buf = []
+            self.buflen = 0
+
+    def close(self):
+        try:
+            self.flush_block()
+        finally:
+            self.blocks.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+def read_csv_chunks(reader, chunksize, firstline=0, linesource=None):
+    """
+    Read records from a csv reader in chunks of up to chunksize. Yields
+    (records, nextline, offset) for each chunk, where records is a list of
+    (rownum, linenum, row), with rownums counting from 0 in each chunk.
+    nextline is the number of lines read so far, counting the firstline
+    skipped ones, and offset is the offset of the CountingLineSource the
+    reader is reading, if given.
+    """
+
+    chunk = []
+    for row in reader:
+        chunk.append((len(chunk), firstline + reader.line_num, row))
+        if len(chunk) >= chunksize:
+            yield chunk, firstline + reader.line_num, linesource and linesource.offset
+            chunk = []
+    if chunk:
+        yield chunk, firstline + reader.line_num, linesource and linesource.offset
+
+class CSVSplitter:
+    """
+    Finds record boundaries in a memory-mapped CSV file without parsing
+    it: a newline ends a record if there have been an even number of
+    quote characters (not counting escaped ones) since the last record
+    boundary, and it isn't escaped itself. The scanning is all done by
+    string methods and regexes, a piece at a time.
+
+    Some versions of the csv module carry a record on past a newline
+    escaped with the escapechar and some don't, so such a newline is never
+    taken as a boundary; a range can only come out bigger for it, and the
+    csv reader parses it as it would have anyway.
+
+    That goes wrong for quote characters in the middle of unquoted fields,
+    which the csv module takes literally.
+    """
+
+    def __init__(self, mm, dialect_options):
+        self.mm = mm
+        quotechar = dialect_options.get('quotechar', '"')
+        escapechar = dialect_options.get('escapechar')
+        self.escapechar = escapechar
+        if escapechar:
+            token_re = re.compile('%s.|%s' % (re.escape(escapechar), re.escape(quotechar)),
+                                  re.S)
+            self.count_quotes = lambda data: token_re.findall(data).count(quotechar)
+        else:
+            self.count_quotes = lambda data: data.count(quotechar)
+
+    def record_end(self, start, minsize=1):
+        """
+        Find the first record boundary at least minsize bytes past start,
+        which must be a record boundary itself. Returns the offset of that
+        and the number of lines in between.
+        """
+
+        mm = self.mm
+        size = len(mm)
+        end = start
+        inquotes = False
+        nlines = 0
+        while end < size:
+            nl = mm.find('\n', max(end, start + minsize - 1))
+            if nl == -1:
+                segend = size
+            else:
+                segend = nl + 1
+            data = mm[end:segend]
+            if self.count_quotes(data) % 2:
+                inquotes = not inquotes
+            nlines += data.count('\n')
+            end = segend
+            if not inquotes and not self.escaped_newline(data):
+                break
+        return end, nlines
+
+    def escaped_newline(self, data):
+        """
+        Whether data ends with an escaped newline: one right after an odd
+        number of escapechars.
+        """
+
+        escapechar = self.escapechar
+        if not escapechar or not data.endswith('\n'):
+            return False
+        body = data[:-1]
+        return (len(body) - len(body.rstrip(escapechar))) % 2 == 1
+
+    def ranges(self, start, rangesize):
+        """
+        Yield (start, end, nlines) for consecutive byte ranges from start to
+        the end of the file, each at least rangesize bytes (except the last)
+        and ending on a record boundary.
+        """
+
+        while start < len(self.mm):
+            end, nlines = self.record_end(start, rangesize)
+            yield start, end, nlines
+            start = end
+
+class FileRange:
+    """
+    A byte range of a CSV file, starting and ending on record boundaries,
+    for a worker process to read and parse itself.
+    """
+
+    def __init__(self, fname, start, end, firstline, dialect_options):
+        self.fname = fname
+        self.start = start
+        self.end = end
+        self.firstline = firstline
+        self.dialect_options = dialect_options
+
+    def read(self):
+        """
+        Returns the records in this range as a list of (rownum, linenum, row),
+        with rownums counting from 0.
+        """
+
+        f = open(self.fname, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = mm[self.start:self.end]
+            finally:
+                mm.close()
+        finally:
+            f.close()
+        # StringIO only splits lines on \n, like a file would
+        reader = csv.reader(StringIO(data), **self.dialect_options)
+        return [(rownum, self.firstline + reader.line_num, row)
+                for (rownum, row) in enumerate(reader)]
+
+def file_range_chunks(fname, splitter, start, rangesize, dialect_options, firstline=0):
+    """
+    Like read_csv_chunks, but yielding FileRanges in place of lists of
+    records.
+    """
+
+    for start, end, nlines in splitter.ranges(start, rangesize):
+        yield FileRange(fname, start, end, firstline, dialect_options), firstline + nlines, end
+        firstline += nlines
+
+class RecordNumbering:
+    """
+    Works out the real record numbers for errors in chunks whose records
+    are numbered from 0, which can only be done once the number of records
+    in every earlier chunk is known.
+    """
+
+    def __init__(self, firstrow=0):
+        self.nextrow = firstrow
+        self.next_chunkid = 0
+        self.counts = {}
+        self.pending = {}
+
+    def add(self, chunkid, nrecords, errors):
+        """
+        Take in the errors and record count for a chunk, and return any
+        errors which can now be numbered properly.
+        """
+
+        self.counts[chunkid] = nrecords
+        self.pending[chunkid] = errors
+        numbered = []
+        while self.next_chunkid in self.counts:
+            base = self.nextrow
+            for rownum, linenum, msg, rows in self.pending.pop(self.next_chunkid):
+                if rownum is not None:
+                    rownum += base
+                numbered.append((rownum, linenum, msg, rows))
+            self.nextrow += self.counts.pop(self.next_chunkid)
+            self.next_chunkid += 1
+        return numbered
+
+    def flush(self):
+        """
+        Return errors still waiting on earlier chunks, without record
+        numbers.
+        """
+
+        leftover = []
+        for chunkid in sorted(self.pending.keys()):
+            for rownum, linenum, msg, rows in self.pending.pop(chunkid):
+                leftover.append((None, linenum, msg, rows))
+        return leftover
+
+class ImportCheckpoint:
+    """
+    Keeps track of how far through its input file an import has gotten, and
+    saves that in a checkpoint file every interval seconds: the byte offset,
+    record number and line number just past the last chunk which was fully
+    imported, such that every chunk before it was too. Chunks can finish out
+    of order, so that might lag a bit behind the latest one to finish.
+
+    The input file's stamp (see file_stamp()) is saved along with that, so
+    that a resumed import can tell whether the file has changed since.
+
+    If the checkpoint can't be written, on_failure is called with the error
+    and checkpointing stops for the rest of the import, which carries on
+    without it.
+    """
+
+    def __init__(self, path, firstrow=0, interval=10, stamp=(0, 0), on_failure=None):
+        self.path = path
+        self.interval = interval
+        self.stamp = stamp
+        self.on_failure = on_failure
+        self.disabled = False
+        self.chunk_ends = {}
+        self.finished = {}
+        self.next_chunkid = 0
+        self.nextrow = firstrow
+        self.position = None
+        self.saved_position = None
+        self.last_save = time.time()
+
+    @staticmethod
+    def load(path):
+        """
+        Read the ((offset, rownum, linenum), stamp) saved in a checkpoint
+        file, or None if there isn't one. Raises ValueError if it's
+        unreadable.
+        """
+
+        try:
+            f = open(path)
+        except IOError:
+            return None
+        try:
+            fields = f.read().split()
+        finally:
+            f.close()
+        if len(fields) != 5:
+            raise ValueError('bad checkpoint file %s' % path)
+        try:
+            fields = map(int, fields)
+        except ValueError:
+            raise ValueError('bad checkpoint file %s' % path)
+        return tuple(fields[:3]), tuple(fields[3:])
+
+    def chunk_submitted(self, chunkid, offset, nextline):
+        """
+        Note where in the input the given chunk ends: the offset and line
+        number just past it.
+        """
+
+        self.chunk_ends[chunkid] = (offset, nextline)
+
+    def chunks_finished(self, finished):
+        """
+        Take in (chunkid, nrecords) pairs for chunks which have been fully
+        dealt with, and save a checkpoint if it's time.
+        """
+
+        self.finished.update(finished)
+        while self.next_chunkid in self.finished:
+            self.nextrow += self.finished.pop(self.next_chunkid)
+            offset, nextline = self.chunk_ends.pop(self.next_chunkid)
+            self.position = (offset, self.nextrow, nextline)
+            self.next_chunkid += 1
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        self.last_save = time.time()
+        if self.disabled or self.position is None or self.position == self.saved_position:
+            return
+        tmppath = self.path + '.tmp'
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            f = open(tmppath, 'w')
+            try:
+                f.write('%d %d %d %d %d\n' % (self.position + self.stamp))
+            finally:
+                f.close()
+            os.rename(tmppath, self.path)
+        except EnvironmentError, e:
+            self.disabled = True
+            try:
+                os.unlink(tmppath)
+            except EnvironmentError:
+                pass
+            if self.on_failure is not None:
+                self.on_failure(e)
+            return
+        self.saved_position = self.position
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except EnvironmentError:
+            pass
+
+def file_stamp(f):
+    """
+    The (size, mtime in microseconds) of an open file, to tell whether it's
+    been changed.
+    """
+
+    st = os.fstat(f.fileno())
+    return st.st_size, int(st.st_mtime * 1000000)
+
+class SerialImporter:
+    """
+    Does the same job as ParallelImporter, with the same interface, but
+    in-process and using an existing connection.
+    """
+
+    def __init__(self, conn, inserter, batcher, policy, maxinflight=1, routing=None,
+                 firstrow=0):
+        self.conn = conn
+        self.inserter = inserter
+        self.batcher = batcher
+        self.policy = policy
+        self.maxinflight = maxinflight
+        self.routing = routing
+        self.router = None
+        self.tracker = InsertTracker(policy)
+        self.numbering = RecordNumbering(firstrow)
+        self.next_chunkid = 0
+        self.finished_chunks = []
+        self.imported = 0
+        self.errors = []
+        # chunks whose results were lost; see ParallelImporter
+        self.lost_chunks = []
+
+    def start(self):
+        pipeline = InsertPipeline(self.conn, self.inserter.prepare(self.conn.cursor()),
+                                  self.maxinflight)
+        self.router = make_router(self.routing, self.inserter, pipeline, self.conn)
+
+    def submit(self, task):
+        records = read_task(task)
+        import_records(self.inserter, self.router, self.batcher, self.policy,
+                       self.tracker, self.next_chunkid, records)
+        self.next_chunkid += 1
+        self.add_results(self.tracker.pop_finished())
+        return True
+
+    def add_results(self, results):
+        for chunkid, imported, errors, nrecords in results:
+            self.imported += imported
+            self.errors.extend(self.numbering.add(chunkid, nrecords, errors))
+            if not self.policy.too_many(errors):
+                self.finished_chunks.append((chunkid, nrecords))
+
+    def pop_finished_chunks(self):
+        """
+        Return (chunkid, nrecords) for the chunks which have been fully
+        dealt with since the last call, chunk ids counting from 0 in the
+        order they were submitted. Each record in those was either imported
+        or rejected.
+        """
+
+        finished = self.finished_chunks
+        self.finished_chunks = []
+        return finished
+
+    def finish(self):
+        self.add_results(self.tracker.finish())
+        self.router.close()
+        self.errors.extend(self.numbering.flush())
+        return self.imported, self.errors
+
+    def terminate(self):
+        if self.router is not None:
+            self.router.close()
+
+class ParallelImporter:
+    """
+    Fans chunks of CSV records out to a pool of worker processes, each with
+    its own connection, and merges the per-worker counts and errors that
+    come back.
+
+    Chunks are either lists of (rownum, linenum, row) records or FileRanges
+    for the workers to read themselves, with records numbered from 0 in
+    each. They get their real numbers, counting from firstrow, once every
+    earlier chunk is done.
+
+    Chunks are handed out through a bounded queue, so submit() blocks when
+    all the workers are busy instead of letting the reader race ahead of
+    them.
+
+    If the workers die with chunks still outstanding, there's no telling
+    which of their records made it, so each of those chunks is reported as
+    an error and its id put in lost_chunks.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, connparams, inserter, batcher, numworkers, policy,
+                 maxinflight=1, routing=None, firstrow=0):
+        if multiprocessing is None:
+            raise ImportError("Parallel import requires the multiprocessing"
+                              " module (Python 2.6 or later)")
+        self.tasks = multiprocessing.Queue(numworkers * 2)
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=import_worker,
+                                                args=(connparams, inserter, batcher,
+                                                      policy, maxinflight, routing,
+                                                      self.tasks, self.results))
+                        for n in range(numworkers)]
+        self.next_chunkid = 0
+        self.outstanding = 0
+        # the tasks of outstanding chunks, by chunk id
+        self.pending = {}
+        self.policy = policy
+        self.numbering = RecordNumbering(firstrow)
+        self.finished_chunks = []
+        self.imported = 0
+        self.errors = []
+        self.lost_chunks = []
+
+    def start(self):
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+    def workers_alive(self):
+        return [w for w in self.workers if w.is_alive()]
+
+    def add_result(self, result):
+        chunkid, imported, errors, nrecords = result
+        self.imported += imported
+        if chunkid is None:
+            self.errors.extend(errors)
+            return
+        self.outstanding -= 1
+        del self.pending[chunkid]
+        if not self.policy.too_many(errors):
+            self.finished_chunks.append((chunkid, nrecords))
+        self.errors.extend(self.numbering.add(chunkid, nrecords, errors))
+
+    def pop_finished_chunks(self):
+        """
+        Return (chunkid, nrecords) for the chunks which have been fully
+        dealt with since the last call, chunk ids counting from 0 in the
+        order they were submitted. Each record in those was either imported
+        or rejected.
+        """
+
+        self.collect_results()
+        finished = self.finished_chunks
+        self.finished_chunks = []
+        return finished
+
+    def collect_results(self, block=False):
+        while True:
+            try:
+                result = self.results.get(block, self.poll_interval)
+            except Queue.Empty:
+                return
+            self.add_result(result)
+            block = False
+
+    def put_task(self, task):
+        while True:
+            self.collect_results()
+            try:
+                self.tasks.put(task, True, self.poll_interval)
+                return True
+            except Queue.Full:
+                if not self.workers_alive():
+                    return False
+
+    def submit(self, task):
+        """
+        Queue up a chunk of records, or a FileRange, for import. Returns
+        False if there are no live workers left to take it.
+        """
+
+        if not self.put_task((self.next_chunkid, task)):
+            return False
+        self.pending[self.next_chunkid] = task
+        self.next_chunkid += 1
+        self.outstanding += 1
+        return True
+
+    def lost_chunk_error(self, task):
+        """
+        An error for a chunk which was lost along with the workers, giving
+        the lines it covered and its records, as far as they can be read.
+        """
+
+        try:
+            records = read_task(task)
+        except (csv.Error, EnvironmentError):
+            records = []
+        if records:
+            return (None, records[0][1],
+                    'Import worker died; lines %d to %d may not have been imported'
+                    % (records[0][1], records[-1][1]),
+                    [row for (rownum, linenum, row) in records])
+        linenum = None
+        if isinstance(task, FileRange):
+            linenum = task.firstline + 1
+        return (None, linenum, 'Import worker died; a chunk of records may not have'
+                               ' been imported', [])
+
+    def finish(self):
+        """
+        Tell the workers there is no more work, and wait for all outstanding
+        chunks to be accounted for. Returns the total number of records
+        imported and the list of errors reported, in the order they came
+        back, followed by one for each chunk lost along with the workers.
+        """
+
+        for w in self.workers:
+            if not self.put_task(None):
+                break
+        while self.outstanding > 0:
+            self.collect_results(block=True)
+            if self.outstanding > 0 and not self.workers_alive():
+                self.collect_results()
+                break
+        for w in self.workers:
+            w.join()
+        self.errors.extend(self.numbering.flush())
+        for chunkid in sorted(self.pending.keys()):
+            self.errors.append(self.lost_chunk_error(self.pending.pop(chunkid)))
+            self.lost_chunks.append(chunkid)
+        return self.imported, self.errors
+
+    def terminate(self):
+        for w in self.workers:
+            if w.is_alive():
+                w.terminate()
+
+class TokenPager:
+    """
+    Reads a whole table, or the part of it in the token range (start, end],
+    a page at a time, in token order, so that memory use doesn't grow with
+    the size of the table and an export can be stopped between any two
+    pages. start and end are token strings, or None for the start or end of
+    the ring; the range can't wrap around. They're written into the queries
+    as numbers or as strings, going by the partitioner.
+
+    The first page is just selectq with a LIMIT; each page after that asks
+    for the partitions whose tokens come after the last whole partition
+    seen so far:
+
+        <selectq> WHERE token(k1, k2) > token(?, ?) LIMIT <pagesize>
+
+    Since a page can end partway through a partition, the rows of the last
+    partition in a full page are held back and read again at the start of
+    the next page. When a single partition fills up a whole page by itself,
+    the rest of it is read a page at a time by clustering key, with the
+    first clustering columns fixed and the next one past the last row read:
+
+        <selectq> WHERE k1 = ? AND k2 = ? AND c1 = ? AND c2 > ? LIMIT <pagesize>
+
+    moving on to fewer fixed clustering columns as each runs out.
+
+    selectq has to select every partition key column; partkey is their
+    (protected) names and partkey_indexes their positions in the selected
+    columns. clustering describes the clustering columns, in order, as
+    (protected name, position, descending) triples; where they aren't all
+    selected, it should be empty. Without them, a partition too big for a
+    page is read all at once, so memory use is only bounded by the size of
+    the biggest partition.
+    """
+
+    max_partition_rows = 2000000000
+
+    def __init__(self, cursor, selectq, partkey, partkey_indexes, pagesize,
+                 start=None, end=None, partitioner=None, clustering=()):
+        self.cursor = cursor
+        self.selectq = selectq
+        self.partkey = partkey
+        self.partkey_indexes = partkey_indexes
+        self.pagesize = pagesize
+        self.start = start
+        self.end = end
+        self.partitioner = partitioner
+        self.clustering = clustering
+        self.paramnames = ['k%d' % n for n in range(len(partkey))]
+        self.partition_queries = {}
+
+    def key_of(self, row):
+        return tuple([row[i] for i in self.partkey_indexes])
+
+    def params_for(self, key, row=None, depth=0):
+        params = dict(zip(self.paramnames, key))
+        for n, (name, index, desc) in enumerate(self.clustering[:depth]):
+            params['c%d' % n] = row[index]
+        return params
+
+    def token_clause(self, op, bound):
+        return 'token(%s) %s %s' % (', '.join(self.partkey), op, bound)
+
+    def token_literal(self, token):
+        if self.partitioner in numeric_token_partitioners:
+            return str(long(token))
+        # the byte-ordered and order-preserving partitioners' tokens
+        return cql_quote(token)
+
+    def page_query(self, clauses):
+        if self.end is not None:
+            clauses = clauses + [self.token_clause('<=', self.token_literal(self.end))]
+        if clauses:
+            return '%s WHERE %s LIMIT %d' % (self.selectq, ' AND '.join(clauses),
+                                             self.pagesize)
+        return '%s LIMIT %d' % (self.selectq, self.pagesize)
+
+    def first_page_query(self):
+        if self.start is None:
+            return self.page_query([])
+        return self.page_query([self.token_clause('>', self.token_literal(self.start))])
+
+    def prepare_next_page(self):
+        nextkey = 'token(%s)' % ', '.join([':' + p for p in self.paramnames])
+        return self.cursor.prepare_query(self.page_query([self.token_clause('>', nextkey)]))
+
+    def partition_query(self, depth):
+        """
+        The prepared query for the rest of a partition after a row, going by
+        its first depth clustering columns: the rows with the same values in
+        the first depth-1, and a later value in the last. With a depth of 0,
+        the query is for the whole partition.
+        """
+
+        query = self.partition_queries.get(depth)
+        if query is not None:
+            return query
+        clauses = ['%s = :%s' % (k, p) for (k, p) in zip(self.partkey, self.paramnames)]
+        for n, (name, index, desc) in enumerate(self.clustering[:depth]):
+            if n < depth - 1:
+                op = '='
+            elif desc:
+                op = '<'
+            else:
+                op = '>'
+            clauses.append('%s %s :c%d' % (name, op, n))
+        limit = depth and self.pagesize or self.max_partition_rows
+        query = self.cursor.prepare_query('%s WHERE %s LIMIT %d'
+                                          % (self.selectq, ' AND '.join(clauses), limit))
+        self.partition_queries[depth] = query
+        return query
+
+    def fetch(self, query, params):
+        self.cursor.execute_prepared(query, params)
+        return self.cursor.fetchall()
+
+    def partition_pages(self, rows):
+        """
+        Yield rows, a full page of rows of one partition from its start, and
+        then the rest of the partition, a page at a time.
+        """
+
+        key = self.key_of(rows[-1])
+        if not self.clustering:
+            yield self.fetch(self.partition_query(0), self.params_for(key))
+            return
+        yield rows
+        depth = len(self.clustering)
+        lastrow = rows[-1]
+        while depth > 0:
+            rows = self.fetch(self.partition_query(depth),
+                              self.params_for(key, lastrow, depth))
+            if rows:
+                yield rows
+            if len(rows) >= self.pagesize:
+                lastrow = rows[-1]
+                depth = len(self.clustering)
+            else:
+                depth -= 1
+
+    def pages(self):
+        """
+        Yield lists of rows, as decoded by the cursor, until the table (or
+        the range) runs out. The cursor's description and column_types
+        describe the rows of each page as it is yielded.
+        """
+
+        self.cursor.execute(self.first_page_query())
+        rows = self.cursor.fetchall()
+        nextpage = None
+        while len(rows) >= self.pagesize:
+            lastkey = self.key_of(rows[-1])
+            n = len(rows) - 1
+            while n > 0 and self.key_of(rows[n - 1]) == lastkey:
+                n -= 1
+            if n == 0:
+                for page in self.partition_pages(rows):
+                    yield page
+            else:
+                yield rows[:n]
+                lastkey = self.key_of(rows[n - 1])
+            if nextpage is None:
+                nextpage = self.prepare_next_page()
+            rows = self.fetch(nextpage, self.params_for(lastkey))
+        if rows:
+            yield rows
+
+# partitioners whose token strings have to be compared as numbers, rather
+# than as strings, to tell where the ring wraps around
+numeric_token_partitioners = (
+    'org.apache.cassandra.dht.Murmur3Partitioner',
+    'org.apache.cassandra.dht.RandomPartitioner',
+)
+
+def unwrap_range(start, end, partitioner):
+    """
+    Turn the token range (start, end] into one or two ranges which don't
+    wrap around the ring, with None standing for the start or end of the
+    ring.
+    """
+
+    if partitioner in numeric_token_partitioners:
+        wraps = long(end) <= long(start)
+    else:
+        wraps = end <= start
+    if wraps:
+        return [(start, None), (None, end)]
+    return [(start, end)]
+
+def split_ring(client, cfname, ring, partitioner, keys_per_split):
+    """
+    Divide up the ring, as returned by describe_ring, into the ranges an
+    export should read separately: describe_splits' pieces of each ring
+    range, made not to wrap around. Returns a list of (start, end, hosts),
+    where hosts are the replicas for that range. client has to be in the
+    table's keyspace already.
+    """
+
+    ranges = []
+    for tokenrange in ring:
+        try:
+            splits = client.describe_splits(cfname, tokenrange.start_token,
+                                            tokenrange.end_token, keys_per_split)
+        except CQL_ERRORS:
+            splits = None
+        if not splits or len(splits) < 2:
+            splits = [tokenrange.start_token, tokenrange.end_token]
+        hosts = ring_endpoints(tokenrange)
+        for start, end in zip(splits[:-1], splits[1:]):
+            for subrange in unwrap_range(start, end, partitioner):
+                ranges.append(subrange + (hosts,))
+    return ranges
+
+class RowFormatter:
+    """
+    Turns rows from a cursor into lists of strings for a csv writer, the
+    same way COPY TO does. A plain formatter is built for each column once,
+    and used again for as long as the column types stay the same. Small
+    and picklable, so export workers can each be given one.
+    """
+
+    def __init__(self, encoding, nullval, time_format, float_precision):
+        self.encoding = encoding
+        self.nullval = nullval
+        self.time_format = time_format
+        self.float_precision = float_precision
+        self.coltypes = None
+        self.formatters = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the formatters are closures, and quick to build again
+        state['coltypes'] = state['formatters'] = None
+        return state
+
+    def make_formatter(self, cqltype):
+        return make_plain_formatter(cqltype, self.encoding, self.time_format,
+                                    self.float_precision)
+
+    def formatters_for(self, coltypes):
+        if coltypes != self.coltypes:
+            self.formatters = map(self.make_formatter, coltypes)
+            self.coltypes = list(coltypes)
+        return self.formatters
+
+    def format_rows(self, rows, coltypes):
+        """
+        Format the first len(coltypes) values of each row.
+        """
+
+        formatters = self.formatters_for(coltypes)
+        nullval = self.nullval
+        return [[nullval if v is None else f(v) for (f, v) in zip(formatters, row)]
+                for row in rows]
+
+class RawRowFormatter(RowFormatter):
+    """
+    A RowFormatter for COPY TO's raw format, which writes values out
+    exactly, in the forms COPY FROM reads: blobs in hex, timestamps as
+    milliseconds since the epoch, floating point numbers with all their
+    digits, and text without escapes. Types there's no raw form for are
+    formatted as usual.
+
+    The csv writer doesn't escape the escape character itself, so if the
+    dialect has one (escapechar), it's doubled here, for the csv reader to
+    undo; otherwise a backslash in the data would escape whatever follows
+    it when the file is read back.
+    """
+
+    def __init__(self, encoding, nullval, escapechar=None):
+        RowFormatter.__init__(self, encoding, nullval, None, None)
+        self.escapechar = escapechar
+
+    def make_formatter(self, cqltype):
+        try:
+            fmt = raw_formatter_for_type(cqltype, self.encoding)
+        except KeyError:
+            fmt = RowFormatter.make_formatter(self, cqltype)
+        escapechar = self.escapechar
+        if not escapechar:
+            return fmt
+        escaped = escapechar * 2
+        return lambda val: fmt(val).replace(escapechar, escaped)
+
+# types whose native values json can write as they are
+json_native_types = ('int', 'bigint', 'varint', 'counter', 'float', 'double', 'boolean',
+                     'text', 'varchar')
+
+def json_formatter_for_type(cqltype, encoding):
+    """
+    Build a function which turns a native value of the given cql type into
+    one json can write, and which json_field_converter_for_type reads back.
+    Values with no json equivalent are written as their raw text, except
+    timestamps, which become milliseconds since the epoch.
+    """
+
+    typename = cqltype.typename
+    if typename in ('list', 'set'):
+        fmt_item = json_formatter_for_type(cqltype.subtypes[0], encoding)
+        return lambda val: [fmt_item(item) for item in val]
+    if typename == 'map':
+        # json object keys can only be strings
+        fmt_key = raw_formatter_for_type(cqltype.subtypes[0], 'utf8')
+        fmt_value = json_formatter_for_type(cqltype.subtypes[1], encoding)
+        return lambda val: dict([(fmt_key(k), fmt_value(v)) for (k, v) in val.items()])
+    if typename in json_native_types:
+        return lambda val: val
+    if typename == 'timestamp':
+        return lambda val: int(round(val * 1000))
+    return raw_formatter_for_type(cqltype, encoding)
+
+class JSONRowFormatter(RowFormatter):
+    """
+    A RowFormatter for COPY TO's jsonl format, which makes values for json
+    to write rather than strings. Nulls stay None.
+    """
+
+    def __init__(self, encoding):
+        RowFormatter.__init__(self, encoding, None, None, None)
+
+    def make_formatter(self, cqltype):
+        try:
+            return json_formatter_for_type(cqltype, self.encoding)
+        except KeyError:
+            return RowFormatter.make_formatter(self, cqltype)
+
+def json_scalar_text(val):
+    if isinstance(val, unicode):
+        return val.encode('utf8')
+    if isinstance(val, bool):
+        return val and 'true' or 'false'
+    if isinstance(val, float):
+        return repr(val)
+    if isinstance(val, (int, long)):
+        return str(val)
+    raise ValueError('expected a string, number or boolean, not %s'
+                     % json.dumps(val))
+
+def make_json_item_converter(cqltype):
+    if cqltype.typename in unquoted_item_types:
+        return json_scalar_text
+    return lambda item: quote_collection_item(json_scalar_text(item))
+
+def json_field_converter_for_type(cqltype):
+    """
+    Build a function which turns a value from a json record into the CSV
+    field COPY FROM would read the same value from, for the given cql type
+    (or None, if it isn't known). Arrays and objects are only understood
+    for collection columns.
+    """
+
+    typename = cqltype and cqltype.typename
+    if typename in ('list', 'set'):
+        convert_item = make_json_item_converter(cqltype.subtypes[0])
+        lbracket, rbracket = ('[', ']') if typename == 'list' else ('{', '}')
+        def convert_array(val):
+            if not isinstance(val, list):
+                return json_scalar_text(val)
+            return lbracket + ', '.join(map(convert_item, val)) + rbracket
+        return convert_array
+    if typename == 'map':
+        convert_key = make_json_item_converter(cqltype.subtypes[0])
+        convert_value = make_json_item_converter(cqltype.subtypes[1])
+        def convert_object(val):
+            if not isinstance(val, dict):
+                return json_scalar_text(val)
+            return '{' + ', '.join([convert_key(k) + ': ' + convert_value(v)
+                                    for (k, v) in val.items()]) + '}'
+        return convert_object
+    return json_scalar_text
+
+class JSONLinesReader:
+    """
+    Reads json objects, one per line, into rows of CSV fields for the given
+    columns, so that they can be imported the same way as CSV records.
+    Missing and null values come out as None, which the inserters leave
+    out of the record's INSERT so that they stay null, while "" is an empty
+    field as usual. Keys which aren't among the columns are ignored. Like a
+    csv reader, keeps count of the lines read in line_num, and raises
+    csv.Error for lines it can't read.
+    """
+
+    def __init__(self, lines, colnames, coltypes=None):
+        self.lines = iter(lines)
+        self.colnames = [name.decode('utf8') for name in colnames]
+        if coltypes is None:
+            coltypes = [None] * len(colnames)
+        self.converters = map(json_field_converter_for_type, coltypes)
+        self.line_num = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = ''
+        while not line.strip():
+            line = self.lines.next()
+            self.line_num += 1
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('expected a json object')
+            return [convert(val) if val is not None else None
+                    for (convert, val) in zip(self.converters, map(record.get, self.colnames))]
+        except ValueError, e:
+            raise csv.Error('line %d: %s' % (self.line_num, e))
+
+class JSONLinesWriter:
+    """
+    Writes rows of values out as json objects, one per line, with the keys
+    in column order. Has the writerow and writerows of a csv writer.
+    """
+
+    def __init__(self, f, colnames):
+        self.f = f
+        self.keys = [json.dumps(name.decode('utf8')) + ': ' for name in colnames]
+        self.encoder = json.JSONEncoder()
+
+    def format_row(self, row):
+        encode = self.encoder.encode
+        return '{' + ', '.join([k + encode(v) for (k, v) in zip(self.keys, row)]) + '}\n'
+
+    def writerow(self, row):
+        self.f.write(self.format_row(row))
+
+    def writerows(self, rows):
+        self.f.write(''.join(map(self.format_row, rows)))
+
+class CSVOutput:
+    """
+    Picklable maker of csv writers, for export workers.
+    """
+
+    def __init__(self, dialect_options):
+        self.dialect_options = dialect_options
+
+    def writer(self, f):
+        return csv.writer(f, **self.dialect_options)
+
+class JSONLinesOutput:
+    """
+    Picklable maker of JSONLinesWriters, for export workers.
+    """
+
+    def __init__(self, colnames):
+        self.colnames = colnames
+
+    def writer(self, f):
+        return JSONLinesWriter(f, self.colnames)
+
+class RangeExport:
+    """
+    Settings for export workers: how to read a token range of the table and
+    how to write its rows out, with the given RowFormatter and CSVOutput or
+    JSONLinesOutput. Each row of selectq starts with the ncols
+    columns to be exported, followed by any primary key columns which
+    aren't among them (see TokenPager for partkey and clustering).
+    """
+
+    def __init__(self, connparams, selectq, partkey, partkey_indexes, ncols,
+                 pagesize, formatter, output, header=None, codec=None, partitioner=None,
+                 clustering=()):
+        self.connparams = connparams
+        self.selectq = selectq
+        self.partkey = partkey
+        self.partkey_indexes = partkey_indexes
+        self.ncols = ncols
+        self.pagesize = pagesize
+        self.formatter = formatter
+        self.output = output
+        self.header = header
+        self.codec = codec
+        self.partitioner = partitioner
+        self.clustering = clustering
+
+    def pages(self, cursor, start, end):
+        pager = TokenPager(cursor, self.selectq, self.partkey, self.partkey_indexes,
+                           self.pagesize, start, end, self.partitioner, self.clustering)
+        for page in pager.pages():
+            coltypes = cursor.column_types[:self.ncols]
+            yield self.formatter.format_rows(page, coltypes)
+
+    def open_range_file(self, fname):
+        outfile = open(fname, 'wb')
+        if self.codec is None:
+            dest = outfile
+        else:
+            dest = CompressingWriter(outfile, self.codec)
+        writer = self.output.writer(dest)
+        if self.header is not None:
+            writer.writerow(self.header)
+        return outfile, dest, writer
+
+class HostConnections:
+    """
+    Connections, opened as needed, to whichever replica of each range will
+    take one, falling back to the host cqlsh is connected to.
+    """
+
+    def __init__(self, connparams):
+        self.connparams = connparams
+        self.conns = {}
+
+    def cursor_for(self, hosts):
+        for host in list(hosts) + [self.connparams.host]:
+            conn = self.conns.get(host)
+            if conn is None:
+                try:
+                    conn = self.connparams.for_host(host).connect()
+                except CONNECTION_ERRORS + CQL_ERRORS:
+                    continue
+                self.conns[host] = conn
+            return conn.cursor()
+        raise socket.error("Can't connect to any of %s" % ', '.join(hosts))
+
+    def close(self):
+        for conn in self.conns.values():
+            try:
+                conn.close()
+            except CONNECTION_ERRORS + CQL_ERRORS:
+                pass
+        self.conns = {}
+
+def export_range(export, connections, rangeid, start, end, hosts, fname, results):
+    # spread the ranges over their replicas, rather than all going to the first
+    if hosts:
+        n = rangeid % len(hosts)
+        hosts = hosts[n:] + hosts[:n]
+    cursor = connections.cursor_for(hosts)
+    if fname is None:
+        for page in export.pages(cursor, start, end):
+            buf = StringIO()
+            export.output.writer(buf).writerows(page)
+            results.put(('rows', rangeid, buf.getvalue(), len(page)))
+        return
+    outfile, dest, writer = export.open_range_file(fname)
+    try:
+        for page in export.pages(cursor, start, end):
+            writer.writerows(page)
+            results.put(('rows', rangeid, None, len(page)))
+    finally:
+        try:
+            if dest is not outfile:
+                dest.close()
+        finally:
+            outfile.close()
+
+def export_worker(export, tasks, results):
+    """
+    Read the token ranges handed out on the tasks queue until a None comes
+    along. For each range, put ('rows', rangeid, csvdata, nrows) on the
+    results queue for every page read, then ('done', rangeid) at the end,
+    or ('error', rangeid, message) if it can't be finished. csvdata is None
+    when the range is being written to its own file.
+    """
+
+    connections = HostConnections(export.connparams)
+    try:
+        for rangeid, start, end, hosts, fname in iter(tasks.get, None):
+            try:
+                export_range(export, connections, rangeid, start, end, hosts, fname,
+                             results)
+            except CONNECTION_ERRORS + CQL_ERRORS + (EnvironmentError,), e:
+                results.put(('error', rangeid, error_message(e)))
+                # the connection may be in any state now
+                connections.close()
+                continue
+            results.put(('done', rangeid))
+    finally:
+        connections.close()
+
+class ParallelExporter:
+    """
+    Hands token ranges out to a pool of worker processes, each with its own
+    connections, and writes the CSV data that comes back to the output as
+    it arrives, so pages from different ranges are interleaved. Ranges
+    which go to their own files are written by the workers themselves.
+
+    The results queue is bounded, so that workers wait for the output to
+    keep up instead of piling pages up in memory.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, export, numworkers):
+        if multiprocessing is None:
+            raise ImportError("Parallel export requires the multiprocessing"
+                              " module (Python 2.6 or later)")
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue(numworkers * 4)
+        self.workers = [multiprocessing.Process(target=export_worker,
+                                                args=(export, self.tasks, self.results))
+                        for n in range(numworkers)]
+        self.rows = 0
+        self.errors = []
+
+    def workers_alive(self):
+        return [w for w in self.workers if w.is_alive()]
+
+    def run(self, ranges, out=None):
+        """
+        Export each (start, end, hosts, fname) range, writing the rows to
+        out for the ones with no fname of their own. Returns the number of
+        rows exported, and a list of (start, end, message) for the ranges
+        which failed.
+        """
+
+        for rangeid, (start, end, hosts, fname) in enumerate(ranges):
+            self.tasks.put((rangeid, start, end, hosts, fname))
+        for w in self.workers:
+            self.tasks.put(None)
+            w.daemon = True
+            w.start()
+        remaining = set(range(len(ranges)))
+        lastlook = False
+        while remaining:
+            try:
+                result = self.results.get(True, self.poll_interval)
+            except Queue.Empty:
+                if self.workers_alive():
+                    continue
+                # one more look, for anything the workers put on the queue
+                # just before they went
+                if lastlook:
+                    break
+                lastlook = True
+                continue
+            if result[0] == 'rows':
+                rangeid, data, nrows = result[1:]
+                if data is not None:
+                    out.write(data)
+                self.rows += nrows
+                continue
+            rangeid = result[1]
+            remaining.discard(rangeid)
+            if result[0] == 'error':
+                start, end = ranges[rangeid][:2]
+                self.errors.append((start, end, result[2]))
+        for rangeid in sorted(remaining):
+            start, end = ranges[rangeid][:2]
+            self.errors.append((start, end, 'Export worker died'))
+        for w in self.workers:
+            w.join()
+        return self.rows, self.errors
+
+    def terminate(self):
+        for w in self.workers:
+            if w.is_alive():
+                w.terminate()
@@ -15,6 +15,8 @@
 # limitations under the License.
 
 import re
+import marshal
+import tempfile
 from collections import defaultdict
 
 RED = '\033[0;1;31m'
@@ -27,12 +29,21 @@ WHITE = '\033[0;1;37m'
 DARK_MAGENTA = '\033[0;35m'
 ANSI_RESET = '\033[0m'
 
+# a colormap with no colors in it. formatters given this one don't bother
+# building colored values at all.
+NO_COLORS = defaultdict(lambda: '')
+
 def colorme(bval, colormap, colorkey):
     if colormap is None:
         colormap = DEFAULT_VALUE_COLORS
+    elif colormap is NO_COLORS:
+        return FormattedValue(bval)
     return FormattedValue(bval, colormap[colorkey] + bval + colormap['reset'])
 
-class FormattedValue:
+class FormattedValue(object):
+    # there are a lot of these around when a big result is being printed
+    __slots__ = ('strval', 'coloredval', 'displaywidth')
+
     def __init__(self, strval, coloredval=None, displaywidth=None):
         self.strval = strval
         if coloredval is None:
@@ -85,6 +96,57 @@ class FormattedValue:
         """
         return self.coloredval + self._pad(width, fill)
 
+class SpilledRows:
+    """
+    A sequence of rows of FormattedValues which keeps up to maxrows of them
+    in memory, and moves them all out to a temporary file once there are
+    more, so that a result can be held until every row has been seen (to
+    know how wide to make the columns) without holding it all in memory.
+    Iterating gives the rows back in order.
+    """
+
+    def __init__(self, maxrows):
+        self.maxrows = maxrows
+        self.rows = []
+        self.spillfile = None
+
+    def append(self, row):
+        if self.spillfile is None:
+            self.rows.append(row)
+            if len(self.rows) > self.maxrows:
+                self.spill()
+        else:
+            self.dump(row)
+
+    def spill(self):
+        self.spillfile = tempfile.TemporaryFile()
+        for row in self.rows:
+            self.dump(row)
+        self.rows = []
+
+    def dump(self, row):
+        marshal.dump(tuple([(v.strval, v.coloredval, v.displaywidth) for v in row]),
+                     self.spillfile)
+
+    def __iter__(self):
+        if self.spillfile is None:
+            for row in self.rows:
+                yield row
+            return
+        self.spillfile.seek(0)
+        while True:
+            try:
+                row = marshal.load(self.spillfile)
+            except EOFError:
+                break
+            yield [FormattedValue(*v) for v in row]
+
+    def close(self):
+        self.rows = []
+        if self.spillfile is not None:
+            self.spillfile.close()
+            self.spillfile = None
+
 DEFAULT_VALUE_COLORS = dict(
     default=YELLOW,
     text=YELLOW,
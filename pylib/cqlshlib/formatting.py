@@ -16,14 +16,18 @@
 
 import re
 import time
-from collections import defaultdict
+import binascii
 from . import wcwidth
-from .displaying import colorme, FormattedValue, DEFAULT_VALUE_COLORS
+from .displaying import colorme, FormattedValue, DEFAULT_VALUE_COLORS, NO_COLORS
 from cql import cqltypes
 
 unicode_controlchars_re = re.compile(r'[\x00-\x31\x7f-\xa0]')
 controlchars_re = re.compile(r'[\x00-\x31\x7f-\xff]')
 
+# text which format_value_text can leave as it is: printable ascii, with no
+# backslashes to escape
+printable_ascii_re = re.compile(ur'[ -\[\]-~]*\Z')
+
 def _show_control_chars(match):
     txt = repr(match.group(0))
     if txt.startswith('u'):
@@ -42,11 +46,17 @@ def _make_turn_bits_red_f(color1, color2):
         return color1 + txt + color2
     return _turn_bits_red
 
+def _show_uncolored_bits(bval):
+    # what bits_to_turn_red_re.sub does with no colors to turn the bits red:
+    # only the doubled backslashes change. cheaper than the regex, and
+    # gives back bval itself when there are none.
+    return bval.replace('\\\\', '\\')
+
 default_null_placeholder = 'null'
 default_time_format = ''
 default_float_precision = 3
 default_colormap = DEFAULT_VALUE_COLORS
-empty_colormap = defaultdict(lambda: '')
+empty_colormap = NO_COLORS
 
 def format_by_type(cqltype, val, encoding, colormap=None, addcolor=False,
                    nullval=None, time_format=None, float_precision=None):
@@ -66,10 +76,148 @@ def format_by_type(cqltype, val, encoding, colormap=None, addcolor=False,
                         time_format=time_format, float_precision=float_precision,
                         nullval=nullval)
 
+def make_value_formatter(cqltype, encoding, colormap=None, addcolor=False,
+                         nullval=None, time_format=None, float_precision=None,
+                         cache=None):
+    """
+    A function of one value which formats it the way format_by_type would
+    with the rest of these arguments. The formatter for the type is looked
+    up, and the defaults filled in, just the once, for formatting a lot of
+    values of the same type (with format_column, say).
+
+    If a FormatterCache is given, values of the types in cacheable_types
+    are looked up in it first, and the FormattedValues made for them are
+    kept in it to be handed out again.
+    """
+
+    if nullval is None:
+        nullval = default_null_placeholder
+    nullcolormap = colormap
+    if addcolor is False:
+        colormap = empty_colormap
+    elif colormap is None:
+        colormap = default_colormap
+    if time_format is None:
+        time_format = default_time_format
+    if float_precision is None:
+        float_precision = default_float_precision
+    formatter = _formatters.get(cqltype.typename, format_value_default)
+    kwargs = dict(subtypes=cqltype.subtypes, encoding=encoding, colormap=colormap,
+                  time_format=time_format, float_precision=float_precision,
+                  nullval=nullval)
+    def format_one(val):
+        if val is None:
+            return colorme(nullval, nullcolormap, 'error')
+        return formatter(val, **kwargs)
+    if cache is None or cqltype.typename not in cacheable_types:
+        return format_one
+    # colormaps aren't hashable, so go by what's in them
+    optkey = (cqltype, encoding, tuple(sorted(colormap.items())), nullval, time_format,
+              float_precision)
+    def format_one_cached(val):
+        if val is None:
+            return colorme(nullval, nullcolormap, 'error')
+        return cache.get((optkey, val), format_one, val)
+    return format_one_cached
+
+# types worth caching the FormattedValues of: ones whose values format the
+# same whenever they're equal (unlike, say, Decimal('1.0') and
+# Decimal('1.00'), or 0.0 and -0.0) and hash, so that FormatterCache can
+# key on them, and which take more than a str() to format. integers are
+# left out, being about as quick to format as to look up, and often ids
+# which would only push everything else out of the cache.
+cacheable_types = frozenset(('ascii', 'text', 'varchar', 'boolean', 'timestamp',
+                             'uuid', 'timeuuid', 'inet', 'blob'))
+
+class FormatterCache:
+    """
+    A cache of FormattedValues for make_value_formatter, holding on to the
+    maxsize most recently used ones. Meant for columns with only a few
+    different values in them (statuses, flags, the same few timestamps),
+    which would otherwise be formatted again for every row. hits and
+    misses count the lookups, for judging whether maxsize is right.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        # entries are also kept in a circular doubly linked list, least
+        # recently used first, of [prev, next, key, value] links
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, make, arg):
+        """
+        The cached value for key, or if there isn't one, make(arg), which is
+        cached under key.
+        """
+
+        root = self.root
+        link = self.entries.get(key)
+        if link is not None:
+            self.hits += 1
+            # move it to the most recently used end
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+        self.misses += 1
+        value = make(arg)
+        if len(self.entries) >= self.maxsize:
+            if self.maxsize <= 0:
+                return value
+            # reuse the least recently used link for the new entry
+            link = root[1]
+            del self.entries[link[2]]
+            root[1] = link[1]
+            link[1][0] = root
+        else:
+            link = [None, None, None, None]
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        link[2] = key
+        link[3] = value
+        last[1] = root[0] = link
+        self.entries[key] = link
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.root[:] = [self.root, self.root, None, None]
+        self.hits = self.misses = 0
+
+def format_column(formatter, values, width=0):
+    """
+    Format a column's worth of values with a formatter from
+    make_value_formatter. Returns the FormattedValues, and the greatest of
+    their display widths and the given width.
+    """
+
+    formatted = []
+    append = formatted.append
+    for val in values:
+        fval = formatter(val)
+        append(fval)
+        if fval.displaywidth > width:
+            width = fval.displaywidth
+    return formatted, width
+
 def format_value_default(val, colormap, **_):
     val = str(val)
     escapedval = val.replace('\\', '\\\\')
     bval = controlchars_re.sub(_show_control_chars, escapedval)
+    if colormap is empty_colormap:
+        return FormattedValue(bval, _show_uncolored_bits(bval))
     tbr = _make_turn_bits_red_f(colormap['hex'], colormap['text'])
     coloredval = colormap['text'] + bits_to_turn_red_re.sub(tbr, bval) + colormap['reset']
     return FormattedValue(bval, coloredval)
@@ -143,13 +291,23 @@ def format_value_timeuuid(val, colormap, time_format, **_):
 
 @formatter_for('text')
 def format_value_text(val, encoding, colormap, **_):
+    if printable_ascii_re.match(val):
+        # nothing to escape, and one column per character
+        bval = val.encode(encoding)
+        if colormap is empty_colormap:
+            return FormattedValue(bval, displaywidth=len(val))
+        return FormattedValue(bval, colormap['text'] + bval + colormap['reset'], len(val))
     escapedval = val.replace(u'\\', u'\\\\')
     escapedval = unicode_controlchars_re.sub(_show_control_chars, escapedval)
     bval = escapedval.encode(encoding, 'backslashreplace')
     displaywidth = wcwidth.wcswidth(bval.decode(encoding))
+    if displaywidth < 0:
+        displaywidth = None
+    if colormap is empty_colormap:
+        return FormattedValue(bval, _show_uncolored_bits(bval), displaywidth)
     tbr = _make_turn_bits_red_f(colormap['hex'], colormap['text'])
     coloredval = colormap['text'] + bits_to_turn_red_re.sub(tbr, bval) + colormap['reset']
-    return FormattedValue(bval, coloredval)
+    return FormattedValue(bval, coloredval, displaywidth)
 
 # name alias
 formatter_for('varchar')(format_value_text)
@@ -161,10 +319,14 @@ def format_simple_collection(subtype, val, lbracket, rbracket, encoding,
                          nullval=nullval)
             for sval in val]
     bval = lbracket + ', '.join(sval.strval for sval in subs) + rbracket
+    displaywidth = 2 * len(subs) + sum(sval.displaywidth for sval in subs)
+    if colormap is empty_colormap:
+        # the items' coloredvals have the bits shown in color un-escaped
+        coloredval = lbracket + ', '.join([sval.coloredval for sval in subs]) + rbracket
+        return FormattedValue(bval, coloredval, displaywidth)
     lb, sep, rb = [colormap['collection'] + s + colormap['reset']
                    for s in (lbracket, ', ', rbracket)]
     coloredval = lb + sep.join(sval.coloredval for sval in subs) + rb
-    displaywidth = 2 * len(subs) + sum(sval.displaywidth for sval in subs)
     return FormattedValue(bval, coloredval, displaywidth)
 
 @formatter_for('list')
@@ -187,10 +349,103 @@ def format_value_map(val, encoding, colormap, time_format, float_precision, subt
     subkeytype, subvaltype = subtypes
     subs = [(subformat(k, subkeytype), subformat(v, subvaltype)) for (k, v) in val.items()]
     bval = '{' + ', '.join(k.strval + ': ' + v.strval for (k, v) in subs) + '}'
+    displaywidth = 4 * len(subs) + sum(k.displaywidth + v.displaywidth for (k, v) in subs)
+    if colormap is empty_colormap:
+        # the items' coloredvals have the bits shown in color un-escaped
+        coloredval = '{' + ', '.join([k.coloredval + ': ' + v.coloredval
+                                      for (k, v) in subs]) + '}'
+        return FormattedValue(bval, coloredval, displaywidth)
     lb, comma, colon, rb = [colormap['collection'] + s + colormap['reset']
                             for s in ('{', ', ', ': ', '}')]
     coloredval = lb \
                + comma.join(k.coloredval + colon + v.coloredval for (k, v) in subs) \
                + rb
-    displaywidth = 4 * len(subs) + sum(k.displaywidth + v.displaywidth for (k, v) in subs)
     return FormattedValue(bval, coloredval, displaywidth)
+
+def unix_time_from_uuid1(u):
+    # 100ns intervals since the start of the gregorian calendar, to seconds
+    # since the unix epoch
+    return (u.time - 0x01B21DD213814000) / 10000000.0
+
+# Mapping cql type base names to functions which build a formatter for values
+# of that type, turning them straight into the same strings format_value
+# gives as strval, with no colors or FormattedValue objects. Meant for
+# formatting lots of values of the same few types, like in COPY TO, where
+# the formatters can be built once per column. The formatters don't handle
+# None; that's up to the caller.
+_plain_formatter_makers = {}
+
+def make_plain_formatter(cqltype, encoding, time_format=None, float_precision=None):
+    if time_format is None:
+        time_format = default_time_format
+    if float_precision is None:
+        float_precision = default_float_precision
+    maker = _plain_formatter_makers.get(cqltype.typename, make_plain_formatter_default)
+    return maker(subtypes=cqltype.subtypes, encoding=encoding, time_format=time_format,
+                 float_precision=float_precision)
+
+def plain_formatter_maker_for(*typnames):
+    def registrator(f):
+        for typname in typnames:
+            _plain_formatter_makers[typname] = f
+        return f
+    return registrator
+
+def make_plain_formatter_default(**_):
+    def format_default(val):
+        return controlchars_re.sub(_show_control_chars, str(val).replace('\\', '\\\\'))
+    return format_default
+
+@plain_formatter_maker_for('bytes')
+def make_plain_formatter_bytes(**_):
+    return binascii.hexlify
+
+@plain_formatter_maker_for('decimal', 'uuid', 'inet', 'boolean', 'bigint', 'int', 'varint',
+                           'counter')
+def make_plain_formatter_str(**_):
+    return str
+
+@plain_formatter_maker_for('float', 'double')
+def make_plain_formatter_floating_point(float_precision, **_):
+    return ('%%.%dg' % float_precision).__mod__
+
+@plain_formatter_maker_for('timestamp')
+def make_plain_formatter_timestamp(time_format, **_):
+    def format_timestamp(val):
+        return time.strftime(time_format, time.localtime(val))
+    return format_timestamp
+
+@plain_formatter_maker_for('timeuuid')
+def make_plain_formatter_timeuuid(time_format, **_):
+    def format_timeuuid(val):
+        return time.strftime(time_format, time.localtime(unix_time_from_uuid1(val)))
+    return format_timeuuid
+
+@plain_formatter_maker_for('text', 'varchar')
+def make_plain_formatter_text(encoding, **_):
+    def format_text(val):
+        if printable_ascii_re.match(val):
+            return val.encode(encoding)
+        escapedval = unicode_controlchars_re.sub(_show_control_chars, val.replace(u'\\', u'\\\\'))
+        return escapedval.encode(encoding, 'backslashreplace')
+    return format_text
+
+def make_plain_formatter_simple_collection(lbracket, rbracket):
+    def maker(subtypes, encoding, time_format, float_precision, **_):
+        subformat = make_plain_formatter(subtypes[0], encoding, time_format, float_precision)
+        def format_collection(val):
+            return lbracket + ', '.join([subformat(sval) for sval in val]) + rbracket
+        return format_collection
+    return maker
+
+plain_formatter_maker_for('list')(make_plain_formatter_simple_collection('[', ']'))
+plain_formatter_maker_for('set')(make_plain_formatter_simple_collection('{', '}'))
+
+@plain_formatter_maker_for('map')
+def make_plain_formatter_map(subtypes, encoding, time_format, float_precision, **_):
+    keyformat, valformat = [make_plain_formatter(t, encoding, time_format, float_precision)
+                            for t in subtypes]
+    def format_map(val):
+        return '{' + ', '.join([keyformat(k) + ': ' + valformat(v)
+                                for (k, v) in val.items()]) + '}'
+    return format_map
@@ -15,7 +15,11 @@
 # limitations under the License.
 
 from functools import partial
+import os
 import re
+import sys
+import cPickle
+import hashlib
 from .saferscanner import SaferScanner
 
 class LexingError(Exception):
@@ -35,7 +39,9 @@ class LexingError(Exception):
     def __str__(self):
         return '%s at line %d, char %d' % (self.msg, self.linenum, self.charnum)
 
-class Hint:
+class Hint(object):
+    __slots__ = ('text',)
+
     def __init__(self, text):
         self.text = text
 
@@ -46,23 +52,43 @@ class Hint:
         return isinstance(other, self.__class__) and other.text == self.text
 
     def __repr__(self):
-        return '%s(%r)' % (self.__class__, self.text)
+        return '%s.%s(%r)' % (self.__class__.__module__, self.__class__.__name__,
+                                self.text)
 
 def is_hint(x):
     return isinstance(x, Hint)
 
-class ParseContext:
+class ParseContext(object):
     """
     These are meant to be immutable, although it would be something of a
     pain to enforce that in python.
+
+    The tokens matched so far, and those remaining, are kept as positions
+    in the tokens being parsed, so that matching a token doesn't copy them
+    all; matched and remainder slice them out when asked for.
     """
 
-    def __init__(self, ruleset, bindings, matched, remainder, productionname):
+    def __init__(self, ruleset, bindings, tokens, start, pos, productionname, memo=None):
         self.ruleset = ruleset
         self.bindings = bindings
-        self.matched = matched
-        self.remainder = remainder
+        self.tokens = tokens
+        self.start = start
+        self.pos = pos
         self.productionname = productionname
+        self.memo = memo
+
+    @property
+    def matched(self):
+        return self.tokens[self.start:self.pos]
+
+    @property
+    def remainder(self):
+        return self.tokens[self.pos:]
+
+    def next_token(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
 
     def get_production_by_name(self, name):
         return self.ruleset[name]
@@ -76,17 +102,36 @@ class ParseContext:
     def with_binding(self, name, val):
         newbinds = self.bindings.copy()
         newbinds[name] = val
-        return self.__class__(self.ruleset, newbinds, self.matched,
-                              self.remainder, self.productionname)
+        return self.__class__(self.ruleset, newbinds, self.tokens, self.start,
+                              self.pos, self.productionname, self.memo)
 
     def with_match(self, num):
-        return self.__class__(self.ruleset, self.bindings,
-                              self.matched + self.remainder[:num],
-                              self.remainder[num:], self.productionname)
+        if self.memo is not None and self.pos + num == len(self.tokens):
+            self.memo.ends_reached += 1
+        return self.__class__(self.ruleset, self.bindings, self.tokens, self.start,
+                              self.pos + num, self.productionname, self.memo)
 
     def with_production_named(self, newname):
-        return self.__class__(self.ruleset, self.bindings, self.matched,
-                              self.remainder, newname)
+        return self.__class__(self.ruleset, self.bindings, self.tokens, self.start,
+                              self.pos, newname, self.memo)
+
+    def with_memoized_match(self, num, binding_changes):
+        """
+        This context, having matched num more tokens with something that
+        made the given changes (from PackratMemo.binding_changes) to the
+        bindings.
+        """
+
+        newbinds = self.bindings
+        if binding_changes:
+            newbinds = newbinds.copy()
+            for name, val in binding_changes:
+                if isinstance(val, tuple):
+                    # from a named_collector, which adds to what's there
+                    val = newbinds.get(name, ()) + val
+                newbinds[name] = val
+        return self.__class__(self.ruleset, newbinds, self.tokens, self.start,
+                              self.pos + num, self.productionname, self.memo)
 
     def extract_orig(self, tokens=None):
         if tokens is None:
@@ -104,6 +149,70 @@ class ParseContext:
         return '<%s matched=%r remainder=%r prodname=%r bindings=%r>' \
                % (self.__class__.__name__, self.matched, self.remainder, self.productionname, self.bindings)
 
+class PackratMemo:
+    """
+    Remembers, for one parse or completion, what each production matched
+    at each token position, so that rule_reference can hand that back when
+    the production is tried at the same position again (by another
+    alternative of a choice, say) instead of matching it all over again.
+
+    Productions are matched for the memo starting from the initial
+    bindings, and what's remembered is how many tokens each match took
+    and what it changed in the bindings, so the results can be replayed
+    on top of whatever bindings the context has each time. Nothing but
+    completers looks at the bindings while matching, so they don't affect
+    what matches.
+
+    When completing, productions which get as far as the end of the
+    tokens (where completions are collected, using the bindings) aren't
+    remembered, and are matched the usual way each time.
+    """
+
+    def __init__(self, ruleset, tokens, bindings):
+        self.ruleset = ruleset
+        self.tokens = tokens
+        self.bindings = bindings
+        self.results = {}
+        # how many times a match has used up the last of the tokens
+        self.ends_reached = 0
+
+    def match(self, rule, name, ctxt, completions):
+        """
+        The results of matching the named production at ctxt, or None if
+        it has to be matched the usual way.
+        """
+
+        key = (name, ctxt.pos)
+        try:
+            found = self.results[key]
+        except KeyError:
+            found = self.results[key] = self.find_matches(rule, name, ctxt.pos, completions)
+        if found is None:
+            return None
+        return [ctxt.with_memoized_match(num, changes) for (num, changes) in found]
+
+    def find_matches(self, rule, name, pos, completions):
+        if completions is not None:
+            if pos == len(self.tokens):
+                return None
+            # nothing should be added here, but if anything is, this
+            # production reached the end, and none of it will be used
+            completions = set()
+        ends_before = self.ends_reached
+        start = ParseContext(self.ruleset, self.bindings, self.tokens, pos, pos, name, self)
+        output = rule.match(start, completions)
+        if completions is not None and self.ends_reached != ends_before:
+            return None
+        return [(c.pos - pos, self.binding_changes(c.bindings)) for c in output]
+
+    def binding_changes(self, bindings):
+        initial = self.bindings
+        if bindings is initial:
+            return ()
+        missing = object()
+        return [(name, val) for (name, val) in bindings.iteritems()
+                if initial.get(name, missing) is not val]
+
 class matcher:
     def __init__(self, arg):
         self.arg = arg
@@ -111,14 +220,27 @@ class matcher:
     def match(self, ctxt, completions):
         raise NotImplementedError
 
+    def first_set(self, firsts):
+        """
+        What a match of this can start with, given the same for each
+        production in firsts (see ParsingRuleSet.find_first_sets): the set
+        of token types and lowercased token texts it can start with, or
+        None if that could be anything, and whether it can match without
+        using up any tokens at all.
+        """
+
+        return None, True
+
+    def set_lookahead(self, firsts):
+        pass
+
     def match_with_results(self, ctxt, completions):
-        matched_before = len(ctxt.matched)
         newctxts = self.match(ctxt, completions)
-        return [(newctxt, newctxt.matched[matched_before:]) for newctxt in newctxts]
+        return [(newctxt, ctxt.tokens[ctxt.pos:newctxt.pos]) for newctxt in newctxts]
 
     @staticmethod
     def try_registered_completion(ctxt, symname, completions):
-        if ctxt.remainder or completions is None:
+        if ctxt.next_token() is not None or completions is None:
             return False
         try:
             completer = ctxt.get_completer(symname)
@@ -138,17 +260,61 @@ class matcher:
         return '%s(%r)' % (self.__class__.__name__, self.arg)
 
 class choice(matcher):
+    # for each alternative, the token types and lowercased token texts it
+    # can start with, or None where it has to be tried regardless
+    lookahead = None
+
     def match(self, ctxt, completions):
         foundctxts = []
-        for a in self.arg:
-            subctxts = a.match(ctxt, completions)
-            foundctxts.extend(subctxts)
+        tok = ctxt.next_token()
+        if tok is None or self.lookahead is None:
+            for a in self.arg:
+                foundctxts.extend(a.match(ctxt, completions))
+            return foundctxts
+        toktype = tok[0]
+        toktext = tok[1].lower()
+        for a, starts in zip(self.arg, self.lookahead):
+            if starts is None or toktype in starts or toktext in starts:
+                foundctxts.extend(a.match(ctxt, completions))
         return foundctxts
 
+    def first_set(self, firsts):
+        starts = frozenset()
+        nullable = False
+        for a in self.arg:
+            substarts, subnullable = a.first_set(firsts)
+            if substarts is None:
+                starts = None
+            elif starts is not None:
+                starts = starts | substarts
+            nullable = nullable or subnullable
+        return starts, nullable
+
+    def set_lookahead(self, firsts):
+        for a in self.arg:
+            a.set_lookahead(firsts)
+        if firsts is None:
+            # try every alternative
+            self.lookahead = None
+            return
+        lookahead = []
+        for a in self.arg:
+            starts, nullable = a.first_set(firsts)
+            if nullable:
+                starts = None
+            lookahead.append(starts)
+        self.lookahead = lookahead
+
 class one_or_none(matcher):
     def match(self, ctxt, completions):
         return [ctxt] + list(self.arg.match(ctxt, completions))
 
+    def first_set(self, firsts):
+        return self.arg.first_set(firsts)[0], True
+
+    def set_lookahead(self, firsts):
+        self.arg.set_lookahead(firsts)
+
 class repeat(matcher):
     def match(self, ctxt, completions):
         found = [ctxt]
@@ -162,6 +328,12 @@ class repeat(matcher):
             found.extend(new_ctxts)
             ctxts = new_ctxts
 
+    def first_set(self, firsts):
+        return self.arg.first_set(firsts)[0], True
+
+    def set_lookahead(self, firsts):
+        self.arg.set_lookahead(firsts)
+
 class rule_reference(matcher):
     def match(self, ctxt, completions):
         prevname = ctxt.productionname
@@ -169,9 +341,18 @@ class rule_reference(matcher):
             rule = ctxt.get_production_by_name(self.arg)
         except KeyError:
             raise ValueError("Can't look up production rule named %r" % (self.arg,))
+        if ctxt.memo is not None and not isinstance(rule, terminal_type_matcher):
+            # (terminals are quicker to match than to look up)
+            output = ctxt.memo.match(rule, self.arg, ctxt, completions)
+            if output is not None:
+                return output
         output = rule.match(ctxt.with_production_named(self.arg), completions)
         return [c.with_production_named(prevname) for c in output]
 
+    def first_set(self, firsts):
+        # an unknown production gets tried, to complain about it
+        return firsts.get(self.arg, (None, True))
+
 class rule_series(matcher):
     def match(self, ctxt, completions):
         ctxts = [ctxt]
@@ -184,6 +365,22 @@ class rule_series(matcher):
             ctxts = new_ctxts
         return ctxts
 
+    def first_set(self, firsts):
+        starts = frozenset()
+        for patpiece in self.arg:
+            substarts, subnullable = patpiece.first_set(firsts)
+            if substarts is None:
+                starts = None
+            elif starts is not None:
+                starts = starts | substarts
+            if not subnullable:
+                return starts, False
+        return starts, True
+
+    def set_lookahead(self, firsts):
+        for patpiece in self.arg:
+            patpiece.set_lookahead(firsts)
+
 class named_symbol(matcher):
     def __init__(self, name, arg):
         matcher.__init__(self, arg)
@@ -197,6 +394,12 @@ class named_symbol(matcher):
         results = self.arg.match_with_results(ctxt, pass_in_compls)
         return [c.with_binding(self.name, ctxt.extract_orig(matchtoks)) for (c, matchtoks) in results]
 
+    def first_set(self, firsts):
+        return self.arg.first_set(firsts)
+
+    def set_lookahead(self, firsts):
+        self.arg.set_lookahead(firsts)
+
     def __repr__(self):
         return '%s(%r, %r)' % (self.__class__.__name__, self.name, self.arg)
 
@@ -220,16 +423,24 @@ class regex_rule(terminal_matcher):
     def __init__(self, pat):
         terminal_matcher.__init__(self, pat)
         self.regex = pat
-        self.re = re.compile(pat + '$', re.I | re.S)
+        # compiled when first needed. most of these are lexer terminals,
+        # which are only matched directly when completing
+        self.re = None
 
     def match(self, ctxt, completions):
-        if ctxt.remainder:
-            if self.re.match(ctxt.remainder[0][1]):
+        tok = ctxt.next_token()
+        if tok is not None:
+            if self.re is None:
+                self.re = re.compile(self.regex + '$', re.I | re.S)
+            if self.re.match(tok[1]):
                 return [ctxt.with_match(1)]
         elif completions is not None:
             completions.add(Hint('<%s>' % ctxt.productionname))
         return []
 
+    def first_set(self, firsts):
+        return None, False
+
     def pattern(self):
         return self.regex
 
@@ -243,13 +454,17 @@ class text_match(terminal_matcher):
             print "bad syntax %r" % (text,)
 
     def match(self, ctxt, completions):
-        if ctxt.remainder:
-            if self.arg.lower() == ctxt.remainder[0][1].lower():
+        tok = ctxt.next_token()
+        if tok is not None:
+            if self.arg.lower() == tok[1].lower():
                 return [ctxt.with_match(1)]
         elif completions is not None:
             completions.add(self.arg)
         return []
 
+    def first_set(self, firsts):
+        return frozenset((self.arg.lower(),)), False
+
     def pattern(self):
         # can't use (?i) here- Scanner component regex flags won't be applied
         def ignorecaseify(matchobj):
@@ -259,8 +474,9 @@ class text_match(terminal_matcher):
 
 class case_match(text_match):
     def match(self, ctxt, completions):
-        if ctxt.remainder:
-            if self.arg == ctxt.remainder[0][1]:
+        tok = ctxt.next_token()
+        if tok is not None:
+            if self.arg == tok[1]:
                 return [ctxt.with_match(1)]
         elif completions is not None:
             completions.add(self.arg)
@@ -284,13 +500,109 @@ class terminal_type_matcher(matcher):
         self.submatcher = submatcher
 
     def match(self, ctxt, completions):
-        if ctxt.remainder:
-            if ctxt.remainder[0][0] == self.tokentype:
+        tok = ctxt.next_token()
+        if tok is not None:
+            if tok[0] == self.tokentype:
                 return [ctxt.with_match(1)]
         elif completions is not None:
             self.submatcher.match(ctxt, completions)
         return []
 
+    def first_set(self, firsts):
+        return frozenset((self.tokentype,)), False
+
+def source_digest(modules):
+    """
+    A hash of the source files of the given modules, or None if they can't
+    be read.
+    """
+
+    digest = hashlib.sha1()
+    for mod in modules:
+        fname = mod.__file__
+        if fname[-4:] in ('.pyc', '.pyo'):
+            fname = fname[:-1]
+        for name in (fname, mod.__file__):
+            try:
+                f = open(name, 'rb')
+                try:
+                    digest.update(f.read())
+                finally:
+                    f.close()
+                break
+            except IOError:
+                pass
+        else:
+            return None
+    return digest.hexdigest()
+
+class GrammarCache:
+    """
+    Keeps things worked out from grammar rules, like parsed rules, in
+    files under dirname. Each is named for a hash of
+    the text it was worked out from and of the code that works it out, so a
+    later run can load it instead of working it out again, and changed
+    rules or code just get new files.
+
+    Anything that can't be read back is made again (and the file it was in
+    removed), and anything that can't be written is just not kept. If the
+    code's own source can't be read, nothing is kept.
+    """
+
+    # the modules whose classes end up in what gets kept
+    code_modules = (sys.modules[__name__],)
+    code_digest = None
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        if GrammarCache.code_digest is None:
+            GrammarCache.code_digest = source_digest(self.code_modules) or ''
+
+    def filename(self, kind, text):
+        keytext = '%s %s %s\n%s' % (kind, self.code_digest, sys.version, text)
+        return os.path.join(self.dirname, '%s-%s' % (kind, hashlib.sha1(keytext).hexdigest()))
+
+    def get(self, kind, text, make):
+        if not self.code_digest:
+            return make()
+        fname = self.filename(kind, text)
+        try:
+            f = open(fname, 'rb')
+        except IOError:
+            f = None
+        if f is not None:
+            try:
+                try:
+                    return cPickle.load(f)
+                finally:
+                    f.close()
+            except Exception:
+                # corrupt, or not loadable by this code; make it again
+                self.remove(fname)
+        val = make()
+        self.put(fname, val)
+        return val
+
+    def remove(self, fname):
+        try:
+            os.unlink(fname)
+        except OSError:
+            pass
+
+    def put(self, fname, val):
+        tmpname = '%s.%d.tmp' % (fname, os.getpid())
+        try:
+            if not os.path.isdir(self.dirname):
+                os.makedirs(self.dirname, 0700)
+            f = open(tmpname, 'wb')
+            try:
+                cPickle.dump(val, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmpname, fname)
+        except Exception:
+            self.remove(tmpname)
+
 class ParsingRuleSet:
     RuleSpecScanner = SaferScanner([
         (r'::=', lambda s,t: t),
@@ -305,15 +617,33 @@ class ParsingRuleSet:
         (r'#[^\n]*', None),
     ], re.I | re.S)
 
+    # whether to remember what productions matched where, during a parse
+    # or completion (see PackratMemo). the cql grammars' choices mostly
+    # fail on their first token, so there's little matching to save, and
+    # keeping the memo costs more than that.
+    packrat = False
+
+    # whether choices skip the alternatives which can't start with the next
+    # token (see find_first_sets). it's only worth turning off to check
+    # that doing so changes nothing
+    use_lookahead = True
+
+    # where to keep parsed rules between runs (see GrammarCache), or None
+    # not to
+    cache_dir = None
+
     def __init__(self):
         self.ruleset = {}
         self.scanner = None
         self.terminals = []
+        self.first_sets = {}
+        self.pending_rules = []
 
     @classmethod
     def from_rule_defs(cls, rule_defs):
         prs = cls()
         prs.ruleset, prs.terminals = cls.parse_rules(rule_defs)
+        prs.find_first_sets()
         return prs
 
     @classmethod
@@ -403,11 +733,56 @@ class ParsingRuleSet:
         raise ValueError('Unexpected end of rule tokens')
 
     def append_rules(self, rulestr):
-        rules, terminals = self.parse_rules(rulestr)
-        self.ruleset.update(rules)
-        self.terminals.extend(terminals)
-        if terminals:
-            self.scanner = None  # recreate it if/when necessary
+        # these aren't parsed until something needs them, so that a
+        # program only pays for the rulesets it actually uses
+        self.pending_rules.append(rulestr)
+
+    def grammar_cache(self):
+        if self.cache_dir is None:
+            return None
+        return GrammarCache(self.cache_dir)
+
+    def load_rules(self):
+        if not self.pending_rules:
+            return
+        cache = self.grammar_cache()
+        for rulestr in self.pending_rules:
+            if cache is None:
+                rules, terminals = self.parse_rules(rulestr)
+            else:
+                rules, terminals = cache.get('rules', rulestr, partial(self.parse_rules, rulestr))
+            self.ruleset.update(rules)
+            self.terminals.extend(terminals)
+            if terminals:
+                self.scanner = None  # recreate it if/when necessary
+        self.pending_rules = []
+        # new rules can change what the old ones start with
+        self.find_first_sets()
+
+    def find_first_sets(self):
+        """
+        Work out what each production can start with (see
+        matcher.first_set), and tell each choice what its alternatives can
+        start with, so it only has to try the ones which could match the
+        next token (unless use_lookahead is off, when they try them all).
+        """
+
+        names = [name for name in self.ruleset if isinstance(name, basestring)]
+        firsts = dict((name, (frozenset(), False)) for name in names)
+        # productions can refer to each other in circles, so go until
+        # nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for name in names:
+                newfirst = self.ruleset[name].first_set(firsts)
+                if newfirst != firsts[name]:
+                    firsts[name] = newfirst
+                    changed = True
+        lookahead_firsts = firsts if self.use_lookahead else None
+        for name in names:
+            self.ruleset[name].set_lookahead(lookahead_firsts)
+        self.first_sets = firsts
 
     def register_completer(self, func, rulename, symname):
         self.ruleset[(rulename, symname)] = func
@@ -421,6 +796,7 @@ class ParsingRuleSet:
         return SaferScanner(regexes, re.I | re.S).scan
 
     def lex(self, text):
+        self.load_rules()
         if self.scanner is None:
             self.scanner = self.make_lexer()
         tokens, unmatched = self.scanner(text)
@@ -428,10 +804,18 @@ class ParsingRuleSet:
             raise LexingError.from_text(text, unmatched, 'text could not be lexed')
         return tokens
 
+    def start_context(self, startsymbol, tokens, init_bindings):
+        self.load_rules()
+        tokens = tuple(tokens)
+        memo = None
+        if self.packrat:
+            memo = PackratMemo(self.ruleset, tokens, init_bindings)
+        return ParseContext(self.ruleset, init_bindings, tokens, 0, 0, startsymbol, memo)
+
     def parse(self, startsymbol, tokens, init_bindings=None):
         if init_bindings is None:
             init_bindings = {}
-        ctxt = ParseContext(self.ruleset, init_bindings, (), tuple(tokens), startsymbol)
+        ctxt = self.start_context(startsymbol, tokens, init_bindings)
         pattern = self.ruleset[startsymbol]
         return pattern.match(ctxt, None)
 
@@ -453,7 +837,7 @@ class ParsingRuleSet:
     def complete(self, startsymbol, tokens, init_bindings=None):
         if init_bindings is None:
             init_bindings = {}
-        ctxt = ParseContext(self.ruleset, init_bindings, (), tuple(tokens), startsymbol)
+        ctxt = self.start_context(startsymbol, tokens, init_bindings)
         pattern = self.ruleset[startsymbol]
         if init_bindings.get('*DEBUG*', False):
             completions = Debugotron(stream=sys.stderr)
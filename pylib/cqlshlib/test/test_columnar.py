@@ -0,0 +1,61 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from cql.cqltypes import lookup_casstype
+from cqlshlib import columnar
+
+class TestColumnarRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def round_trip(self, casstypes, rows):
+        colnames = ['c%d' % n for n in range(len(casstypes))]
+        writer = columnar.ColumnarWriter(self.tmpdir, colnames,
+                                         map(lookup_casstype, casstypes))
+        writer.writerows(rows)
+        writer.finish()
+        table = columnar.ColumnarTable(self.tmpdir)
+        try:
+            return list(table)
+        finally:
+            table.close()
+
+    def test_falsy_values(self):
+        rows = [(-0.0, 0, False, u'', ''), (None, None, None, None, None)]
+        readback = self.round_trip(['DoubleType', 'Int32Type', 'BooleanType', 'UTF8Type',
+                                    'BytesType'], rows)
+        self.assertEqual(readback, rows)
+        self.assertEqual(math.copysign(1, readback[0][0]), -1)
+
+    def test_collections(self):
+        # varints and decimals of zero, and timestamps, which the driver's
+        # serializers get wrong inside collections
+        rows = [((0, -1, 10 ** 20), set([0.0, 1.5]), {Decimal(0): 1234567.891}),
+                ((), set(), {})]
+        readback = self.round_trip(['ListType(IntegerType)', 'SetType(DateType)',
+                                    'MapType(DecimalType,DateType)'], rows)
+        self.assertEqual(readback, rows)
+
+if __name__ == '__main__':
+    unittest.main()
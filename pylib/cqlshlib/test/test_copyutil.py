@@ -0,0 +1,887 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# run with "python -m unittest discover" from pylib, or with nosetests
+
+import bz2
+import csv
+import gzip
+import os
+import pickle
+import re
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+import zlib
+from collections import deque
+from cStringIO import StringIO
+from decimal import Decimal
+import cql
+from cql.cqltypes import lookup_casstype
+from cqlshlib import copyutil
+
+# what COPY uses when no QUOTE, ESCAPE or DELIMITER is given
+default_dialect = dict(delimiter=',', doublequote=False, escapechar='\\', quotechar='"')
+
+class FakeTableCursor:
+    """
+    Runs the queries a TokenPager makes against a table of (k, c, ...) rows,
+    with partition key k standing in for its own token, and clustering
+    columns c and d. With desc, rows are sorted by c descending within a
+    partition.
+    """
+
+    token_re = re.compile(r"token\(k\) (>|<=) (?:'(-?\d+)'|(-?\d+)|token\(:k0\))")
+    clustering_re = re.compile(r"\b([cd]) (=|<|>) :(c\d)")
+    colindexes = dict(c=1, d=2)
+
+    def __init__(self, rows, desc=False):
+        if desc:
+            self.rows = sorted(rows, key=lambda r: (r[0], -r[1]) + r[2:])
+        else:
+            self.rows = sorted(rows)
+        self.queries = []
+        self.column_types = [lookup_casstype('Int32Type')] * 2
+
+    def prepare_query(self, query):
+        return query
+
+    def execute(self, query, params={}):
+        self.queries.append(query)
+        rows = self.rows
+        for op, quoted, bare in self.token_re.findall(query):
+            bound = int(quoted or bare or params.get('k0', 0))
+            if op == '>':
+                rows = [r for r in rows if r[0] > bound]
+            else:
+                rows = [r for r in rows if r[0] <= bound]
+        if 'k = :k0' in query:
+            rows = [r for r in rows if r[0] == params['k0']]
+        for col, op, param in self.clustering_re.findall(query):
+            n, val = self.colindexes[col], params[param]
+            if op == '=':
+                rows = [r for r in rows if r[n] == val]
+            elif op == '>':
+                rows = [r for r in rows if r[n] > val]
+            else:
+                rows = [r for r in rows if r[n] < val]
+        limit = int(re.search(r'LIMIT (\d+)$', query).group(1))
+        self.result = rows[:limit]
+
+    execute_prepared = execute
+
+    def fetchall(self):
+        return self.result
+
+class TestTokenPager(unittest.TestCase):
+    rows = [(1, 0), (2, 0), (2, 1), (3, 0), (3, 1), (3, 2), (3, 3), (3, 4), (4, 0), (5, 0),
+            (5, 1), (6, 0)]
+
+    def pages(self, pagesize, start=None, end=None, partitioner=None):
+        self.cursor = FakeTableCursor(self.rows)
+        pager = copyutil.TokenPager(self.cursor, 'SELECT k, c FROM t', ['k'], [0], pagesize,
+                                    start, end, partitioner)
+        return list(pager.pages())
+
+    def test_whole_table(self):
+        for pagesize in (1, 2, 3, 5, 100):
+            pages = self.pages(pagesize)
+            self.assertEqual([r for page in pages for r in page], self.rows)
+
+    def test_partitions_not_split(self):
+        # the last partition in a full page is held back for the next one,
+        # and a partition too big for a page is read by itself
+        pages = self.pages(3)
+        self.assertEqual(pages, [[(1, 0)], [(2, 0), (2, 1)],
+                                 [(3, 0), (3, 1), (3, 2), (3, 3), (3, 4)],
+                                 [(4, 0)], [(5, 0), (5, 1)], [(6, 0)]])
+
+    def test_range(self):
+        pages = self.pages(2, '2', '5')
+        self.assertEqual([r for page in pages for r in page],
+                         [r for r in self.rows if 2 < r[0] <= 5])
+
+    def test_numeric_tokens(self):
+        pages = self.pages(100, '-1', '5', 'org.apache.cassandra.dht.Murmur3Partitioner')
+        self.assertEqual(self.cursor.queries,
+                         ['SELECT k, c FROM t WHERE token(k) > -1 AND token(k) <= 5 LIMIT 100'])
+        self.assertEqual([r for page in pages for r in page],
+                         [r for r in self.rows if r[0] <= 5])
+        self.pages(100, '-9223372036854775808', None,
+                   'org.apache.cassandra.dht.Murmur3Partitioner')
+        self.assertEqual(self.cursor.queries,
+                         ['SELECT k, c FROM t WHERE token(k) > -9223372036854775808 LIMIT 100'])
+        self.pages(100, None, '85070591730234615865843651857942052864',
+                   'org.apache.cassandra.dht.RandomPartitioner')
+        self.assertEqual(self.cursor.queries,
+                         ['SELECT k, c FROM t WHERE token(k) <= '
+                          '85070591730234615865843651857942052864 LIMIT 100'])
+
+    def test_big_partitions(self):
+        # partitions bigger than a page are read a page at a time by
+        # clustering key
+        rows = [(1, 0)] + [(2, c) for c in range(10)] + [(3, 0), (3, 1)]
+        for desc in (False, True):
+            cursor = FakeTableCursor(rows, desc)
+            pager = copyutil.TokenPager(cursor, 'SELECT k, c FROM t', ['k'], [0], 3,
+                                        clustering=[('c', 1, desc)])
+            pages = list(pager.pages())
+            self.assert_(all(len(page) <= 3 for page in pages))
+            self.assertEqual([r for page in pages for r in page], cursor.rows)
+            self.failIf([q for q in cursor.queries if 'LIMIT 2000000000' in q])
+
+    def test_two_clustering_columns(self):
+        rows = [(1, c, d) for c in range(4) for d in range(3)] + [(2, 0, 0)]
+        cursor = FakeTableCursor(rows)
+        pager = copyutil.TokenPager(cursor, 'SELECT k, c, d FROM t', ['k'], [0], 4,
+                                    clustering=[('c', 1, False), ('d', 2, False)])
+        pages = list(pager.pages())
+        self.assert_(all(len(page) <= 4 for page in pages))
+        self.assertEqual([r for page in pages for r in page], sorted(rows))
+        self.assert_('SELECT k, c, d FROM t WHERE k = :k0 AND c = :c0 AND d > :c1 LIMIT 4'
+                     in cursor.queries)
+        self.assert_('SELECT k, c, d FROM t WHERE k = :k0 AND c > :c0 LIMIT 4'
+                     in cursor.queries)
+
+    def test_string_tokens(self):
+        self.pages(100, '2', '5', 'org.apache.cassandra.dht.ByteOrderedPartitioner')
+        self.assertEqual(self.cursor.queries,
+                         ["SELECT k, c FROM t WHERE token(k) > '2' AND token(k) <= '5' LIMIT 100"])
+
+class TestRowFormatter(unittest.TestCase):
+    def test_format_rows(self):
+        coltypes = map(lookup_casstype, ['Int32Type', 'UTF8Type', 'DoubleType'])
+        formatter = copyutil.RowFormatter('utf8', 'NULL', '%Y', 2)
+        rows = [[1, u'a\tb', 0.125], [2, None, None]]
+        self.assertEqual(formatter.format_rows(rows, coltypes),
+                         [['1', 'a\\tb', '0.12'], ['2', 'NULL', 'NULL']])
+
+    def test_formatters_reused(self):
+        formatter = copyutil.RowFormatter('utf8', '', '%Y', 5)
+        coltypes = map(lookup_casstype, ['Int32Type', 'UTF8Type'])
+        formatters = formatter.formatters_for(coltypes)
+        self.assert_(formatter.formatters_for(list(coltypes)) is formatters)
+        other = formatter.formatters_for(coltypes[::-1])
+        self.assert_(other is not formatters)
+        self.assertEqual([f(v) for (f, v) in zip(other, [u'x', 3])], ['x', '3'])
+
+    def test_picklable(self):
+        formatter = copyutil.RowFormatter('utf8', '', '%Y', 5)
+        formatter.formatters_for([lookup_casstype('Int32Type')])
+        copied = pickle.loads(pickle.dumps(formatter))
+        self.assertEqual(copied.format_rows([[4]], [lookup_casstype('Int32Type')]), [['4']])
+
+class TestRawRoundTrip(unittest.TestCase):
+    awkward_text = [
+        u'back\\slash',
+        u'trail\\',
+        u'\\',
+        u'"quoted"',
+        u'it\'s',
+        u'new\nline',
+        u'cr\r\nlf',
+        u'com,ma',
+        u'\\"',
+        u'\u00fc\\',
+    ]
+
+    def round_trip(self, casstypes, rows, dialect=default_dialect):
+        coltypes = map(lookup_casstype, casstypes)
+        formatter = copyutil.RawRowFormatter('utf8', '', dialect.get('escapechar'))
+        out = StringIO()
+        csv.writer(out, **dialect).writerows(formatter.format_rows(rows, coltypes))
+        parsers = map(copyutil.parser_for_type, coltypes)
+        readback = []
+        for record in csv.reader(StringIO(out.getvalue()), **dialect):
+            self.assertEqual(len(record), len(parsers))
+            readback.append([parse(field) for (parse, field) in zip(parsers, record)])
+        return readback
+
+    def test_text(self):
+        rows = [[t] for t in self.awkward_text]
+        self.assertEqual(self.round_trip(['UTF8Type'], rows), rows)
+
+    def test_ascii(self):
+        rows = [[t] for t in ['back\\slash', 'trail\\', '"q"', 'new\nline', 'x\\"']]
+        self.assertEqual(self.round_trip(['AsciiType'], rows), rows)
+
+    def test_several_columns(self):
+        rows = [self.awkward_text[n:n + 3] for n in range(len(self.awkward_text) - 2)]
+        self.assertEqual(self.round_trip(['UTF8Type'] * 3, rows), rows)
+
+    def test_collections(self):
+        types = ['ListType(UTF8Type)', 'MapType(UTF8Type,UTF8Type)']
+        rows = [[[u'a\\', u'"b"\n'], {u'k\\': u'v\\', u'it\'s': u'\\'}]]
+        self.assertEqual(self.round_trip(types, rows), rows)
+
+    def test_doublequote_dialect(self):
+        dialect = dict(delimiter=',', doublequote=True, quotechar='"')
+        rows = [[t] for t in self.awkward_text]
+        self.assertEqual(self.round_trip(['UTF8Type'], rows, dialect), rows)
+
+    def test_other_escapechar(self):
+        dialect = dict(default_dialect, escapechar='|')
+        rows = [[t] for t in self.awkward_text + [u'pi|pe|', u'|']]
+        self.assertEqual(self.round_trip(['UTF8Type'], rows, dialect), rows)
+
+class TestConverters(unittest.TestCase):
+    def convert(self, casstype, fields):
+        cqltype = lookup_casstype(casstype)
+        convert = copyutil.converter_for_type(cqltype)
+        return [cqltype.deserialize(convert(field)) for field in fields]
+
+    def test_varint(self):
+        fields = ['0', '-1', '127', '128', '-128', '-129', '123456789012345678901234567890',
+                  '-123456789012345678901234567890']
+        self.assertEqual(self.convert('IntegerType', fields), map(int, fields))
+        self.assertEqual(copyutil.converter_for_type(lookup_casstype('IntegerType'))('0'),
+                         '\x00')
+
+    def test_decimal(self):
+        fields = ['0', '0.0', '-0.5', '-1', '1.25', '12345678901234567890.0987654321',
+                  '-12345678901234567890.0987654321']
+        self.assertEqual(self.convert('DecimalType', fields), map(Decimal, fields))
+        self.assertEqual(copyutil.converter_for_type(lookup_casstype('DecimalType'))('0.0'),
+                         '\x00\x00\x00\x01\x00')
+
+    def test_collection_items(self):
+        self.assertEqual(self.convert('ListType(IntegerType)', ['[0, -1, 99999999999]']),
+                         [(0, -1, 99999999999)])
+        self.assertEqual(self.convert('SetType(DecimalType)', ['{0.0, -2.5}']),
+                         [set([Decimal('0.0'), Decimal('-2.5')])])
+        self.assertEqual(self.convert('MapType(IntegerType,DateType)', ['{0: 1000}']),
+                         [{0: 1.0}])
+
+class TestTimestamps(unittest.TestCase):
+    def setUp(self):
+        self.oldtz = os.environ.get('TZ')
+        # US eastern time, without needing the zoneinfo files
+        os.environ['TZ'] = 'EST+05EDT,M3.2.0,M11.1.0'
+        time.tzset()
+
+    def tearDown(self):
+        if self.oldtz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.oldtz
+        time.tzset()
+
+    def test_formats(self):
+        parse = copyutil.parse_timestamp
+        self.assertEqual(parse('1341144000000'), 1341144000.0)
+        self.assertEqual(parse('2012-07-01 12:00:00+0000'), 1341144000)
+        self.assertEqual(parse('2012-07-01T14:00+0200'), 1341144000)
+        self.assertEqual(parse('2012-07-01 07:30-0430'), 1341144000)
+        self.assert_(abs(parse('now') - time.time()) < 60)
+        self.assertRaises(ValueError, parse, 'July 1st')
+
+    def test_local_time_follows_dst(self):
+        parse = copyutil.parse_timestamp
+        self.assertEqual(parse('2012-07-01 08:00'), 1341144000)
+        self.assertEqual(parse('2012-01-01 07:00'), 1325419200)
+        self.assertEqual(parse('2012-01-01'), 1325394000)
+
+    def test_timeuuid(self):
+        parse = copyutil.parse_timeuuid
+        u = parse('2012-07-01 12:00+0000')
+        self.assertEqual(u.version, 1)
+        self.assertEqual(u.time, 1341144000 * 10000000 + copyutil.UUID_EPOCH_OFFSET)
+        self.assertNotEqual(parse('1341144000000'), u)
+        self.assertEqual(parse('now').version, 1)
+        self.assertEqual(parse(str(u)), u)
+        self.assertRaises(ValueError, parse, '4a9b6f2c-66c4-4b6a-9b7e-3f1f0b2c6d11')
+
+class FakePrepared:
+    def __init__(self, itemid, query):
+        self.itemid = itemid
+        self.query = query
+
+class FakeCursor:
+    def __init__(self):
+        self.prepared = []
+
+    def prepare_query(self, query):
+        self.prepared.append(FakePrepared(len(self.prepared), query))
+        return self.prepared[-1]
+
+    def handle_cql_execution_errors(self, executor, *args):
+        return executor(*args)
+
+class FakeClient:
+    """
+    Takes pipelined execute_prepared_cql_query calls, answering them in the
+    order they were sent, and failing the ones with a 'bad' value.
+    """
+
+    def __init__(self):
+        self.unanswered = deque()
+        self.most_unanswered = 0
+
+    def send_execute_prepared_cql_query(self, itemid, values):
+        self.unanswered.append(values)
+        self.most_unanswered = max(self.most_unanswered, len(self.unanswered))
+
+    def recv_execute_prepared_cql_query(self):
+        if 'bad' in self.unanswered.popleft():
+            raise cql.ProgrammingError('Bad Request: bad value')
+
+class FakeConn:
+    def __init__(self):
+        self.client = FakeClient()
+        self.cursors = []
+
+    def cursor(self):
+        self.cursors.append(FakeCursor())
+        return self.cursors[-1]
+
+    def close(self):
+        pass
+
+class FakeConnParams:
+    host = 'localhost'
+
+    def connect(self):
+        return FakeConn()
+
+class TestJSONLinesNulls(unittest.TestCase):
+    insertq = 'INSERT INTO ks.t (%s) VALUES (%s)'
+    colnames = ['k', 'a', 'b']
+    casstypes = ['UTF8Type', 'UTF8Type', 'BytesType']
+    lines = [
+        '{"k": "x", "a": null, "b": "00ff"}',
+        '{"k": "y", "a": "", "b": ""}',
+        '{"k": "z"}',
+    ]
+
+    def read(self, coltypes=None):
+        return list(copyutil.JSONLinesReader(self.lines, self.colnames, coltypes))
+
+    def test_reader(self):
+        coltypes = map(lookup_casstype, self.casstypes)
+        expected = [['x', None, '00ff'], ['y', '', ''], ['z', None, None]]
+        self.assertEqual(self.read(coltypes), expected)
+        self.assertEqual(self.read(), expected)
+
+    def test_literal_insert(self):
+        inserter = copyutil.LiteralInsert(self.insertq, self.colnames, self.colnames,
+                                          lambda val: "'%s'" % val)
+        self.assertEqual(map(inserter.convert_row, self.read()), [
+            "INSERT INTO ks.t (k, b) VALUES ('x', '00ff')",
+            "INSERT INTO ks.t (k, a, b) VALUES ('y', '', '')",
+            "INSERT INTO ks.t (k) VALUES ('z')",
+        ])
+
+    def test_prepared_insert(self):
+        coltypes = map(lookup_casstype, self.casstypes)
+        inserter = copyutil.PreparedInsert(self.insertq, self.colnames, self.colnames, coltypes)
+        rows = map(inserter.convert_row, self.read(coltypes))
+        self.assertEqual(rows, [['x', None, '\x00\xff'], ['y', '', ''], ['z', None, None]])
+        cursor = FakeCursor()
+        request = inserter.prepare(cursor)
+        sync = lambda: None
+        self.assertEqual(request(rows[1:2], sync), ('execute_prepared_cql_query', (0, ['y', '', ''])))
+        self.assertEqual(request(rows[:1], sync),
+                         ('execute_prepared_cql_query', (1, ['x', '\x00\xff'])))
+        self.assertEqual(cursor.prepared[1].query, 'INSERT INTO ks.t (k, b) VALUES (:r0c0, :r0c2)')
+        self.assertEqual(request(rows, sync),
+                         ('execute_prepared_cql_query', (2, ['x', '\x00\xff', 'y', '', '', 'z'])))
+        self.assertEqual(cursor.prepared[2].query,
+                         'BEGIN BATCH INSERT INTO ks.t (k, b) VALUES (:r0c0, :r0c2); '
+                         'INSERT INTO ks.t (k, a, b) VALUES (:r1c0, :r1c1, :r1c2); '
+                         'INSERT INTO ks.t (k) VALUES (:r2c0); APPLY BATCH')
+        self.assertEqual(inserter.row_size(rows[0]), 3)
+
+    def test_prepared_batch_shapes(self):
+        coltypes = map(lookup_casstype, self.casstypes)
+        inserter = copyutil.PreparedInsert(self.insertq, self.colnames, self.colnames, coltypes)
+        inserter.max_batch_shapes = 1
+        rows = [['k%d' % n] + [(n >> b) & 1 and 'ff' or None for b in range(2)]
+                for n in range(8)]
+        records = [(n, n + 1, row, inserter.convert_row(row)) for (n, row) in enumerate(rows)]
+        cursor = FakeCursor()
+        request = inserter.prepare(cursor)
+        sent = []
+        for n in range(0, len(records), 2):
+            for piece in inserter.split_batch(records[n:n + 2]):
+                sent.append(len(piece))
+                request([rec[3] for rec in piece], lambda: None)
+        self.assertEqual(sent, [2, 1, 1, 2, 1, 1])
+        # the full-row INSERT up front, the first batch, and a single row
+        # with just a null
+        self.assertEqual(len(cursor.prepared), 3)
+        self.assertEqual(inserter.split_batch(records[4:6]), [records[4:6]])
+
+class TestRowBatcher(unittest.TestCase):
+    def batches(self, batcher, rows, values=None):
+        if values is None:
+            values = [''] * len(rows)
+        records = [(n, n + 1, row, val) for (n, (row, val)) in enumerate(zip(rows, values))]
+        return [[rec[0] for rec in batch] for batch in batcher.batches(records, len)]
+
+    def test_one_at_a_time(self):
+        self.assertEqual(self.batches(copyutil.RowBatcher(), [['a'], ['b']]), [[0], [1]])
+
+    def test_partitions_together(self):
+        batcher = copyutil.RowBatcher(3, partkey_indexes=[0], primkey_indexes=[0, 1])
+        rows = [['p1', 'a'], ['p2', 'a'], ['p1', 'b'], ['p1', 'a'], ['p2', 'b']]
+        # the second p1/a can't share a batch with the first
+        self.assertEqual(self.batches(batcher, rows), [[0, 2], [3, 1, 4]])
+
+    def test_max_bytes(self):
+        batcher = copyutil.RowBatcher(10, max_bytes=5)
+        rows = [['a'], ['b'], ['c'], ['d']]
+        self.assertEqual(self.batches(batcher, rows, ['ab', 'ab', 'abcdefgh', 'a']),
+                         [[0, 1], [2], [3]])
+
+class BrokenClient(FakeClient):
+    def recv_execute_prepared_cql_query(self):
+        raise socket.error('connection reset')
+
+class TestInsertPipeline(unittest.TestCase):
+    def request(self, rows, sync):
+        return 'execute_prepared_cql_query', (0, rows)
+
+    def test_responses_match_requests(self):
+        conn = FakeConn()
+        pipeline = copyutil.InsertPipeline(conn, self.request, 2)
+        done = []
+        for tag, val in enumerate(['a', 'bad', 'c', 'd', 'bad']):
+            done.extend(pipeline.send([val], tag))
+            self.assert_(pipeline.pending() <= 2)
+        done.extend(pipeline.drain())
+        self.assertEqual(conn.client.most_unanswered, 2)
+        self.assertEqual([tag for (tag, err) in done], range(5))
+        self.assertEqual([tag for (tag, err) in done if err is not None], [1, 4])
+
+    def test_fallback(self):
+        conn = FakeConn()
+        conn.client = BrokenClient()
+        fallback_conn = FakeConn()
+        fallback = copyutil.InsertPipeline(fallback_conn, self.request, 4)
+        failures = []
+        pipeline = copyutil.InsertPipeline(conn, self.request, 2, fallback=fallback,
+                                           on_failure=lambda: failures.append(1))
+        done = []
+        for tag, val in enumerate(['a', 'b', 'c', 'd']):
+            done.extend(pipeline.send([val], tag))
+        done.extend(pipeline.drain())
+        self.assertEqual(failures, [1])
+        self.assertEqual(sorted(done), [(0, None), (1, None), (2, None), (3, None)])
+        self.assertEqual(pipeline.pending(), 0)
+
+    def test_no_fallback(self):
+        conn = FakeConn()
+        conn.client = BrokenClient()
+        pipeline = copyutil.InsertPipeline(conn, self.request, 2)
+        done = pipeline.send(['a'], 0) + pipeline.send(['b'], 1) + pipeline.send(['c'], 2)
+        done.extend(pipeline.drain())
+        self.assertEqual([tag for (tag, err) in done], [0, 1, 2])
+        self.failIf([err for (tag, err) in done if not isinstance(err, socket.error)])
+
+class FakeTokenRange:
+    def __init__(self, start_token, end_token, endpoints, rpc_endpoints=None):
+        self.start_token = start_token
+        self.end_token = end_token
+        self.endpoints = endpoints
+        self.rpc_endpoints = rpc_endpoints
+
+class TestTokens(unittest.TestCase):
+    def test_murmur3(self):
+        # tokens Cassandra gives these keys
+        for key, token in [('\x00\x00\x00\x01', -4069959284402364209),
+                           ('\x00\x00\x00\x02', -3248873570005575792),
+                           ('\x00\x00\x00\x03', 9010454139840013625),
+                           ('', 0),
+                           ('abc', -5434086359492102041),
+                           ('0123456789abcdefXYZ', -7362412312553418723),
+                           (''.join(map(chr, range(20, 60))), -965344887456225891)]:
+            self.assertEqual(copyutil.murmur3_token(key), token)
+
+    def test_md5(self):
+        self.assertEqual(copyutil.md5_token('abc'), 148866708576779697295343134153845407886L)
+        # negative as a BigInteger, so the absolute value
+        self.assertEqual(copyutil.md5_token('\x00\x00\x00\x01'),
+                         19580090105725936846312850328329299579L)
+
+    def test_routing_key(self):
+        self.assertEqual(copyutil.routing_key(['x', 'abc', None], [1]), 'abc')
+        self.assertEqual(copyutil.routing_key(['x', 'abc', 'de'], [1, 2]),
+                         '\x00\x03abc\x00\x00\x02de\x00')
+
+    def test_token_map(self):
+        ring = [FakeTokenRange('0', '100', ['b'], ['0.0.0.0']),
+                FakeTokenRange('100', '-50', ['c']),
+                FakeTokenRange('-50', '0', ['a'], ['10.0.0.1'])]
+        tokenmap = copyutil.TokenMap(ring)
+        self.assertEqual([tokenmap.replicas_for(t) for t in (-100, -50, -49, 0, 1, 100, 101)],
+                         [['c'], ['c'], ['10.0.0.1'], ['10.0.0.1'], ['b'], ['b'], ['c']])
+        self.assert_(tokenmap.same_ring(list(reversed(ring))))
+        self.failIf(tokenmap.same_ring(ring[:2]))
+
+class FakeTableConn(FakeConn):
+    def __init__(self, rows):
+        FakeConn.__init__(self)
+        self.rows = rows
+
+    def cursor(self):
+        return FakeTableCursor(self.rows)
+
+class FakeTableConnParams:
+    host = 'localhost'
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def for_host(self, host):
+        return self
+
+    def connect(self):
+        return FakeTableConn(self.rows)
+
+class FakeSplitsClient:
+    def __init__(self, splits):
+        self.splits = splits
+
+    def describe_splits(self, cfname, start, end, keys_per_split):
+        if (start, end) not in self.splits:
+            raise cql.OperationalError('no splits')
+        return self.splits[(start, end)]
+
+class TestRangeExport(unittest.TestCase):
+    murmur3 = 'org.apache.cassandra.dht.Murmur3Partitioner'
+
+    def test_unwrap_range(self):
+        self.assertEqual(copyutil.unwrap_range('-5', '10', self.murmur3), [('-5', '10')])
+        self.assertEqual(copyutil.unwrap_range('10', '-5', self.murmur3),
+                         [('10', None), (None, '-5')])
+        # compared as numbers, not strings
+        self.assertEqual(copyutil.unwrap_range('9', '10', self.murmur3), [('9', '10')])
+        self.assertEqual(copyutil.unwrap_range('b', 'a', 'ByteOrderedPartitioner'),
+                         [('b', None), (None, 'a')])
+
+    def test_split_ring(self):
+        ring = [FakeTokenRange('100', '-50', ['a']), FakeTokenRange('-50', '100', ['b'])]
+        client = FakeSplitsClient({('-50', '100'): ['-50', '0', '100']})
+        self.assertEqual(copyutil.split_ring(client, 't', ring, self.murmur3, 1000),
+                         [('100', None, ['a']), (None, '-50', ['a']),
+                          ('-50', '0', ['b']), ('0', '100', ['b'])])
+
+    def test_parallel_export(self):
+        if copyutil.multiprocessing is None:
+            return
+        rows = TestTokenPager.rows
+        export = copyutil.RangeExport(FakeTableConnParams(rows), 'SELECT k, c FROM t', ['k'],
+                                      [0], 2, 2, copyutil.RowFormatter('utf8', '', '%Y', 5),
+                                      copyutil.CSVOutput({}))
+        exporter = copyutil.ParallelExporter(export, 2)
+        out = StringIO()
+        try:
+            nrows, errors = exporter.run([(None, '2', [], None), ('2', '4', [], None),
+                                          ('4', None, [], None)], out)
+        finally:
+            exporter.terminate()
+        self.assertEqual((nrows, errors), (len(rows), []))
+        self.assertEqual(sorted(out.getvalue().splitlines()), ['%d,%d' % r for r in rows])
+
+class FakePipeline:
+    """
+    Keeps up to maxinflight sends outstanding, like InsertPipeline, and
+    fails any batch with a 'bad' row in it.
+    """
+
+    def __init__(self, maxinflight):
+        self.maxinflight = maxinflight
+        self.inflight = []
+        self.drains = 0
+
+    def pending(self):
+        return len(self.inflight)
+
+    def send(self, rows, tag):
+        self.inflight.append((tag, 'bad' in rows and Exception('bad row') or None))
+        done = self.inflight[:-self.maxinflight]
+        self.inflight = self.inflight[-self.maxinflight:]
+        return done
+
+    def drain(self):
+        self.drains += 1
+        done = self.inflight
+        self.inflight = []
+        return done
+
+class FakeInserter:
+    def convert_row(self, row):
+        return row[0]
+
+    def row_size(self, row):
+        return 1
+
+    def split_batch(self, batch):
+        return [batch]
+
+class FakeRouter:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def route(self, records):
+        return [(self.pipeline, records)]
+
+class TestInsertTracker(unittest.TestCase):
+    def import_chunks(self, chunks, maxerrors=0):
+        pipeline = FakePipeline(4)
+        policy = copyutil.ErrorPolicy(1, maxerrors)
+        tracker = copyutil.InsertTracker(policy)
+        results = []
+        for chunkid, rows in enumerate(chunks):
+            records = [(n, n + 1, [row]) for n, row in enumerate(rows)]
+            copyutil.import_records(FakeInserter(), FakeRouter(pipeline), copyutil.RowBatcher(),
+                                    policy, tracker, chunkid, records)
+            results.extend(tracker.pop_finished())
+            self.assertEqual(pipeline.drains, 0)
+        self.assertEqual(pipeline.pending(), min(4, sum(map(len, chunks))))
+        results.extend(tracker.finish())
+        self.assertEqual(pipeline.pending(), 0)
+        return results
+
+    def test_window_spans_chunks(self):
+        results = self.import_chunks([['a', 'b', 'c'], ['d', 'e', 'f'], ['g']])
+        self.assertEqual(results, [(0, 3, [], 3), (1, 3, [], 3), (2, 1, [], 1)])
+
+    def test_errors_go_with_their_chunk(self):
+        results = self.import_chunks([['a', 'b'], ['c', 'bad', 'd'], ['e', 'f']], maxerrors=5)
+        self.assertEqual([r[:2] for r in results], [(0, 2), (1, 2), (2, 2)])
+        self.assertEqual(results[1][2], [(1, 2, 'bad row', [['bad']])])
+
+class FlakyPipeline(FakePipeline):
+    """
+    Times out the first time it's sent each batch, and fails any batch
+    with a 'bad' row in it after that.
+    """
+
+    def __init__(self, maxinflight):
+        FakePipeline.__init__(self, maxinflight)
+        self.seen = set()
+
+    def send(self, rows, tag):
+        if tuple(rows) in self.seen:
+            return FakePipeline.send(self, rows, tag)
+        self.seen.add(tuple(rows))
+        return [(tag, cql.OperationalError('Request did not complete within rpc_timeout.'))]
+
+class TestErrorPolicy(unittest.TestCase):
+    def test_policy(self):
+        policy = copyutil.ErrorPolicy(3, maxerrors=1)
+        timeout = cql.OperationalError('timed out')
+        self.assert_(policy.should_retry(timeout, 2))
+        self.failIf(policy.should_retry(timeout, 3))
+        self.failIf(policy.should_retry(cql.ProgrammingError('Bad Request'), 1))
+        for trynum in range(1, 10):
+            delay = min(policy.max_backoff, policy.base_backoff * 2 ** (trynum - 1))
+            self.assert_(delay / 2 <= policy.retry_delay(trynum) <= delay)
+        self.failIf(policy.too_many([1]))
+        self.assert_(policy.too_many([1, 2]))
+
+    def test_retries_and_rejects(self):
+        policy = copyutil.ErrorPolicy(2, maxerrors=5)
+        policy.base_backoff = 0.001
+        tracker = copyutil.InsertTracker(policy)
+        records = [(n, n + 1, [row]) for (n, row) in enumerate(['a', 'bad', 'c'])]
+        copyutil.import_records(FakeInserter(), FakeRouter(FlakyPipeline(4)),
+                                copyutil.RowBatcher(3), policy, tracker, 0, records)
+        results = tracker.pop_finished() + tracker.finish()
+        # the batch is retried once, then split up so that only the bad row
+        # is rejected, with its original row for the ERRFILE
+        self.assertEqual(results, [(0, 2, [(1, 2, 'bad row', [['bad']])], 3)])
+
+class DyingConnParams:
+    def connect(self):
+        os._exit(1)
+
+class TestParallelImporter(unittest.TestCase):
+    def import_chunks(self, importer, chunks):
+        importer.start()
+        try:
+            for chunk in chunks:
+                self.assert_(importer.submit([(n, linenum, [val]) for (n, (linenum, val))
+                                              in enumerate(chunk)]))
+            return importer.finish()
+        finally:
+            importer.terminate()
+
+    def test_same_as_serial(self):
+        if copyutil.multiprocessing is None:
+            return
+        inserter = copyutil.PreparedInsert('INSERT INTO ks.t (%s) VALUES (%s)', ['k'], ['k'],
+                                           [lookup_casstype('UTF8Type')])
+        policy = copyutil.ErrorPolicy(1, 10)
+        chunks = [[(1, 'a'), (2, 'b'), (3, 'bad')], [(5, 'c'), (6, 'bad')], [(7, 'd')]]
+        serial = copyutil.SerialImporter(FakeConn(), inserter, copyutil.RowBatcher(), policy,
+                                         maxinflight=2, firstrow=10)
+        parallel = copyutil.ParallelImporter(FakeConnParams(), inserter, copyutil.RowBatcher(),
+                                             2, policy, maxinflight=2, firstrow=10)
+        expected = (4, [(12, 3, 'Bad Request: bad value', [['bad']]),
+                        (14, 6, 'Bad Request: bad value', [['bad']])])
+        for importer in (serial, parallel):
+            imported, errors = self.import_chunks(importer, chunks)
+            self.assertEqual((imported, sorted(errors)), expected)
+            self.assertEqual(importer.lost_chunks, [])
+
+    def test_chunks_lost_with_workers(self):
+        if copyutil.multiprocessing is None:
+            return
+        importer = copyutil.ParallelImporter(DyingConnParams(), FakeInserter(),
+                                             copyutil.RowBatcher(), 1,
+                                             copyutil.ErrorPolicy(1, 100))
+        importer.start()
+        try:
+            importer.submit([(0, 1, ['a']), (1, 2, ['b'])])
+            importer.submit([(0, 3, ['c'])])
+            imported, errors = importer.finish()
+        finally:
+            importer.terminate()
+        self.assertEqual(imported, 0)
+        self.assertEqual(importer.lost_chunks, [0, 1])
+        self.assertEqual([(rownum, linenum, rows) for (rownum, linenum, msg, rows) in errors],
+                         [(None, 1, [['a'], ['b']]), (None, 3, [['c']])])
+        self.assert_('lines 1 to 2' in errors[0][2])
+
+class TestImportCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_save_and_load(self):
+        path = os.path.join(self.tmpdir, 'checkpoints', 'ks.t.x')
+        checkpoint = copyutil.ImportCheckpoint(path, 5, interval=0, stamp=(123, 456))
+        checkpoint.chunk_submitted(0, 1000, 12)
+        checkpoint.chunks_finished([(0, 10)])
+        self.assertEqual(copyutil.ImportCheckpoint.load(path), ((1000, 15, 12), (123, 456)))
+        checkpoint.remove()
+        self.assertEqual(copyutil.ImportCheckpoint.load(path), None)
+
+    def test_unwritable(self):
+        # a file where the checkpoint directory should be
+        blocker = os.path.join(self.tmpdir, 'checkpoints')
+        open(blocker, 'w').close()
+        failures = []
+        checkpoint = copyutil.ImportCheckpoint(os.path.join(blocker, 'ks.t.x'), interval=0,
+                                               on_failure=failures.append)
+        for chunkid in range(3):
+            checkpoint.chunk_submitted(chunkid, chunkid * 100 + 100, chunkid + 1)
+            checkpoint.chunks_finished([(chunkid, 1)])
+        checkpoint.save()
+        checkpoint.remove()
+        self.assertEqual(len(failures), 1)
+        self.assert_(isinstance(failures[0], EnvironmentError))
+        self.assertEqual(checkpoint.saved_position, None)
+
+class SmallBlockLineSource(copyutil.DecompressingLineSource):
+    blocksize = 7
+
+class TestCompression(unittest.TestCase):
+    lines = ['first line\n', 'a,b,c\n', '\n', 'x' * 100 + '\n', 'no newline']
+
+    def compress(self, codec, data):
+        out = StringIO()
+        writer = copyutil.CompressingWriter(out, codec)
+        writer.write(data)
+        writer.close()
+        return out.getvalue()
+
+    def read_lines(self, codec, data, skip=0):
+        source = SmallBlockLineSource(StringIO(data), codec, skip)
+        try:
+            lines = list(source)
+        finally:
+            source.close()
+        return lines, source.offset
+
+    def test_round_trip(self):
+        data = ''.join(self.lines)
+        for codec in ('gzip', 'bz2'):
+            compressed = self.compress(codec, data)
+            self.assertEqual(self.read_lines(codec, compressed), (self.lines, len(data)))
+            # other tools read what's written
+            if codec == 'gzip':
+                self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), data)
+            else:
+                self.assertEqual(bz2.decompress(compressed), data)
+
+    def test_concatenated_streams_and_skip(self):
+        data = ''.join(self.lines)
+        for codec in ('gzip', 'bz2'):
+            compressed = self.compress(codec, data[:15]) + self.compress(codec, data[15:])
+            skip = len(self.lines[0])
+            self.assertEqual(self.read_lines(codec, compressed, skip),
+                             (self.lines[1:], len(data)))
+
+    def test_bad_data(self):
+        source = SmallBlockLineSource(StringIO('not compressed at all'), 'gzip')
+        try:
+            self.assertRaises(zlib.error, list, source)
+        finally:
+            source.close()
+
+    def test_codec_names(self):
+        self.assertEqual(copyutil.compression_for('data.CSV.GZ'), 'gzip')
+        self.assertEqual(copyutil.compression_for('data.csv.bz2'), 'bz2')
+        self.assertEqual(copyutil.compression_for('data.csv'), None)
+        self.assertEqual(copyutil.compression_for(None), None)
+        self.assertEqual(copyutil.compression_for('data.gz', 'NONE'), None)
+        self.assertEqual(copyutil.compression_for('data.csv', 'BZ2'), 'bz2')
+        self.assertRaises(ValueError, copyutil.compression_for, 'data.csv', 'zip')
+        self.assertEqual(copyutil.range_file_name('out.csv.gz', 3), 'out.csv.3.gz')
+        self.assertEqual(copyutil.range_file_name('out.csv', 3), 'out.csv.3')
+
+class TestCSVSplitter(unittest.TestCase):
+    data = ('a,b\\\nc,d\n'
+            'e,"f\ng",h\n'
+            'i,j\\\\\n'
+            'k,\\"l\n'
+            '\\\n\n'
+            'm,n\n')
+
+    def split(self, dialect):
+        # a str has everything of an mmap that the splitter uses
+        splitter = copyutil.CSVSplitter(self.data, dialect)
+        return list(splitter.ranges(0, 1))
+
+    def test_ranges_parse_like_the_whole(self):
+        ranges = self.split(default_dialect)
+        self.assertEqual(ranges[-1][1], len(self.data))
+        self.assertEqual(sum([nlines for start, end, nlines in ranges]), self.data.count('\n'))
+        whole = list(csv.reader(StringIO(self.data), **default_dialect))
+        pieces = []
+        for start, end, nlines in ranges:
+            pieces.extend(csv.reader(StringIO(self.data[start:end]), **default_dialect))
+        self.assertEqual(pieces, whole)
+
+    def test_no_boundary_after_escaped_newline(self):
+        ends = [end for start, end, nlines in self.split(default_dialect)]
+        self.assertEqual(ends, [9, 19, 25, 31, 34, 38])
+
+    def test_without_escapechar(self):
+        dialect = dict(default_dialect, doublequote=True)
+        del dialect['escapechar']
+        ends = [end for start, end, nlines in self.split(dialect)]
+        self.assertEqual(ends[0], len('a,b\\\n'))
+
+if __name__ == '__main__':
+    unittest.main()
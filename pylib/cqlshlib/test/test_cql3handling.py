@@ -0,0 +1,188 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# checks that the ways of speeding up parsing and completion which can be
+# turned off (see ParsingRuleSet) don't change what comes out, on the cql3
+# grammar
+
+import unittest
+from cqlshlib import cql3handling
+
+CqlRuleSet = cql3handling.CqlRuleSet
+
+def marshal_type(name):
+    return 'org.apache.cassandra.db.marshal.' + name
+
+users_layout = cql3handling.CqlTableDef.from_layout({
+    u'columnfamily_name': u'users',
+    u'key_aliases': u'["k"]',
+    u'column_aliases': u'["c", "d"]',
+    u'key_validator': marshal_type('Int32Type'),
+    u'default_validator': marshal_type('BytesType'),
+    u'comparator': marshal_type('CompositeType(%s,%s,%s)'
+                                % (marshal_type('UTF8Type'), marshal_type('Int32Type'),
+                                   marshal_type('UTF8Type'))),
+    u'value_alias': None,
+    u'key_alias': None,
+}, [
+    {u'column_name': u'name', u'validator': marshal_type('UTF8Type'), u'index_name': None},
+    {u'column_name': u'age', u'validator': marshal_type('Int32Type'),
+     u'index_name': u'age_idx'},
+    {u'column_name': u'visits', u'validator': marshal_type('CounterColumnType'),
+     u'index_name': None},
+])
+users_layout.keyspace = 'ks'
+
+class FakeCassandra:
+    """
+    What the cql3 completers ask of the shell, for a keyspace ks with a
+    table users (and every other table looking just like it).
+    """
+
+    def get_keyspace_names(self):
+        return ['ks', 'system']
+
+    def get_columnfamily_names(self, ksname=None):
+        return ['users', 'Mixed']
+
+    def get_columnfamily_layout(self, ksname, cfname):
+        return users_layout
+
+    def get_index_names(self, ksname=None):
+        return ['age_idx']
+
+statements = [
+    "USE ks;",
+    "SELECT * FROM ks.users;",
+    "SELECT name, age FROM ks.users USING CONSISTENCY ONE WHERE k = 1 AND c > 'x'"
+        " ORDER BY c DESC LIMIT 10;",
+    "SELECT COUNT(*) FROM users WHERE token(k) > token(5);",
+    "SELECT * FROM users WHERE k IN (1, 2, 3);",
+    "INSERT INTO ks.users (k, c, d, name) VALUES (1, 'a', 2, 'n') USING TTL 10 AND TIMESTAMP 5;",
+    "UPDATE users USING CONSISTENCY QUORUM SET visits = visits + 1, name = 'x' WHERE k = 1;",
+    "DELETE name, age FROM users USING TIMESTAMP 3 WHERE k = 1;",
+    "BEGIN BATCH USING CONSISTENCY ONE INSERT INTO users (k, c) VALUES (1, 'a');"
+        " UPDATE users SET name = 'b' WHERE k = 2; APPLY BATCH;",
+    "CREATE KEYSPACE k2 WITH replication = {'class': 'SimpleStrategy',"
+        " 'replication_factor': 1};",
+    "CREATE TABLE t (k int, c text, v map<text, int>, PRIMARY KEY (k, c))"
+        " WITH compaction = {'class': 'LeveledCompactionStrategy'} AND comment = 'hi'"
+        " AND CLUSTERING ORDER BY (c DESC);",
+    "CREATE INDEX ON users (name);",
+    "ALTER TABLE users ADD email text;",
+    "ALTER TABLE users WITH comment = 'x';",
+    "DROP INDEX age_idx;",
+    "TRUNCATE users;",
+    "GRANT SELECT ON users TO bob;",
+    "SELECT * FROM users WHERE;",
+    "INSERT INTO users VALUES;",
+]
+
+# text before the cursor, and the partial word at it
+partials = [
+    ("", ""),
+    ("", "SEL"),
+    ("SELECT ", ""),
+    ("SELECT * FROM ", ""),
+    ("SELECT * FROM ks.", ""),
+    ("SELECT * FROM ks.", "u"),
+    ("SELECT * FROM ks.users ", ""),
+    ("SELECT * FROM ks.users WHERE ", ""),
+    ("SELECT * FROM ks.users WHERE k = 1 AND ", ""),
+    ("SELECT * FROM ks.users WHERE k = 1 AND c = 'a' AND ", ""),
+    ("SELECT * FROM ks.users WHERE k = 1 ORDER BY ", ""),
+    ("SELECT * FROM ks.users WHERE k = 1 ORDER BY c, ", ""),
+    ("SELECT * FROM ks.users WHERE TOKEN(", ""),
+    ("SELECT * FROM ks.users USING CONSISTENCY ", ""),
+    ("INSERT INTO ks.users (", ""),
+    ("INSERT INTO ks.users (k, c) VALUES (1, 'a') USING ", ""),
+    ("INSERT INTO ks.users (k, c) VALUES (1, 'a') USING TTL 5 AND ", ""),
+    ("UPDATE ks.users SET ", ""),
+    ("UPDATE ks.users SET visits = ", ""),
+    ("UPDATE ks.users USING TTL 5 AND ", ""),
+    ("DELETE ", ""),
+    ("DELETE name FROM ks.users USING ", ""),
+    ("BEGIN BATCH ", ""),
+    ("BEGIN BATCH INSERT INTO users (k, c) VALUES (1, 'a'); ", ""),
+    ("CREATE TABLE t (k int PRIMARY KEY) WITH ", ""),
+    ("CREATE TABLE t (k int PRIMARY KEY) WITH compaction = ", ""),
+    ("CREATE TABLE t (k int, c text, PRIMARY KEY (k, c)) WITH CLUSTERING ", ""),
+    ("CREATE KEYSPACE k2 WITH ", ""),
+    ("CREATE KEYSPACE k2 WITH replication = {'class': '", ""),
+    ("CREATE INDEX ON ks.users (", ""),
+    ("ALTER TABLE ks.users ", ""),
+    ("ALTER TABLE ks.users ALTER ", ""),
+    ("DROP ", ""),
+    ("DROP INDEX ", ""),
+    ("USE ", ""),
+    ("USE \"", ""),
+    ("SELECT * FROM ks.users WHERE k = 1 AND c = 'it", ""),
+]
+
+def parse_results(ruleset):
+    results = []
+    for stmt in statements:
+        ctxts = ruleset.cql_parse(stmt)
+        results.append(sorted((c.pos, sorted(c.bindings.items())) for c in ctxts))
+    return results
+
+def completion_results(ruleset):
+    cass = FakeCassandra()
+    return [sorted(ruleset.cql_complete(text, partial, cassandra_conn=cass))
+            for (text, partial) in partials]
+
+class TestSameResults(unittest.TestCase):
+    def setUp(self):
+        self.expected_parses = parse_results(CqlRuleSet)
+        self.expected_completions = completion_results(CqlRuleSet)
+
+    def check_same(self, ruleset):
+        for stmt, got, expected in zip(statements, parse_results(ruleset),
+                                       self.expected_parses):
+            self.assertEqual(got, expected, stmt)
+        for text, got, expected in zip(partials, completion_results(ruleset),
+                                       self.expected_completions):
+            self.assertEqual(got, expected, text)
+
+    def test_sanity(self):
+        # the statements parse, and the completers have something to say
+        self.assert_(all(self.expected_parses))
+        completions = dict(zip(partials, self.expected_completions))
+        self.assert_('users' in completions[('SELECT * FROM ks.', '')])
+        self.assertEqual(completions[('SELECT * FROM ks.', 'u')], ['users '])
+        self.assert_('visits' in completions[('UPDATE ks.users SET ', '')])
+        self.assertEqual(completions[('DROP INDEX ', '')], ['age_idx ;'])
+        self.assert_('TIMESTAMP' in completions[('UPDATE ks.users USING TTL 5 AND ', '')])
+        self.failIf('TTL' in completions[('UPDATE ks.users USING TTL 5 AND ', '')])
+
+    def test_packrat(self):
+        CqlRuleSet.packrat = True
+        try:
+            self.check_same(CqlRuleSet)
+        finally:
+            del CqlRuleSet.packrat
+
+    def test_lookahead(self):
+        CqlRuleSet.use_lookahead = False
+        try:
+            CqlRuleSet.find_first_sets()
+            self.check_same(CqlRuleSet)
+        finally:
+            del CqlRuleSet.use_lookahead
+            CqlRuleSet.find_first_sets()
+
+if __name__ == '__main__':
+    unittest.main()
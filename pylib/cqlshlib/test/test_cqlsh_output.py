@@ -0,0 +1,250 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# tests for how the shell prints query results, run against bin/cqlsh with
+# a fake connection in place of a real one
+
+import csv
+import imp
+import json
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+from cql.cqltypes import lookup_casstype
+
+cqlsh_path = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'bin', 'cqlsh')
+cqlsh = imp.load_source('cqlsh', cqlsh_path)
+
+class FakeResultCursor:
+    """
+    Just enough of a cql cursor for Shell: execute() gets the one row of
+    system.local the shell asks for when it starts up, and after that, the
+    result set up with set_result can be fetched. The sizes fetchmany is
+    asked for are kept in fetch_sizes.
+    """
+
+    version_row = ('1.2.0', '19.35.0', '3.0.0')
+
+    def __init__(self):
+        self.rows = []
+        self.fetch_sizes = []
+
+    def execute(self, query):
+        self.description = [(n, None, None, None, None, None, True)
+                            for n in ('release_version', 'thrift_version', 'cql_version')]
+        self.rows = [self.version_row]
+
+    def set_result(self, colnames, casstypes, rows):
+        self.description = [(n, None, None, None, None, None, True) for n in colnames]
+        self.name_info = [(n, lookup_casstype('UTF8Type')) for n in colnames]
+        self.column_types = map(lookup_casstype, casstypes)
+        self.rows = list(rows)
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchmany(self, size):
+        self.fetch_sizes.append(size)
+        page, self.rows = self.rows[:size], self.rows[size:]
+        return page
+
+class FakeResultConn:
+    def __init__(self):
+        self.result_cursor = FakeResultCursor()
+
+    def cursor(self):
+        return self.result_cursor
+
+class FakeParsed:
+    def __init__(self, **bindings):
+        self.bindings = bindings
+
+    def get_binding(self, name):
+        return self.bindings.get(name)
+
+class ShellOutputTest(unittest.TestCase):
+    def setUp(self):
+        # for what the shell tells the user, as opposed to query results
+        self.saved_stdout, self.saved_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        self.shell = cqlsh.Shell('localhost', 9160, use_conn=FakeResultConn(), tty=False,
+                                 encoding='utf8')
+        self.shell.cql_ver_tuple = (3, 0, 0, '')
+        self.shell.query_out = StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.saved_stdout, self.saved_stderr
+
+    def print_result(self, colnames, casstypes, rows):
+        cursor = self.shell.cursor
+        cursor.set_result(colnames, casstypes, rows)
+        del cursor.fetch_sizes[:]
+        self.shell.query_out = StringIO()
+        self.shell.print_result(cursor)
+        return self.shell.query_out.getvalue()
+
+class TestPaging(ShellOutputTest):
+    rows = [[n, u'x' * n] for n in range(1, 6)]
+
+    def test_unpaged(self):
+        out = self.print_result(['k', 'v'], ['Int32Type', 'UTF8Type'], self.rows)
+        self.assertEqual(out.splitlines()[:3],
+                         [' k | v', '---+-------', ' 1 |     x'])
+        self.assertEqual(len(out.splitlines()), 2 + len(self.rows) + 1)
+
+    def test_pages(self):
+        self.shell.do_paging(FakeParsed(switch='ON', size='2'))
+        self.assert_(self.shell.paging_enabled)
+        out = self.print_result(['k', 'v'], ['Int32Type', 'UTF8Type'], self.rows)
+        # a header for each page, with columns only as wide as the page needs
+        self.assertEqual(out.splitlines(), [
+            ' k | v',
+            '---+----',
+            ' 1 |  x',
+            ' 2 | xx',
+            ' k | v',
+            '---+------',
+            ' 3 |  xxx',
+            ' 4 | xxxx',
+            ' k | v',
+            '---+-------',
+            ' 5 | xxxxx',
+            '',
+        ])
+        self.assertEqual(self.shell.cursor.fetch_sizes, [2, 2, 2, 2])
+
+    def test_off(self):
+        self.shell.do_paging(FakeParsed(switch='ON'))
+        self.assertEqual(self.shell.page_size, 100)
+        self.shell.do_paging(FakeParsed(switch='OFF'))
+        self.failIf(self.shell.paging_enabled)
+        out = self.print_result(['k', 'v'], ['Int32Type', 'UTF8Type'], self.rows)
+        self.assertEqual(out.count(' k | v'), 1)
+
+    def test_bad_size(self):
+        self.shell.do_paging(FakeParsed(switch='ON', size='0'))
+        self.failIf(self.shell.paging_enabled)
+        self.assertEqual(self.shell.page_size, 100)
+        self.assert_('positive integer' in sys.stderr.getvalue())
+
+class TestSpilledResult(ShellOutputTest):
+    rows = [[n, u'\u4e2d' * (n % 4), n * 0.5] for n in range(25)]
+    casstypes = ['Int32Type', 'UTF8Type', 'DoubleType']
+
+    def test_same_as_in_memory(self):
+        self.shell.output_page_size = 4
+        inmemory = self.print_result(['k', 'v', 'f'], self.casstypes, self.rows)
+        self.shell.result_spill_rows = 5
+        spilled = self.print_result(['k', 'v', 'f'], self.casstypes, self.rows)
+        self.assertEqual(spilled, inmemory)
+        # widths come from every row, not just the ones before the spill
+        self.assertEqual(spilled.splitlines()[1], '----+--------+------')
+
+class TestMachineOutput(ShellOutputTest):
+    colnames = ['k', 'v', 'm']
+    casstypes = ['Int32Type', 'UTF8Type', 'MapType(UTF8Type,DoubleType)']
+    rows = [
+        [1, u'plain', {u'a': 0.5}],
+        [2, u'com,ma "quoted"', {}],
+        [3, u'tab\there\nnewline', None],
+        [4, u'back\\slash \xfc', {u'k,\t': 1.25}],
+        [5, None, None],
+    ]
+
+    def print_as(self, fmt, rows=None):
+        self.shell.do_output(FakeParsed(fmt=fmt))
+        return self.print_result(self.colnames, self.casstypes,
+                                 self.rows if rows is None else rows)
+
+    def test_csv(self):
+        out = self.print_as('CSV')
+        self.assertEqual(out.splitlines()[:3],
+                         ['k,v,m', '1,plain,{a: 0.5}', '2,"com,ma ""quoted""",{}'])
+        records = list(csv.reader(out.splitlines(True)))
+        self.assertEqual(records[1:], [
+            ['1', 'plain', '{a: 0.5}'],
+            ['2', 'com,ma "quoted"', '{}'],
+            ['3', 'tab\\there\\nnewline', ''],
+            ['4', 'back\\\\slash \xc3\xbc', '{k,\\t: 1.25}'],
+            ['5', '', ''],
+        ])
+
+    def test_tsv(self):
+        lines = self.print_as('tsv').splitlines()
+        # tabs and newlines in values are escaped, so every row is one line
+        # with the same number of fields
+        self.assertEqual(len(lines), len(self.rows) + 1)
+        self.assertEqual(lines[0], 'k\tv\tm')
+        self.assertEqual(lines[3], '3\ttab\\there\\nnewline\t')
+        self.assertEqual(lines[5], '5\t\t')
+        self.assert_(all(line.count('\t') == 2 for line in lines))
+
+    def test_json(self):
+        lines = self.print_as('json').splitlines()
+        self.assertEqual(len(lines), len(self.rows))
+        objs = map(json.loads, lines)
+        # keys in column order
+        self.assertEqual(lines[0], '{"k": 1, "v": "plain", "m": {"a": 0.5}}')
+        self.assertEqual([o['v'] for o in objs], [r[1] for r in self.rows])
+        self.assertEqual([o['k'] for o in objs], range(1, 6))
+        self.assertEqual(objs[4]['m'], None)
+
+    def test_decode_errors(self):
+        bad = cqlsh.DecodeError('\xde\xad', ValueError('bad'), 'UTF8Type', 'v')
+        out = self.print_as('csv', [[1, bad, None]])
+        self.assertEqual(out.splitlines()[1], '1,0xdead,')
+        self.assert_('Failed to decode' in sys.stderr.getvalue())
+
+    def test_no_colors(self):
+        self.shell.color = True
+        out = self.print_as('csv')
+        self.failIf('\x1b' in out)
+
+    def test_back_to_table(self):
+        self.print_as('json')
+        out = self.print_as('table')
+        self.assertEqual(out.splitlines()[0], ' k | v                  | m')
+
+class TestFormatCache(ShellOutputTest):
+    def show_cache(self):
+        self.shell.query_out = StringIO()
+        self.shell.do_show(FakeParsed(what='CACHE'))
+        return self.shell.query_out.getvalue()
+
+    def test_counts(self):
+        rows = [[n, u'same'] for n in range(5)]
+        self.print_result(['k', 'v'], ['Int32Type', 'UTF8Type'], rows)
+        self.assertEqual(self.show_cache(),
+                         'Format cache: 4 hits, 1 misses, 1 of 1000 entries used\n')
+
+    def test_off(self):
+        shell = cqlsh.Shell('localhost', 9160, use_conn=FakeResultConn(), tty=False,
+                            encoding='utf8', format_cache_size=0)
+        self.assert_(shell.format_cache is None)
+        self.shell = shell
+        self.assertEqual(self.show_cache(), 'The format cache is off.\n')
+
+    def test_size(self):
+        for args, size in (([], 1000), (['--format-cache-size', '10'], 10),
+                           (['--format-cache-size=0'], 0)):
+            options = cqlsh.read_options(args, {})[0]
+            self.assertEqual(options.format_cache_size, size)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from cqlshlib.displaying import FormattedValue, SpilledRows
+
+def unpack(rows):
+    return [[(v.strval, v.coloredval, v.displaywidth) for v in row] for row in rows]
+
+class TestSpilledRows(unittest.TestCase):
+    rows = [[FormattedValue(str(n), '\x1b[0;32m%d\x1b[0m' % n),
+             FormattedValue('\xe4\xb8\xad' * n, displaywidth=2 * n)]
+            for n in range(10)]
+
+    def fill(self, maxrows):
+        spilled = SpilledRows(maxrows)
+        for row in self.rows:
+            spilled.append(row)
+        return spilled
+
+    def test_in_memory(self):
+        spilled = self.fill(len(self.rows))
+        try:
+            self.assert_(spilled.spillfile is None)
+            self.assertEqual(unpack(spilled), unpack(self.rows))
+        finally:
+            spilled.close()
+
+    def test_spilled(self):
+        spilled = self.fill(3)
+        try:
+            self.assert_(spilled.spillfile is not None)
+            self.assertEqual(spilled.rows, [])
+            self.assertEqual(unpack(spilled), unpack(self.rows))
+            # and again, for a second pass
+            self.assertEqual(unpack(spilled), unpack(self.rows))
+        finally:
+            spilled.close()
+
+    def test_spill_at_limit(self):
+        spilled = SpilledRows(2)
+        try:
+            spilled.append(self.rows[0])
+            spilled.append(self.rows[1])
+            self.assert_(spilled.spillfile is None)
+            spilled.append(self.rows[2])
+            self.assert_(spilled.spillfile is not None)
+        finally:
+            spilled.close()
+
+    def test_close(self):
+        spilled = self.fill(3)
+        spillfile = spilled.spillfile
+        spilled.close()
+        self.assert_(spillfile.closed)
+        self.assertEqual(list(spilled), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import unittest
+import uuid
+from decimal import Decimal
+from cql.cqltypes import lookup_casstype
+from cqlshlib.formatting import (format_value, default_colormap, empty_colormap,
+                                 make_plain_formatter, make_value_formatter, format_by_type,
+                                 format_column, FormatterCache)
+
+ansi_re = re.compile(r'\x1b\[[0-9;]*m')
+
+class TestUncoloredValues(unittest.TestCase):
+    values = [
+        ('UTF8Type', u'back\\slash\n'),
+        ('BytesType', '\x00\xff'),
+        ('ListType(UTF8Type)', [u'\xfc\\', u'a\\b']),
+        ('SetType(AsciiType)', ['\\x\t']),
+        ('MapType(UTF8Type,UTF8Type)', {u'k\\': u'v\\'}),
+    ]
+
+    def format(self, cqltype, val, colormap):
+        return format_value(cqltype, val, encoding='utf8', colormap=colormap,
+                            time_format='%Y-%m-%d', float_precision=5, nullval='null')
+
+    def test_same_as_colored(self):
+        # with no colors, values look just like colored ones with the colors
+        # taken out
+        for typename, val in self.values:
+            cqltype = lookup_casstype(typename)
+            colored = self.format(cqltype, val, default_colormap)
+            uncolored = self.format(cqltype, val, empty_colormap)
+            self.assertEqual(uncolored.strval, colored.strval)
+            self.assertEqual(uncolored.coloredval, ansi_re.sub('', colored.coloredval))
+            self.assertEqual(uncolored.displaywidth, colored.displaywidth)
+
+    def test_collection_backslashes(self):
+        cqltype = lookup_casstype('ListType(UTF8Type)')
+        self.assertEqual(self.format(cqltype, [u'a\\b'], empty_colormap).coloredval, '[a\\b]')
+
+class TestPlainFormatters(unittest.TestCase):
+    values = [
+        ('UTF8Type', u'plain'),
+        ('UTF8Type', u'tab\tback\\slash \xfc\u4e2d'),
+        ('AsciiType', 'nl\n\x7f'),
+        ('BytesType', '\x00\xff'),
+        ('Int32Type', -12),
+        ('LongType', 2 ** 40),
+        ('IntegerType', -(2 ** 70)),
+        ('CounterColumnType', 7),
+        ('FloatType', 1.5),
+        ('DoubleType', -0.0),
+        ('DoubleType', 123456789.125),
+        ('DecimalType', Decimal('1.00')),
+        ('BooleanType', False),
+        ('UUIDType', uuid.UUID('8ab53f46-27cf-4f1c-a3d6-0a3f0bd2a8a3')),
+        ('TimeUUIDType', uuid.UUID('d4b3ad80-6011-11e2-a1b6-000000000000')),
+        ('DateType', 1358354400.25),
+        ('ListType(UTF8Type)', [u'a\\b', u'\xfc']),
+        ('SetType(DoubleType)', [0.5, 2.0]),
+        ('MapType(UTF8Type,Int32Type)', {u'k\n': 1}),
+    ]
+
+    def test_same_as_format_value(self):
+        # the plain formatters give the same strings format_value does
+        for time_format, float_precision in (('%Y-%m-%d %H:%M:%S%z', 3), ('%s', 10)):
+            for typename, val in self.values:
+                cqltype = lookup_casstype(typename)
+                fval = format_value(cqltype, val, encoding='utf8', colormap=empty_colormap,
+                                    time_format=time_format,
+                                    float_precision=float_precision, nullval='null')
+                plain = make_plain_formatter(cqltype, 'utf8', time_format, float_precision)
+                self.assertEqual(plain(val), fval.strval, '%s %r' % (typename, val))
+
+class TestFormatColumn(unittest.TestCase):
+    def fields(self, fvals):
+        return [(v.strval, v.coloredval, v.displaywidth) for v in fvals]
+
+    def test_same_as_format_by_type(self):
+        columns = [
+            ('UTF8Type', [u'a', None, u'\u4e2d\u6587', u'tab\t']),
+            ('Int32Type', [1, -200, None]),
+            ('DoubleType', [0.5, 1e100]),
+            ('ListType(UTF8Type)', [[u'x', u'y'], []]),
+        ]
+        for addcolor in (False, True):
+            for typename, values in columns:
+                cqltype = lookup_casstype(typename)
+                formatter = make_value_formatter(cqltype, 'utf8', addcolor=addcolor,
+                                                 time_format='%Y', float_precision=4)
+                formatted, width = format_column(formatter, values)
+                expected = [format_by_type(cqltype, v, 'utf8', addcolor=addcolor,
+                                           time_format='%Y', float_precision=4)
+                            for v in values]
+                self.assertEqual(self.fields(formatted), self.fields(expected))
+                self.assertEqual(width, max(v.displaywidth for v in expected))
+
+    def test_width(self):
+        formatter = make_value_formatter(lookup_casstype('UTF8Type'), 'utf8')
+        # display width, not length, and never less than the width given
+        self.assertEqual(format_column(formatter, [u'\u4e2d\u6587', u'abc'])[1], 4)
+        self.assertEqual(format_column(formatter, [u'abc'], 10)[1], 10)
+        self.assertEqual(format_column(formatter, [], 3), ([], 3))
+
+class TestFormatterCache(unittest.TestCase):
+    def setUp(self):
+        self.made = []
+
+    def make(self, arg):
+        self.made.append(arg)
+        return arg * 2
+
+    def test_hits_and_misses(self):
+        cache = FormatterCache(3)
+        self.assertEqual(cache.get('a', self.make, 'a'), 'aa')
+        self.assertEqual(cache.get('a', self.make, 'a'), 'aa')
+        self.assertEqual(cache.get('b', self.make, 'b'), 'bb')
+        self.assertEqual(self.made, ['a', 'b'])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 2, 2))
+
+    def test_evicts_least_recently_used(self):
+        cache = FormatterCache(2)
+        cache.get('a', self.make, 'a')
+        cache.get('b', self.make, 'b')
+        cache.get('a', self.make, 'a')
+        # b is the least recently used now, so it goes
+        cache.get('c', self.make, 'c')
+        self.assertEqual(len(cache), 2)
+        cache.get('a', self.make, 'a')
+        cache.get('c', self.make, 'c')
+        self.assertEqual(self.made, ['a', 'b', 'c'])
+        cache.get('b', self.make, 'b')
+        self.assertEqual(self.made, ['a', 'b', 'c', 'b'])
+        self.assertEqual(sorted(cache.entries), ['b', 'c'])
+
+    def test_many_evictions(self):
+        cache = FormatterCache(5)
+        for n in range(100):
+            self.assertEqual(cache.get(n % 7, self.make, n % 7), (n % 7) * 2)
+            self.assert_(len(cache) <= 5)
+        # going round 7 keys in order, with room for 5, always misses
+        self.assertEqual((cache.hits, cache.misses), (0, 100))
+
+    def test_zero_size(self):
+        cache = FormatterCache(0)
+        self.assertEqual(cache.get('a', self.make, 'a'), 'aa')
+        self.assertEqual(cache.get('a', self.make, 'a'), 'aa')
+        self.assertEqual((len(cache), cache.misses), (0, 2))
+
+    def test_clear(self):
+        cache = FormatterCache(2)
+        cache.get('a', self.make, 'a')
+        cache.get('a', self.make, 'a')
+        cache.clear()
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+        cache.get('a', self.make, 'a')
+        self.assertEqual(self.made, ['a', 'a'])
+
+    def test_cached_formatter(self):
+        cache = FormatterCache(10)
+        cqltype = lookup_casstype('UTF8Type')
+        formatter = make_value_formatter(cqltype, 'utf8', time_format='%Y',
+                                         float_precision=3, cache=cache)
+        first = formatter(u'same')
+        self.assert_(formatter(u'same') is first)
+        self.assertEqual(first.strval, 'same')
+        self.assertEqual(formatter(None).strval, 'null')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # with other options, the same value is formatted anew
+        colored = make_value_formatter(cqltype, 'utf8', addcolor=True, time_format='%Y',
+                                       float_precision=3, cache=cache)(u'same')
+        self.assert_(colored is not first)
+        self.assertNotEqual(colored.coloredval, first.coloredval)
+        # colormaps are told apart by what's in them, not by identity
+        mycolors = dict(default_colormap, text='<', reset='>')
+        mine = make_value_formatter(cqltype, 'utf8', colormap=mycolors, addcolor=True,
+                                    time_format='%Y', float_precision=3, cache=cache)
+        self.assertEqual(mine(u'same').coloredval, '<same>')
+        self.assert_(make_value_formatter(cqltype, 'utf8', colormap=dict(mycolors),
+                                          addcolor=True, time_format='%Y',
+                                          float_precision=3, cache=cache)(u'same')
+                     is mine(u'same'))
+        # types left out of cacheable_types don't go in the cache
+        make_value_formatter(lookup_casstype('Int32Type'), 'utf8', cache=cache)(5)
+        self.assertEqual(len(cache), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from cqlshlib import pylexotron
+from cqlshlib.pylexotron import GrammarCache, PackratMemo, ParsingRuleSet
+
+rules = '''
+<stmt> ::= "SELECT" <ident> ";" ;
+<ident> ::= /[a-z]+/ ;
+'''
+
+class TestGrammarCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.made = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make(self):
+        self.made += 1
+        return ParsingRuleSet.parse_rules(rules)
+
+    def get(self):
+        return GrammarCache(self.tmpdir).get('rules', rules, self.make)
+
+    def files(self):
+        return os.listdir(self.tmpdir)
+
+    def test_kept(self):
+        first = self.get()
+        self.assertEqual(len(self.files()), 1)
+        again = self.get()
+        self.assertEqual(self.made, 1)
+        self.assertEqual(sorted(again[0]), sorted(first[0]))
+        self.assertEqual([name for (name, t) in again[1]], ['ident'])
+
+    def test_corrupt_file(self):
+        for junk in ('', 'not a pickle', 'cpylexotron\nno_such_class\nq\x00.'):
+            self.get()
+            fname = os.path.join(self.tmpdir, self.files()[0])
+            f = open(fname, 'wb')
+            f.write(junk)
+            f.close()
+            made = self.made
+            # made again, and the bad file replaced
+            self.assertEqual(sorted(self.get()[0]), ['ident', 'stmt'])
+            self.assertEqual(self.made, made + 1)
+            self.assertEqual(self.files(), [os.path.basename(fname)])
+            self.assertNotEqual(open(fname, 'rb').read(), junk)
+
+    def test_corrupt_file_removed(self):
+        self.get()
+        fname = os.path.join(self.tmpdir, self.files()[0])
+        open(fname, 'wb').close()
+        # even when what's made again can't be kept
+        cache = GrammarCache(self.tmpdir)
+        cache.put = lambda fname, val: None
+        cache.get('rules', rules, self.make)
+        self.assertEqual(self.made, 2)
+        self.assertEqual(self.files(), [])
+
+    def test_code_changes(self):
+        cache = GrammarCache(self.tmpdir)
+        fname = cache.filename('rules', rules)
+        saved = GrammarCache.code_digest
+        try:
+            # as if pylexotron.py had been changed
+            GrammarCache.code_digest = 'something else'
+            self.assertNotEqual(GrammarCache(self.tmpdir).filename('rules', rules), fname)
+        finally:
+            GrammarCache.code_digest = saved
+
+    def test_source_digest(self):
+        digest = pylexotron.source_digest(GrammarCache.code_modules)
+        self.assertEqual(len(digest), 40)
+        self.assertEqual(GrammarCache(self.tmpdir).code_digest, digest)
+        self.assertNotEqual(pylexotron.source_digest([unittest]), digest)
+
+    def test_no_source(self):
+        saved = GrammarCache.code_digest
+        try:
+            GrammarCache.code_digest = ''
+            self.get()
+            self.get()
+            self.assertEqual(self.made, 2)
+            self.assertEqual(self.files(), [])
+        finally:
+            GrammarCache.code_digest = saved
+
+first_rules = r'''
+<stmt> ::= <opt> "GO"
+         | <many> <ident>
+         | <later>
+         | <opt>
+         ;
+<opt> ::= "MAYBE"? ;
+<many> ::= ( "ONE" | "TWO" )* ;
+<later> ::= "LATER" <ident> ;
+<odd> ::= <nowhere> | "ODD" ;
+<ident> ::= /[a-z]+/ ;
+JUNK ::= /[ \t]+/ ;
+'''
+
+class TestFirstSets(unittest.TestCase):
+    def setUp(self):
+        self.ruleset = ParsingRuleSet.from_rule_defs(first_rules)
+
+    def parse(self, text):
+        return sorted((c.pos, sorted(c.bindings.items()))
+                      for c in self.ruleset.lex_and_parse(text, 'stmt'))
+
+    def test_nullable(self):
+        firsts = self.ruleset.first_sets
+        self.assertEqual(firsts['opt'], (frozenset(['maybe']), True))
+        self.assertEqual(firsts['many'], (frozenset(['one', 'two']), True))
+        self.assertEqual(firsts['ident'], (frozenset(['ident']), False))
+
+    def test_references(self):
+        firsts = self.ruleset.first_sets
+        self.assertEqual(firsts['later'], (frozenset(['later']), False))
+        # through the nullable productions, to what comes after them
+        self.assertEqual(self.ruleset.ruleset['stmt'].lookahead, [
+            frozenset(['maybe', 'go']),
+            frozenset(['one', 'two', 'ident']),
+            frozenset(['later']),
+            # tried whatever the next token is, since it can match nothing
+            None,
+        ])
+        # a production that doesn't exist could be anything
+        self.assertEqual(firsts['odd'], (None, True))
+        self.assertEqual(self.ruleset.ruleset['odd'].lookahead, [None, frozenset(['odd'])])
+
+    def test_appended(self):
+        self.assertEqual(self.ruleset.lex_and_whole_match('soon x', 'stmt'), None)
+        self.ruleset.append_rules('''
+            <later> ::= "LATER" <ident> | "SOON" <ident> ;
+            <nowhere> ::= "HERE" <ident> ;
+        ''')
+        self.assert_(self.ruleset.lex_and_whole_match('soon x', 'stmt') is not None)
+        # once loaded, the choices in <stmt> and <odd> were told about the
+        # new rules
+        self.assertEqual(self.ruleset.ruleset['stmt'].lookahead[2],
+                         frozenset(['later', 'soon']))
+        self.assertEqual(self.ruleset.first_sets['odd'], (frozenset(['here', 'odd']), False))
+        self.assertEqual(self.ruleset.ruleset['odd'].lookahead,
+                         [frozenset(['here']), frozenset(['odd'])])
+
+    def test_skipped(self):
+        texts = ['go', 'maybe go', 'one two x', 'x', 'later x', 'odd', 'maybe']
+        lookahead = map(self.parse, texts)
+        self.ruleset.use_lookahead = False
+        self.ruleset.find_first_sets()
+        self.assertEqual(self.ruleset.ruleset['stmt'].lookahead, None)
+        self.assertEqual(map(self.parse, texts), lookahead)
+
+# both alternatives of <tail> start with a <list>, so with the memo on, the
+# second gets what the first matched; [items] is added to by both <stmt>
+# and <list>, and the completers for last and next look at it
+packrat_rules = r'''
+<stmt> ::= [items]=<word> <tail> ( "then" next=<word> )? ;
+<tail> ::= <list> "!"
+         | <list> "?"
+         ;
+<list> ::= "(" [items]=<word> ( "," [items]=<word> )* ")" last=<word>? ;
+<word> ::= /[a-z]+/ ;
+<punct> ::= /[(),!?;]/ ;
+JUNK ::= /[ \t]+/ ;
+'''
+
+class CountingMemo(PackratMemo):
+    hits = 0
+
+    def match(self, rule, name, ctxt, completions):
+        if self.results.get((name, ctxt.pos)) is not None:
+            CountingMemo.hits += 1
+        return PackratMemo.match(self, rule, name, ctxt, completions)
+
+class TestPackrat(unittest.TestCase):
+    texts = ['a ( b ) !', 'a ( b , c ) ?', 'a ( b , c , d ) e ?', 'a ( b ) ;', 'a (']
+    partials = ['a ', 'a ( ', 'a ( b , c ', 'a ( b , c ) ', 'a ( b ) d ', 'a ( b , c ) ! ',
+                'a ( b , c ) ? then ']
+
+    def setUp(self):
+        self.ruleset = ParsingRuleSet.from_rule_defs(packrat_rules)
+        self.ruleset.register_completer(self.complete_word, 'list', 'last')
+        self.ruleset.register_completer(self.complete_word, 'stmt', 'next')
+        CountingMemo.hits = 0
+        pylexotron.PackratMemo = CountingMemo
+
+    def tearDown(self):
+        pylexotron.PackratMemo = PackratMemo
+
+    @staticmethod
+    def complete_word(ctxt):
+        return ['after_' + ctxt.get_binding('items')[-1]]
+
+    def parse(self, text):
+        return sorted((c.pos, sorted(c.bindings.items()))
+                      for c in self.ruleset.lex_and_parse(text, 'stmt'))
+
+    def complete(self, text):
+        return sorted(self.ruleset.complete('stmt', self.ruleset.lex(text)))
+
+    def with_and_without(self, func, args):
+        self.ruleset.packrat = False
+        without = map(func, args)
+        self.assertEqual(CountingMemo.hits, 0)
+        self.ruleset.packrat = True
+        return map(func, args), without
+
+    def test_parse(self):
+        got, expected = self.with_and_without(self.parse, self.texts)
+        self.assertEqual(got, expected)
+        self.assert_(CountingMemo.hits > 0)
+        # what <list> collected, replayed after what <stmt> had already
+        whole = self.ruleset.lex_and_whole_match('a ( b , c , d ) e ?', 'stmt')
+        self.assertEqual(whole.get_binding('items'), ('a', 'b', 'c', 'd'))
+        self.assertEqual(whole.get_binding('last'), 'e')
+
+    def test_complete(self):
+        got, expected = self.with_and_without(self.complete, self.partials)
+        self.assertEqual(got, expected)
+        self.assert_(CountingMemo.hits > 0)
+        # the completer sees the bindings made on the way to the end
+        self.assertEqual(self.complete('a ( b , c ) '), ['!', '?', 'after_c'])
+        self.assertEqual(self.complete('a ( b ) d '), ['!', '?'])
+        # and those replayed from the memo
+        self.assertEqual(self.complete('a ( b , c ) ? then '), ['after_c'])
+
+if __name__ == '__main__':
+    unittest.main()
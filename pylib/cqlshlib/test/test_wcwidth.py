@@ -0,0 +1,66 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+from cql.cqltypes import lookup_casstype
+from cqlshlib import wcwidth
+from cqlshlib.formatting import format_value, empty_colormap
+
+class TestWidthTable(unittest.TestCase):
+    samples = [
+        u'',
+        u'plain ascii',
+        u'\u4e2d\u6587 and \uff21\uff22',
+        u'combining e\u0301 \u200b',
+        u'tab\there',
+        u'nul\x00',
+        u'del\x7f',
+        u'\x9f',
+        u'\ud7a3\ud7a4\ufffd',
+    ]
+
+    def test_bmp_same_as_mk_wcwidth(self):
+        for ucs in xrange(0x10000):
+            self.assertEqual(wcwidth.wcwidth(unichr(ucs)), wcwidth.mk_wcwidth(ucs),
+                             'U+%04X' % ucs)
+
+    def test_beyond_bmp(self):
+        if sys.maxunicode <= 0xFFFF:
+            return
+        for ucs in (0x10000, 0x1d167, 0x20000, 0x2fffd, 0x2fffe, 0x30000, 0xe0001):
+            self.assertEqual(wcwidth.wcwidth(unichr(ucs)), wcwidth.mk_wcwidth(ucs))
+        s = u'a' + unichr(0x20000) + unichr(0x1d167)
+        self.assertEqual(wcwidth.wcswidth(s), 3)
+
+    def test_wcswidth_same_as_mk_wcswidth(self):
+        for s in self.samples:
+            self.assertEqual(wcwidth.wcswidth(s), wcwidth.mk_wcswidth(map(ord, s)), repr(s))
+
+class TestTextWidths(unittest.TestCase):
+    def test_ascii_fast_path(self):
+        # plain ascii text takes a shortcut to its width; it should come out
+        # the same as for text which doesn't
+        cqltype = lookup_casstype('UTF8Type')
+        for val in (u'', u'abc', u'a b~[]', u'\u4e2d\u6587', u'e\u0301', u'back\\slash',
+                    u'new\nline'):
+            fval = format_value(cqltype, val, encoding='utf8', colormap=empty_colormap,
+                                time_format='', float_precision=3, nullval='null')
+            self.assertEqual(fval.displaywidth,
+                             wcwidth.wcswidth(fval.strval.decode('utf8')), repr(val))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -300,12 +300,56 @@ def mk_wcswidth_cjk(pwcs):
 
   return width
 
+# mk_wcwidth() is a lot of python to run for every character of every
+# value displayed, so the widths of the characters in the Basic
+# Multilingual Plane are worked out ahead of time into a table, one byte
+# per code point, holding the width plus one (so that control characters
+# get 0). The rest of the code points are left to mk_wcwidth().
+
+# spacing characters in the East Asian Wide (W) or Full-width (F) categories
+# in the BMP, as mk_wcwidth() has them
+wide_bmp = (
+  ( 0x1100, 0x115F ), ( 0x2329, 0x232A ), ( 0x2E80, 0x303E ),
+  ( 0x3040, 0xA4CF ), ( 0xAC00, 0xD7A3 ), ( 0xF900, 0xFAFF ),
+  ( 0xFE10, 0xFE19 ), ( 0xFE30, 0xFE6F ), ( 0xFF00, 0xFF60 ),
+  ( 0xFFE0, 0xFFE6 )
+)
+
+def mk_bmp_width_table():
+  table = bytearray('\x02') * 0x10000
+  def set_widths(first, last, width):
+    if first > 0xFFFF:
+      return
+    last = min(last, 0xFFFF)
+    table[first:last + 1] = chr(width + 1) * (last - first + 1)
+  # in the reverse of the order mk_wcwidth() tests for them in
+  for first, last in wide_bmp:
+    set_widths(first, last, 2)
+  for first, last in combining:
+    set_widths(first, last, 0)
+  set_widths(0x01, 0x1F, -1)
+  set_widths(0x7F, 0x9F, -1)
+  set_widths(0x00, 0x00, 0)
+  return table
+
+bmp_widths = mk_bmp_width_table()
+
 # python-y versions, dealing with unicode objects
 def wcwidth(c):
-    return mk_wcwidth(ord(c))
+    ucs = ord(c)
+    if ucs <= 0xFFFF:
+        return bmp_widths[ucs] - 1
+    return mk_wcwidth(ucs)
 
 def wcswidth(s):
-    return mk_wcswidth(map(ord, s))
+    try:
+        widths = map(bmp_widths.__getitem__, map(ord, s))
+    except IndexError:
+        # something beyond the BMP in there
+        return mk_wcswidth(map(ord, s))
+    if 0 in widths:
+        return -1
+    return sum(widths) - len(widths)
 
 def wcwidth_cjk(c):
     return mk_wcwidth_cjk(ord(c))
@@ -364,4 +408,9 @@ if __name__ == "__main__":
 
     assert wcswidth(u'foobar\u200b\a') < 0
 
+    for ucs in xrange(0x10000):
+        assert bmp_widths[ucs] - 1 == mk_wcwidth(ucs), \
+                'width table says %d for U+%04X, but mk_wcwidth says %d' \
+                % (bmp_widths[ucs] - 1, ucs, mk_wcwidth(ucs))
+
     print 'tests pass.'